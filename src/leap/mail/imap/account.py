@@ -412,6 +412,16 @@ class SoledadBackedAccount(WithMsgFields, IndexedDB, MBoxParser):
 
     # extra, for convenience
 
+    def reconcile_counts(self):
+        """
+        Reconcile the message counters kept in the memory store with the
+        ones in soledad, after a sync.
+
+        It blocks, so it is expected to run in a separate thread.
+        """
+        if self._memstore is not None:
+            self._memstore.reconcile_counts()
+
     def deleteAllMessages(self, iknowhatiamdoing=False):
         """
         Deletes all messages from all mailboxes.
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# collector.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Garbage collection of orphaned header and content documents.
+
+Header and content documents are shared by all the messages with the same
+content and payload hashes, so they are not deleted when a message is
+expunged. The collector counts the references to them from the flags
+documents (and the header documents, for the contents), and deletes the
+ones that nobody refers to anymore.
+
+Since a message can start referring to an orphaned document while we are
+collecting, the orphans are forgotten by the dedup check first, and only
+the ones that are still orphans after a second count are deleted.
+
+Other devices of the same account can write a message whose header and
+content documents we already have, referring to them from a flags document
+that has not been synced here yet. Those documents look like orphans to us,
+so the collector runs in dry-run mode unless told otherwise.
+"""
+import logging
+
+from collections import Counter
+
+from twisted.internet import defer
+from twisted.internet.task import deferLater, LoopingCall
+
+from leap.mail.decorators import deferred_to_thread
+from leap.mail.imap.fields import fields
+
+logger = logging.getLogger(__name__)
+
+
+# The period of the collection, in seconds.
+COLLECT_PERIOD = 60 * 60
+
+# The maximum number of documents deleted per second.
+COLLECT_RATE = 100
+
+# The number of documents deleted in a row.
+COLLECT_BATCH_SIZE = 20
+
+
+def get_phashes(content):
+    """
+    Return the payload hashes referred from a header document, walking
+    its parts map.
+
+    :param content: the content of the header document
+    :type content: dict
+    :rtype: set
+    """
+    phashes = set([])
+    pending = [content]
+    while pending:
+        item = pending.pop()
+        if isinstance(item, dict):
+            for key, value in item.iteritems():
+                if key in (fields.PAYLOAD_HASH_KEY, fields.BODY_KEY):
+                    if isinstance(value, basestring) and value:
+                        phashes.add(str(value))
+                else:
+                    pending.append(value)
+        elif isinstance(item, (list, tuple)):
+            pending.extend(item)
+    return phashes
+
+
+class OrphanCollector(object):
+    """
+    A rate-limited mark and sweep collector for the header and content
+    documents that are not referred to by any message.
+    """
+
+    def __init__(self, soledad, memstore=None, soledad_store=None,
+                 rate=COLLECT_RATE, dry_run=True):
+        """
+        Initialize an OrphanCollector.
+
+        :param soledad: a Soledad instance
+        :type soledad: Soledad
+        :param memstore: the memory store, whose pending messages are also
+                         counted as references.
+        :type memstore: MemoryStore
+        :param soledad_store: the soledad store, whose dedup check has to
+                              forget the deleted documents.
+        :type soledad_store: SoledadStore
+        :param rate: the maximum number of documents deleted per second.
+        :type rate: int
+        :param dry_run: if True, only report the orphans, without
+                        deleting them. See the module docstring before
+                        turning it off.
+        :type dry_run: bool
+        """
+        self._soledad = soledad
+        self._memstore = memstore
+        self._soledad_store = soledad_store
+        self._rate = rate
+        self._dry_run = dry_run
+
+        self._loop = None
+        self._collecting = False
+
+    def start(self, period=COLLECT_PERIOD):
+        """
+        Start collecting periodically.
+
+        :param period: the period of the collection, in seconds.
+        :type period: int
+        """
+        if self._loop is None:
+            self._loop = LoopingCall(self.collect)
+            self._loop.start(period, now=False)
+        else:
+            logger.warning("Tried to start an already running collector.")
+
+    def stop(self):
+        """
+        Stop collecting.
+        """
+        if self._loop and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    @defer.inlineCallbacks
+    def collect(self, dry_run=None):
+        """
+        Find the orphaned header and content documents, and delete them
+        unless we are in dry-run mode.
+
+        :param dry_run: overrides the dry-run mode given at construction.
+        :type dry_run: bool or None
+        :return: a deferred that will be fired with a report dict, with the
+                 content hashes of the orphaned headers, the payload hashes
+                 of the orphaned contents, and the number of deleted
+                 documents.
+        :rtype: Deferred
+        """
+        if dry_run is None:
+            dry_run = self._dry_run
+        if self._collecting:
+            logger.debug("Already collecting orphans.")
+            defer.returnValue(None)
+        self._collecting = True
+        try:
+            report = yield self._collect(dry_run)
+        finally:
+            self._collecting = False
+        defer.returnValue(report)
+
+    @defer.inlineCallbacks
+    def _collect(self, dry_run):
+        """
+        Do the collection.
+
+        :param dry_run: whether to only report the orphans.
+        :type dry_run: bool
+        :rtype: Deferred
+        """
+        # 1. mark
+        chashes, phashes = self._get_pending_refs()
+        hdocs, cdocs = yield defer.maybeDeferred(
+            self._find_orphans, chashes, phashes)
+        hdocs, cdocs = hdocs or {}, cdocs or {}
+
+        report = {"headers": sorted(hdocs), "contents": sorted(cdocs),
+                  "deleted": 0}
+        logger.info("Found %s orphaned header docs and %s orphaned "
+                    "content docs" % (len(hdocs), len(cdocs)))
+        if dry_run or not (hdocs or cdocs):
+            defer.returnValue(report)
+
+        # 2. forget them and mark again, so that no message started to
+        # refer to them meanwhile.
+        for docs in hdocs.values() + cdocs.values():
+            for doc in docs:
+                self._forget(doc)
+        chashes, phashes = self._get_pending_refs()
+        still_hdocs, still_cdocs = yield defer.maybeDeferred(
+            self._find_orphans, chashes, phashes)
+        docs = ([doc for chash, docs in hdocs.iteritems()
+                 if chash in (still_hdocs or {}) for doc in docs] +
+                [doc for phash, docs in cdocs.iteritems()
+                 if phash in (still_cdocs or {}) for doc in docs])
+
+        # 3. sweep, rate limited
+        from twisted.internet import reactor
+        for start in xrange(0, len(docs), COLLECT_BATCH_SIZE):
+            batch = docs[start:start + COLLECT_BATCH_SIZE]
+            deleted = yield defer.maybeDeferred(self._delete_docs, batch)
+            report["deleted"] += deleted or 0
+            yield deferLater(reactor, float(len(batch)) / self._rate,
+                             lambda: None)
+        logger.info("Deleted %s orphaned docs" % (report["deleted"],))
+        defer.returnValue(report)
+
+    def _get_pending_refs(self):
+        """
+        Return the content and payload hashes referred to by the messages
+        in the memory store that have not been written yet.
+
+        :return: a tuple with the sets of content and payload hashes
+        :rtype: tuple
+        """
+        chashes, phashes = set([]), set([])
+        if self._memstore is None:
+            return chashes, phashes
+        for msg in self._memstore.all_new_dirty_msg_iter():
+            chash = msg.fdoc.content.get(fields.CONTENT_HASH_KEY, None)
+            if chash:
+                chashes.add(str(chash))
+            phashes.update(get_phashes(msg.hdoc.content or {}))
+            for cdoc in msg.cdocs.values():
+                phash = cdoc.get(fields.PAYLOAD_HASH_KEY, None)
+                if phash:
+                    phashes.add(str(phash))
+        return chashes, phashes
+
+    @deferred_to_thread
+    def _find_orphans(self, chashes, phashes):
+        """
+        Count the references to every header and content document, and
+        return the ones without any.
+
+        :param chashes: content hashes referred to from elsewhere.
+        :type chashes: set
+        :param phashes: payload hashes referred to from elsewhere.
+        :type phashes: set
+        :return: a tuple with two dicts, with the lists of orphaned header
+                 and content documents, by content and payload hash.
+        :rtype: tuple
+        """
+        soledad = self._soledad
+        chash_refs = Counter(chashes)
+        for key in soledad.get_index_keys(fields.TYPE_C_HASH_IDX):
+            if key[0] == fields.TYPE_FLAGS_VAL:
+                chash_refs[str(key[1])] += 1
+
+        phash_refs = Counter(phashes)
+        orphan_hdocs = {}
+        for hdoc in soledad.get_from_index(
+                fields.TYPE_IDX, fields.TYPE_HEADERS_VAL):
+            chash = str(hdoc.content.get(fields.CONTENT_HASH_KEY, ""))
+            if chash_refs[chash]:
+                phash_refs.update(get_phashes(hdoc.content))
+            else:
+                orphan_hdocs.setdefault(chash, []).append(hdoc)
+
+        orphan_cdocs = {}
+        for key in soledad.get_index_keys(fields.TYPE_P_HASH_IDX):
+            phash = str(key[1])
+            if key[0] != fields.TYPE_CONTENT_VAL or phash_refs[phash]:
+                continue
+            orphan_cdocs[phash] = soledad.get_from_index(
+                fields.TYPE_P_HASH_IDX, fields.TYPE_CONTENT_VAL, phash)
+        return orphan_hdocs, orphan_cdocs
+
+    def _forget(self, doc):
+        """
+        Make the dedup check forget a document that is going to be deleted.
+
+        :param doc: the header or content document
+        :type doc: SoledadDocument
+        """
+        if self._soledad_store is not None:
+            self._soledad_store.forget_known_hash(doc.content)
+
+    @deferred_to_thread
+    def _delete_docs(self, docs):
+        """
+        Delete some documents.
+
+        :param docs: the documents to delete
+        :type docs: list of SoledadDocument
+        :return: the number of deleted documents
+        :rtype: int
+        """
+        deleted = 0
+        for doc in docs:
+            try:
+                self._soledad.delete_doc(doc)
+                deleted += 1
+            except Exception as exc:
+                logger.exception(exc)
+        return deleted
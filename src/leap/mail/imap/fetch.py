@@ -211,6 +211,8 @@ class LeapIncomingMail(object):
             log.msg('syncing soledad...')
             self._soledad.sync()
             log.msg('soledad synced.')
+            # the sync can bring changes done by other clients.
+            self.imapAccount.reconcile_counts()
             doclist = self._soledad.get_from_index("just-mail", "*")
         self._process_doclist(doclist)
 
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+# journal.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Write-ahead journal for the MemoryStore.
+
+Every message created or modified in the MemoryStore is appended to a local
+file before it is acknowledged, and marked as done once it has been written
+to Soledad. If we crash in between, the pending records are replayed into
+the MemoryStore on the next startup.
+
+Each record is a length-prefixed pickle, followed by its crc32, so that a
+record that was only partially written when we crashed can be detected and
+discarded.
+
+The done records are not synced on their own: losing them only means that
+some messages are written again on replay. Once the file grows beyond a given
+size, it is rewritten with only the pending records.
+"""
+import cPickle as pickle
+import logging
+import os
+import struct
+import threading
+import zlib
+
+from collections import OrderedDict, namedtuple
+
+logger = logging.getLogger(__name__)
+
+
+"""
+A JournalRecord holds one of the operations in the journal.
+
+:param op: the operation, one of CREATE, PUT or DONE
+:param mbox: the mailbox
+:param uid: the message UID
+:param content: a dict with the message parts, as in MessageWrapper, or None
+"""
+JournalRecord = namedtuple('JournalRecord', ['op', 'mbox', 'uid', 'content'])
+
+CREATE = "create"
+PUT = "put"
+DONE = "done"
+
+_HEADER = struct.Struct(">II")
+
+# The size, in bytes, beyond which the journal file is compacted.
+COMPACT_SIZE = 4 * 1024 * 1024
+
+
+class MessageJournal(object):
+    """
+    An append-only journal of the pending writes of a MemoryStore.
+    """
+
+    def __init__(self, path, sync=True, compact_size=COMPACT_SIZE):
+        """
+        Initialize a MessageJournal.
+
+        :param path: the path to the journal file. It will be created if
+                     it does not exist.
+        :type path: str
+        :param sync: whether to fsync the journal after every append.
+                     Without it, the journal survives a crash of the process,
+                     but not one of the OS.
+        :type sync: bool
+        :param compact_size: the size of the journal file, in bytes, beyond
+                             which it is rewritten with only the pending
+                             records.
+        :type compact_size: int
+        """
+        self._path = path
+        self._sync = sync
+        self._compact_size = compact_size
+        self._lock = threading.Lock()
+
+        """
+        pending keeps the last record for every key that has not been
+        marked as done, in the order they were appended.
+
+        {('mbox-a', 1): JournalRecord(...)}
+        """
+        self._pending = OrderedDict()
+
+        with open(path, "ab"):
+            pass
+        self._load()
+        self._fd = open(path, "ab")
+
+        # the size of the file, and the one it had after the last
+        # compaction, so that we do not compact again until it has grown
+        # enough.
+        self._size = os.path.getsize(path)
+        self._compacted_size = self._size
+
+    def _load(self):
+        """
+        Read the records in the journal file, and keep the pending ones.
+
+        A truncated or corrupted record ends the reading, since nothing
+        could have been acknowledged after it.
+        """
+        valid = 0
+        with open(self._path, "rb") as fd:
+            while True:
+                header = fd.read(_HEADER.size)
+                if len(header) < _HEADER.size:
+                    break
+                length, crc = _HEADER.unpack(header)
+                data = fd.read(length)
+                if len(data) < length or \
+                        zlib.crc32(data) & 0xffffffff != crc:
+                    logger.warning("Discarding corrupted record at the "
+                                   "end of the journal %s" % (self._path,))
+                    break
+                try:
+                    record = JournalRecord(*pickle.loads(data))
+                except Exception as exc:
+                    logger.exception(exc)
+                    break
+                self._apply(record)
+                valid = fd.tell()
+
+        if valid != os.path.getsize(self._path):
+            with open(self._path, "r+b") as fd:
+                fd.truncate(valid)
+
+    def _apply(self, record):
+        """
+        Update the pending records with a new one.
+
+        A put after a create that has not been written yet is still
+        a create, with the updated content.
+
+        :param record: the record
+        :type record: JournalRecord
+        """
+        key = record.mbox, record.uid
+        previous = self._pending.pop(key, None)
+        if record.op == DONE:
+            return
+        if previous is not None:
+            # a put carries only the parts that changed.
+            content = dict(previous.content)
+            content.update((part, doc)
+                           for part, doc in record.content.iteritems()
+                           if doc)
+            record = record._replace(content=content)
+            if previous.op == CREATE:
+                record = record._replace(op=CREATE)
+        self._pending[key] = record
+
+    def _pack(self, record):
+        """
+        Return the bytes for a record, as written in the journal file.
+
+        :param record: the record
+        :type record: JournalRecord
+        :rtype: str
+        """
+        data = pickle.dumps(tuple(record), pickle.HIGHEST_PROTOCOL)
+        return _HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+
+    def _write(self, record, flush=True):
+        """
+        Append a record to the journal file.
+
+        :param record: the record
+        :type record: JournalRecord
+        :param flush: whether to flush the file after writing it.
+        :type flush: bool
+        """
+        data = self._pack(record)
+        self._fd.write(data)
+        self._size += len(data)
+        if flush:
+            self._flush()
+
+    def _flush(self):
+        """
+        Flush the journal file, and fsync it if we were asked to.
+        """
+        self._fd.flush()
+        if self._sync:
+            os.fsync(self._fd.fileno())
+
+    def _get_record(self, op, mbox, uid, content):
+        """
+        Return a record for an operation, with only plain types in its
+        content.
+
+        :rtype: JournalRecord
+        """
+        content = dict((part, dict(doc) if doc is not None else None)
+                       for part, doc in content.iteritems())
+        cdocs = content.get("cdocs", None)
+        if cdocs:
+            content["cdocs"] = dict((i, dict(cdoc))
+                                    for i, cdoc in cdocs.iteritems())
+        return JournalRecord(op, mbox, uid, content)
+
+    def append(self, op, mbox, uid, content):
+        """
+        Append an operation to the journal.
+
+        :param op: the operation, CREATE or PUT
+        :type op: str
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        :param content: the message parts, as in MessageWrapper.as_dict
+        :type content: dict
+        """
+        self.append_many([(op, mbox, uid, content)])
+
+    def append_many(self, operations):
+        """
+        Append several operations to the journal, syncing it only once.
+
+        :param operations: tuples with the same arguments as `append`
+        :type operations: iterable
+        """
+        records = [self._get_record(*operation) for operation in operations]
+        with self._lock:
+            for record in records:
+                self._write(record, flush=False)
+                self._apply(record)
+            self._flush()
+
+    def _compact(self):
+        """
+        Rewrite the journal file with only the pending records.
+
+        The new file is written aside and renamed over the old one, so that
+        we never end up with a partial journal.
+        """
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "wb") as fd:
+            for record in self._pending.itervalues():
+                fd.write(self._pack(record))
+            fd.flush()
+            if self._sync:
+                os.fsync(fd.fileno())
+        self._fd.close()
+        os.rename(tmp_path, self._path)
+        self._fd = open(self._path, "ab")
+        self._size = self._compacted_size = os.path.getsize(self._path)
+
+    def mark_done(self, mbox, uid):
+        """
+        Mark all the operations for a given message as written to the
+        permanent store.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        """
+        self.mark_done_many([(mbox, uid)])
+
+    def mark_done_many(self, keys):
+        """
+        Mark all the operations for several messages as written to the
+        permanent store.
+
+        The done records are flushed together with the next append. When
+        there is nothing pending anymore, the journal is truncated, and
+        when it grows beyond the compaction size it is rewritten with only
+        the pending records.
+
+        :param keys: the keys for the messages, in the form mbox, uid
+        :type keys: iterable
+        """
+        with self._lock:
+            for mbox, uid in keys:
+                if (mbox, uid) not in self._pending:
+                    continue
+                self._write(JournalRecord(DONE, mbox, uid, None),
+                            flush=False)
+                del self._pending[(mbox, uid)]
+            if not self._pending:
+                self._fd.truncate(0)
+                self._size = self._compacted_size = 0
+            elif (self._size >= self._compact_size and
+                    self._size >= 2 * self._compacted_size):
+                self._compact()
+
+    def pending(self):
+        """
+        Return the operations that have not been marked as done yet.
+
+        :rtype: list of JournalRecord
+        """
+        with self._lock:
+            return self._pending.values()
+
+    def close(self):
+        """
+        Close the journal file.
+        """
+        with self._lock:
+            self._fd.close()
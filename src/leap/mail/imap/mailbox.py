@@ -85,6 +85,24 @@ class SoledadMailbox(WithMsgFields, MBoxParser):
     CMD_UIDVALIDITY = "UIDVALIDITY"
     CMD_UNSEEN = "UNSEEN"
 
+    # Search keys that can be answered from the flags index, mapped to the
+    # flag they refer to and whether it has to be set or not.
+    FLAG_SEARCH_KEYS = {
+        "ALL": (None, True),
+        "SEEN": (WithMsgFields.SEEN_FLAG, True),
+        "UNSEEN": (WithMsgFields.SEEN_FLAG, False),
+        "DELETED": (WithMsgFields.DELETED_FLAG, True),
+        "UNDELETED": (WithMsgFields.DELETED_FLAG, False),
+        "FLAGGED": (WithMsgFields.FLAGGED_FLAG, True),
+        "UNFLAGGED": (WithMsgFields.FLAGGED_FLAG, False),
+        "ANSWERED": (WithMsgFields.ANSWERED_FLAG, True),
+        "UNANSWERED": (WithMsgFields.ANSWERED_FLAG, False),
+        "DRAFT": (WithMsgFields.DRAFT_FLAG, True),
+        "UNDRAFT": (WithMsgFields.DRAFT_FLAG, False),
+        "RECENT": (WithMsgFields.RECENT_FLAG, True),
+        "OLD": (WithMsgFields.RECENT_FLAG, False),
+    }
+
     # FIXME we should turn this into a datastructure with limited capacity
     _listeners = defaultdict(set)
 
@@ -126,9 +144,15 @@ class SoledadMailbox(WithMsgFields, MBoxParser):
         if not self.getFlags():
             self.setFlags(self.INIT_FLAGS)
 
+        # A deferred that will be fired when the flags documents for this
+        # mailbox have been loaded into the memory store.
+        self.preloaded = None
+
         if self._memstore:
-            self.prime_known_uids_to_memstore()
             self.prime_last_uid_to_memstore()
+            self.preloaded = self.prime_known_uids_to_memstore()
+            self.preloaded.addCallback(
+                lambda _: self.prime_last_uid_to_memstore())
 
     @property
     def listeners(self):
@@ -263,21 +287,43 @@ class SoledadMailbox(WithMsgFields, MBoxParser):
 
     def prime_last_uid_to_memstore(self):
         """
-        Prime memstore with last_uid value
+        Prime memstore with last_uid value.
+
+        Until the known uids have been loaded into the memstore, we rely on
+        the value stored in the mailbox document.
         """
         set_exist = set(self.messages.all_uid_iter())
         last = max(set_exist) if set_exist else 0
+        mbox = self._get_mbox()
+        if mbox:
+            last = max(last, mbox.content.get(fields.LAST_UID_KEY, 0))
         logger.info("Priming Soledad last_uid to %s" % (last,))
         self._memstore.set_last_soledad_uid(self.mbox, last)
 
     def prime_known_uids_to_memstore(self):
         """
-        Prime memstore with the set of all known uids.
+        Prime memstore with the set of all known uids, loading all the flags
+        documents for this mailbox.
+
+        We do this to be able to filter the requests efficiently, and to
+        answer the flags, uid and size fetches, counts and flag searches
+        from memory. The documents are queried in a separate thread, and
+        only once per mailbox: the memstore keeps them from then on.
+
+        :return: a deferred that will be fired when all the flags documents
+                 have been loaded.
+        :rtype: Deferred
+        """
+        return self._memstore.preload_fdocs(self.mbox, self._get_all_fdocs)
 
-        We do this to be able to filter the requests efficiently.
+    @deferred_to_thread
+    def _get_all_fdocs(self):
+        """
+        Get all the flags documents for this mailbox from soledad.
+
+        :rtype: list of SoledadDocument
         """
-        known_uids = self.messages.all_soledad_uid_iter()
-        self._memstore.set_known_uids(self.mbox, known_uids)
+        return self.messages.get_all_docs()
 
     def getUIDValidity(self):
         """
@@ -491,9 +537,32 @@ class SoledadMailbox(WithMsgFields, MBoxParser):
         if not self.isWriteable():
             raise imap4.ReadOnlyMailbox
         d = defer.Deferred()
-        self._memstore.expunge(self.mbox, d)
+        self._memstore.expunge(self.mbox, d, progress=self._expunge_progress)
         return d
 
+    def _expunge_progress(self, deleted, total):
+        """
+        Log the progress of an expunge.
+
+        :param deleted: the number of messages deleted so far
+        :type deleted: int
+        :param total: the number of messages to delete
+        :type total: int
+        """
+        logger.debug("%s: expunged %s of %s messages"
+                     % (self.mbox, deleted, total))
+
+    def flush(self):
+        """
+        Write the pending changes to this mailbox to the permanent store.
+
+        :return: a deferred that will be fired when the changes are written.
+        :rtype: Deferred
+        """
+        if self._memstore is None:
+            return defer.succeed(None)
+        return self._memstore.flush(self.mbox)
+
     def _bound_seq(self, messages_asked):
         """
         Put an upper bound to a messages sequence if this is open.
@@ -769,10 +838,53 @@ class SoledadMailbox(WithMsgFields, MBoxParser):
                 # we want a list, so return it all the same
                 return d1
 
+        flag_result = self._search_flags(query)
+        if flag_result is not None:
+            return flag_result
+
         # nothing implemented for any other query
         logger.warning("Cannot process query: %s" % (query,))
         return []
 
+    def _search_flags(self, query):
+        """
+        Answer a search that only has flag keys from the flags index in
+        the memory store.
+
+        Since our UIDs are sequential, the result is valid both for UIDs and
+        for message sequence numbers.
+
+        :param query: The search criteria
+        :type query: list
+        :return: a sorted list of UIDs, or None if the query cannot be
+                 answered from the flags index.
+        :rtype: list or None
+        """
+        if not query or self._memstore is None:
+            return None
+        if not self._memstore.is_flags_index_loaded(self.mbox):
+            return None
+        keys = []
+        for key in query:
+            if not isinstance(key, basestring):
+                return None
+            key = key.upper()
+            if key not in self.FLAG_SEARCH_KEYS:
+                return None
+            keys.append(key)
+
+        result = set(self.messages.all_uid_iter())
+        for key in keys:
+            flag, is_set = self.FLAG_SEARCH_KEYS[key]
+            if flag is None:
+                continue
+            uids = self._memstore.get_flag_uids(self.mbox, flag)
+            if is_set:
+                result.intersection_update(uids)
+            else:
+                result.difference_update(uids)
+        return sorted(result)
+
     # IMessageCopier
 
     def copy(self, message):
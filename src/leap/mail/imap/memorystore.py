@@ -20,23 +20,27 @@ In-memory transient store for a LEAPIMAPServer.
 import contextlib
 import logging
 import threading
+import time
 import weakref
 
-from collections import defaultdict
-from copy import copy
+from bisect import bisect_left, insort
+from collections import defaultdict, OrderedDict
 
-from twisted.internet import defer
-from twisted.internet.task import LoopingCall
+from twisted.internet import defer, task, threads
 from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadable import isInIOThread
 from zope.interface import implements
 
-from leap.common.check import leap_assert_type
+from leap.common.check import leap_assert, leap_assert_type
 from leap.mail import size
 from leap.mail.decorators import deferred_to_thread
 from leap.mail.utils import empty
 from leap.mail.messageflow import MessageProducer
 from leap.mail.imap import interfaces
+from leap.mail.imap import journal as msgjournal
 from leap.mail.imap.fields import fields
+from leap.mail.imap.messageparts import CompactFlagsDoc
 from leap.mail.imap.messageparts import MessagePartType, MessagePartDoc
 from leap.mail.imap.messageparts import RecentFlagsDoc
 from leap.mail.imap.messageparts import MessageWrapper
@@ -45,10 +49,33 @@ from leap.mail.imap.messageparts import ReferenciableDict
 logger = logging.getLogger(__name__)
 
 
-# The default period to do writebacks to the permanent
-# soledad storage, in seconds.
+# The default maximum age of the oldest pending change before we do
+# a writeback to the permanent soledad storage, in seconds.
 SOLEDAD_WRITE_PERIOD = 10
 
+# The default number of pending messages, and their size in bytes, that
+# trigger a writeback without waiting for the write period to expire.
+WRITE_BACK_MAX_PENDING = 50
+WRITE_BACK_MAX_SIZE = 4 * 1024 * 1024
+
+# Time to wait before retrying a writeback if the previous one is still
+# being consumed, in seconds.
+WRITE_BACK_RETRY = 0.5
+
+# The flags we keep an index of uids for. The \Recent flag is not kept
+# in the flags documents, but in a per-mailbox set.
+INDEXED_FLAGS = (fields.SEEN_FLAG, fields.DELETED_FLAG, fields.FLAGGED_FLAG,
+                 fields.ANSWERED_FLAG, fields.DRAFT_FLAG)
+
+# The default memory budget for the message store, in bytes. When it is
+# exceeded, the messages that have already been written to the permanent
+# store are evicted, least recently used first.
+MEMORY_BUDGET = 128 * 1024 * 1024
+
+# The number of flags documents loaded in a single step of the reactor
+# when preloading a mailbox.
+PRELOAD_CHUNK_SIZE = 500
+
 
 @contextlib.contextmanager
 def set_bool_flag(obj, att):
@@ -75,10 +102,10 @@ class MemoryStore(object):
     indexed by mailbox name and UID.
 
     It also can be passed a permanent storage as a paremeter (any implementor
-    of IMessageStore, in this case a SoledadStore). In this case, a periodic
-    dump of the messages stored in memory will be done. The period of the
-    writes to the permanent storage is controled by the write_period parameter
-    in the constructor.
+    of IMessageStore, in this case a SoledadStore). In this case, the
+    messages stored in memory will be dumped to it whenever the number of
+    pending messages, their size or the age of the oldest pending change
+    go beyond the thresholds passed in the constructor.
     """
     implements(interfaces.IMessageStore,
                interfaces.IMessageStoreWriter)
@@ -90,18 +117,41 @@ class MemoryStore(object):
     _last_uid_lock = threading.Lock()
 
     def __init__(self, permanent_store=None,
-                 write_period=SOLEDAD_WRITE_PERIOD):
+                 write_period=SOLEDAD_WRITE_PERIOD,
+                 max_size=MEMORY_BUDGET,
+                 max_pending=WRITE_BACK_MAX_PENDING,
+                 max_pending_size=WRITE_BACK_MAX_SIZE,
+                 journal=None):
         """
         Initialize a MemoryStore.
 
         :param permanent_store: a IMessageStore implementor to dump
                                 messages to.
         :type permanent_store: IMessageStore
-        :param write_period: the interval to dump messages to disk, in seconds.
+        :param write_period: the maximum time a change can wait before being
+                             dumped to disk, in seconds.
         :type write_period: int
+        :param max_size: the memory budget for the stored messages, in bytes.
+                         Messages that are neither new nor dirty are evicted
+                         when it is exceeded. None means no limit.
+        :type max_size: int or None
+        :param max_pending: the number of pending messages that triggers
+                            a dump to disk.
+        :type max_pending: int
+        :param max_pending_size: the size of the pending messages, in bytes,
+                                 that triggers a dump to disk.
+        :type max_pending_size: int
+        :param journal: a journal where the changes are recorded before
+                        being acknowledged. Its pending changes are replayed
+                        into the store.
+        :type journal: MessageJournal or None
         """
         self._permanent_store = permanent_store
         self._write_period = write_period
+        self._max_size = max_size
+        self._max_pending = max_pending
+        self._max_pending_size = max_pending_size
+        self._journal = journal
 
         # Internal Storage: messages
         self._msg_store = {}
@@ -126,10 +176,11 @@ class MemoryStore(object):
         # Internal Storage: recent-flags store
         """
         recent-flags store keeps one dict per mailbox,
-        with the document-id of the u1db document
+        with the document-id and revision of the u1db document
         and the set of the UIDs that have the recent flag.
 
         {'mbox-a': {'doc_id': 'deadbeef',
+                    'rev': 'cafe:3',
                     'set': {1,2,3,4}
                     }
         }
@@ -138,7 +189,19 @@ class MemoryStore(object):
         # indexes after we move to local-only UIDs.
 
         self._rflags_store = defaultdict(
-            lambda: {'doc_id': None, 'set': set([])})
+            lambda: {'doc_id': None, 'rev': None, 'set': set([])})
+
+        """
+        recent-flags changes keeps, per mailbox, the UIDs whose recent flag
+        has changed since the document was last queued for writing, with
+        their new value. The changes of the write in progress, if any, are
+        kept in the in-flight dict until the write is confirmed.
+
+        {'mbox-a': {5: True, 2: False}}
+        """
+        self._rflags_changes = defaultdict(dict)
+        self._rflags_inflight = {}
+        self._rflags_lock = threading.Lock()
 
         """
         last-uid store keeps the count of the highest UID
@@ -149,6 +212,15 @@ class MemoryStore(object):
         """
         self._last_uid = {}
 
+        """
+        last-uid-pending keeps the highest last uid per mailbox that has not
+        been written to the permanent store yet. It is written, only once
+        per mailbox, together with the pending messages.
+
+        {'mbox-a': 42}
+        """
+        self._last_uid_pending = {}
+
         """
         known-uids keeps a count of the uids that soledad knows for a given
         mailbox
@@ -157,12 +229,132 @@ class MemoryStore(object):
         """
         self._known_uids = defaultdict(set)
 
+        """
+        fdoc-revs keeps the document id and the revision of the flags
+        document for the messages that are in the permanent store, so that
+        we can put a dirty flags document without looking it up first.
+
+        {('mbox-a', 1): ('doc-id', 'rev')}
+        """
+        self._fdoc_revs = {}
+
+        """
+        generations keeps a counter per message that is incremented every
+        time the message is created, changed or removed, so that the
+        LeapMessage instances can tell when their cached documents are
+        stale.
+
+        {('mbox-a', 1): 3}
+        """
+        self._generations = defaultdict(int)
+
+        # Flags index.
+        """
+        flag-uids keeps, for each mailbox, the set of uids that have each
+        one of the indexed flags. flags-known keeps the uids whose flags
+        we have indexed, and flags-loaded the mailboxes for which we have
+        also loaded the flags of all the messages in the permanent store,
+        so the index is complete.
+
+        {'mbox-a': {'\\Seen': set([1, 2]), '\\Deleted': set([2])}}
+        """
+        self._flag_uids = defaultdict(lambda: defaultdict(set))
+        self._flags_known = defaultdict(set)
+        self._flags_loaded = set([])
+        self._flags_lock = threading.Lock()
+
+        """
+        preload-waiters keeps, for each mailbox whose flags documents are
+        being preloaded, the deferreds to be fired once they are loaded,
+        and preload-removed the uids removed meanwhile, that must not be
+        loaded back.
+
+        {'mbox-a': [<Deferred>]}
+        {'mbox-a': set([3])}
+        """
+        self._preload_waiters = {}
+        self._preload_removed = defaultdict(set)
+
+        # Internal Storage: per-mailbox partitions
+        """
+        mbox-uids keeps, for each mailbox, a sorted list with the UIDs of
+        the messages that we are holding in the message store. We use it to
+        avoid walking the keys of the whole message store when we are only
+        interested in the messages of a given mailbox.
+
+        {'mbox-a': [1, 2, 3],
+         'mbox-b': [4, 8]}
+        """
+        self._mbox_uids = defaultdict(list)
+
         # New and dirty flags, to set MessageWrapper State.
+        # dirty-deferreds keeps a list of deferreds for each key, since
+        # a message can be put several times before it is written.
         self._new = set([])
         self._new_deferreds = {}
         self._dirty = set([])
-        self._rflags_dirty = set([])
-        self._dirty_deferreds = {}
+        self._dirty_deferreds = defaultdict(list)
+
+        """
+        new-mbox and dirty-mbox are the per-mailbox partitions of the
+        `new` and `dirty` sets, holding only the UIDs.
+
+        {'mbox-a': set([4, 5])}
+        """
+        self._new_mbox = defaultdict(set)
+        self._dirty_mbox = defaultdict(set)
+
+        # Memory management.
+        """
+        clean-lru keeps the keys of the messages that are neither new nor
+        dirty, ordered from the least to the most recently used. These are
+        the candidates for eviction when we go over the memory budget.
+
+        evicted keeps, for each mailbox, the uids of the messages that we
+        have evicted, so that we know we have to reload them from the
+        permanent store on the next access.
+
+        {'mbox-a': set([1, 2])}
+
+        msg-sizes keeps the estimated size of each part of every message,
+        and we keep running totals for the whole store, for each mailbox
+        and for each part type, so that reading any of them is O(1).
+
+        {('mbox-a', 1): {'fdoc': 120, 'hdoc': 800, 'cdocs': 4096}}
+        """
+        self._clean_lru = OrderedDict()
+        self._evicted = defaultdict(set)
+        self._msg_sizes = {}
+        self._store_size = 0
+        self._mbox_sizes = defaultdict(int)
+        self._part_sizes = defaultdict(int)
+        self._lru_lock = threading.RLock()
+
+        # Write-back scheduling.
+        """
+        pending keeps the keys of the messages that have been created or
+        modified since the last dump to disk. Changing the same message
+        several times between two dumps counts only once.
+
+        pending-since is the time of the oldest change not yet dumped.
+        """
+        self._pending = set([])
+        self._pending_since = None
+        self._pending_lock = threading.Lock()
+        self._write_call = None
+        self._write_paused = False
+
+        """
+        flush-waiters keeps, for each message that someone is waiting to be
+        written, the deferreds to be fired once it is neither new nor dirty.
+
+        {('mbox-a', 1): [<Deferred>]}
+        """
+        self._flush_waiters = defaultdict(list)
+        self._flush_lock = threading.Lock()
+
+        # The mailboxes whose write-back is paused, ie, while expunging.
+        self._paused_mboxes = set([])
 
         # Flag for signaling we're busy writing to the disk storage.
         setattr(self, self.WRITING_FLAG, False)
@@ -173,26 +365,115 @@ class MemoryStore(object):
             # our messages to be written.
             self.producer = MessageProducer(permanent_store,
                                             period=0.1)
-            # looping call for dumping to SoledadStore
-            self._write_loop = LoopingCall(self.write_messages,
-                                           permanent_store)
 
-            # We can start the write loop right now, why wait?
-            self._start_write_loop()
+        if self._journal is not None:
+            self._replay_journal()
 
     def _start_write_loop(self):
         """
-        Start loop for writing to disk database.
+        Resume the writes to disk database, and do any pending one.
         """
-        if not self._write_loop.running:
-            self._write_loop.start(self._write_period, now=True)
+        self._write_paused = False
+        self._schedule_write()
 
     def _stop_write_loop(self):
         """
-        Stop loop for writing to disk database.
+        Pause the writes to disk database.
+        """
+        self._write_paused = True
+        if self._write_call is not None and self._write_call.active():
+            self._write_call.cancel()
+        self._write_call = None
+
+    def _mark_pending(self, *keys):
+        """
+        Record a change that has to be dumped to disk, and schedule the
+        write-back accordingly.
+
+        :param keys: the keys for the changed messages, in the form mbox,
+                     uid. None if the change is not on a message (ie, the
+                     recent flags).
+        :type keys: tuple
+        """
+        if self._permanent_store is None:
+            return
+        with self._pending_lock:
+            self._pending.update(key for key in keys if key is not None)
+            if self._pending_since is None:
+                self._pending_since = time.time()
+        self._schedule_write()
+
+    def _get_pending_size(self):
+        """
+        Return the estimated size of the pending messages, in bytes.
+
+        :rtype: int
+        """
+        sizes = self._msg_sizes
+        with self._pending_lock:
+            pending = list(self._pending)
+        return sum(sum(sizes.get(key, {}).itervalues()) for key in pending)
+
+    def _schedule_write(self):
+        """
+        Schedule the next write-back: right away if the pending changes go
+        beyond any of the thresholds, or when the oldest one expires
+        otherwise.
+
+        It is safe to call this from any thread, the scheduling is always
+        done in the reactor thread.
+        """
+        from twisted.internet import reactor
+        if not isInIOThread():
+            reactor.callFromThread(self._schedule_write)
+            return
+        if self._write_paused or self._pending_since is None:
+            return
+
+        if (len(self._pending) >= self._max_pending or
+                self._get_pending_size() >= self._max_pending_size):
+            delay = 0
+        else:
+            age = time.time() - self._pending_since
+            delay = max(0, self._write_period - age)
+
+        call = self._write_call
+        if call is not None and call.active():
+            if call.getTime() <= reactor.seconds() + delay:
+                return
+            call.cancel()
+        self._write_call = reactor.callLater(delay, self._do_write)
+
+    def _write_now(self):
+        """
+        Dump the pending changes to the permanent store as soon as
+        possible, regardless of the thresholds.
+
+        It is safe to call this from any thread.
+        """
+        from twisted.internet import reactor
+        if not isInIOThread():
+            reactor.callFromThread(self._write_now)
+            return
+        if self._write_paused or self._pending_since is None:
+            return
+        call = self._write_call
+        if call is not None and call.active():
+            call.cancel()
+        self._write_call = reactor.callLater(0, self._do_write)
+
+    def _do_write(self):
+        """
+        Dump the pending changes to the permanent store, retrying later
+        if the previous dump has not been consumed yet.
         """
-        if self._write_loop.running:
-            self._write_loop.stop()
+        from twisted.internet import reactor
+        self._write_call = None
+        if self._write_paused:
+            return
+        if not self.write_messages(self._permanent_store):
+            self._write_call = reactor.callLater(
+                WRITE_BACK_RETRY, self._do_write)
 
     # IMessageStore
 
@@ -227,8 +508,50 @@ class MemoryStore(object):
         log.msg("adding new doc to memstore %r (%r)" % (mbox, uid))
         key = mbox, uid
 
+        self._journal_append(msgjournal.CREATE, mbox, uid, message)
+        self._create_message(mbox, uid, message, observer, notify_on_disk)
+        self._mark_pending(key)
+
+    def create_messages(self, mbox, messages, notify_on_disk=True):
+        """
+        Create several new messages into this MemoryStore at once.
+
+        They are recorded in the journal in one go, and the write-back is
+        scheduled only once.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param messages: tuples with the UID and the MessageWrapper for
+                         every message.
+        :type messages: list of tuples
+        :param notify_on_disk: whether the returned deferred should wait
+                               until the messages are written to disk to
+                               be fired.
+        :type notify_on_disk: bool
+        :return: a deferred that will fire with the list of UIDs.
+        :rtype: Deferred
+        """
+        log.msg("adding %s new docs to memstore %r" % (len(messages), mbox))
+        if self._journal is not None:
+            self._journal.append_many(
+                (msgjournal.CREATE, mbox, uid, message.as_dict())
+                for uid, message in messages)
+        observers = []
+        for uid, message in messages:
+            observer = defer.Deferred()
+            self._create_message(mbox, uid, message, observer, notify_on_disk)
+            observers.append(observer)
+        self._mark_pending(*[(mbox, uid) for uid, _ in messages])
+        return defer.gatherResults(observers)
+
+    def _create_message(self, mbox, uid, message, observer, notify_on_disk):
+        """
+        Helper method, called by both create_message and create_messages.
+        See create_message for parameter documentation.
+        """
+        key = mbox, uid
+        self.set_new(key)
         self._add_message(mbox, uid, message, notify_on_disk)
-        self._new.add(key)
 
         # XXX use this while debugging the callback firing,
         # remove after unittesting this.
@@ -273,11 +596,90 @@ class MemoryStore(object):
         d = defer.Deferred()
         d.addCallback(lambda result: log.msg("message PUT save: %s" % result))
 
-        self._dirty.add(key)
-        self._dirty_deferreds[key] = d
+        self._journal_append(msgjournal.PUT, mbox, uid, message)
+        self.set_dirty(key)
+        self._dirty_deferreds[key].append(d)
         self._add_message(mbox, uid, message, notify_on_disk)
+        self._mark_pending(key)
         return d
 
+    # Journal
+
+    def _journal_append(self, op, mbox, uid, message):
+        """
+        Record an operation in the journal, if we have one.
+
+        :param op: the operation, CREATE or PUT
+        :type op: str
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the UID for the message
+        :type uid: int
+        :param message: the message
+        :type message: MessageWrapper
+        """
+        if self._journal is not None:
+            self._journal.append(op, mbox, uid, message.as_dict())
+
+    def _journal_done(self, key):
+        """
+        Mark a message as written in the journal, if we have one and the
+        message is neither new nor dirty anymore.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        """
+        if self._journal is None:
+            return
+        if key in self._new or key in self._dirty:
+            return
+        mbox, uid = key
+        self._journal.mark_done(mbox, uid)
+
+    def _replay_journal(self):
+        """
+        Load into the store the operations that were recorded in the journal
+        but never written to the permanent store.
+
+        If a created message made it to the permanent store before we could
+        mark it as done, it is put again instead of being created twice.
+        """
+        FDOC = MessagePartType.fdoc.key
+        HDOC = MessagePartType.hdoc.key
+        CDOCS = MessagePartType.cdocs.key
+        DOCS_ID = MessagePartType.docs_id.key
+
+        records = self._journal.pending()
+        if records:
+            logger.info("Replaying %s messages from the journal"
+                        % (len(records),))
+        for record in records:
+            mbox, uid, content = record.mbox, record.uid, record.content
+            key = mbox, uid
+            new = record.op == msgjournal.CREATE
+            docs_id = content.get(DOCS_ID, None) or {}
+
+            if new and self._permanent_store is not None:
+                fdoc = self._permanent_store.get_flags_doc(mbox, uid)
+                if fdoc is not None:
+                    new = False
+                    docs_id = {FDOC: fdoc.doc_id}
+
+            message = MessageWrapper(
+                fdoc=content.get(FDOC, None), hdoc=content.get(HDOC, None),
+                cdocs=content.get(CDOCS, None),
+                new=new, dirty=not new, docs_id=docs_id)
+            if new:
+                self.set_new(key)
+            else:
+                self.set_dirty(key)
+            self._add_message(mbox, uid, message)
+            with self._last_uid_lock:
+                if uid > self._last_uid.get(mbox, 0):
+                    self._last_uid[mbox] = uid
+                    self._last_uid_pending[mbox] = uid
+            self._mark_pending(key)
+
     def _add_message(self, mbox, uid, message, notify_on_disk=True):
         """
         Helper method, called by both create_message and put_message.
@@ -302,11 +704,13 @@ class MemoryStore(object):
                                     CDOCS: {},
                                     DOCS_ID: {}}
             store = self._msg_store[key]
+            self._add_to_mbox_index(mbox, uid)
+            self._evicted[mbox].discard(uid)
 
         fdoc = msg_dict.get(FDOC, None)
         if fdoc:
             if not store.get(FDOC, None):
-                store[FDOC] = ReferenciableDict({})
+                store[FDOC] = CompactFlagsDoc()
             store[FDOC].update(fdoc)
 
             # content-hash indexing
@@ -318,6 +722,9 @@ class MemoryStore(object):
             chash_fdoc_store[chash][mbox] = weakref.proxy(
                 store[FDOC])
 
+            if fields.FLAGS_KEY in fdoc:
+                self._index_flags(mbox, uid, fdoc[fields.FLAGS_KEY])
+
         hdoc = msg_dict.get(HDOC, None)
         if hdoc is not None:
             if not store.get(HDOC, None):
@@ -350,6 +757,10 @@ class MemoryStore(object):
                     store.pop(key)
         prune((FDOC, HDOC, CDOCS, DOCS_ID), store)
 
+        self._update_size(key, store)
+        self._update_lru(key)
+        self._maybe_evict(keep=key)
+
     def get_docid_for_fdoc(self, mbox, uid):
         """
         Return Soledad document id for the flags-doc for a given mbox and uid,
@@ -361,11 +772,76 @@ class MemoryStore(object):
         :type uid: int
         :rtype: unicode or None
         """
+        msg_dict = self._msg_store.get((mbox, uid), None)
+        if msg_dict is not None:
+            doc_id = msg_dict.get(MessagePartType.docs_id.key, {}).get(
+                MessagePartType.fdoc.key, None)
+            if doc_id is not None:
+                return doc_id
+
+        rev = self._fdoc_revs.get((mbox, uid), None)
+        if rev is not None:
+            return rev[0]
+
         fdoc = self._permanent_store.get_flags_doc(mbox, uid)
         if empty(fdoc):
             return None
-        doc_id = fdoc.doc_id
-        return doc_id
+        self.set_fdoc_rev(mbox, uid, fdoc.doc_id, fdoc.rev)
+        return fdoc.doc_id
+
+    def get_fdoc_rev(self, mbox, uid):
+        """
+        Return the document id and the revision of the flags document for
+        a given mbox and uid, as last seen in the permanent store.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        :return: a tuple with the doc_id and the revision, or None if we
+                 have not seen the document.
+        :rtype: tuple or None
+        """
+        return self._fdoc_revs.get((mbox, uid), None)
+
+    def set_fdoc_rev(self, mbox, uid, doc_id, rev):
+        """
+        Record the document id and the revision of the flags document for
+        a given mbox and uid, after it has been read from or written to the
+        permanent store.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        :param doc_id: the document id
+        :type doc_id: unicode
+        :param rev: the document revision
+        :type rev: unicode
+        """
+        self._fdoc_revs[(mbox, uid)] = (doc_id, rev)
+
+    def get_generation(self, mbox, uid):
+        """
+        Return the generation of a given message, that changes every time
+        the message is created, changed or removed.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        :rtype: int
+        """
+        return self._generations.get((mbox, uid), 0)
+
+    def _bump_generation(self, key):
+        """
+        Increment the generation of a given message.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        """
+        self._generations[key] += 1
 
     def get_message(self, mbox, uid, flags_only=False):
         """
@@ -386,7 +862,10 @@ class MemoryStore(object):
 
         msg_dict = self._msg_store.get(key, None)
         if empty(msg_dict):
-            return None
+            msg_dict = self._reload_evicted(mbox, uid)
+            if empty(msg_dict):
+                return None
+        self._touch(key)
         new, dirty = self._get_new_dirty_state(key)
         if flags_only:
             return MessageWrapper(fdoc=msg_dict[FDOC],
@@ -407,20 +886,92 @@ class MemoryStore(object):
         :type uid: int
         """
         # XXX For the moment we are only removing the flags and headers
-        # docs. The rest we leave there polluting your hard disk,
-        # until we think about a good way of deorphaning.
+        # docs. The rest are left there until the OrphanCollector finds
+        # nobody refers to them anymore.
 
         # XXX implement elijah's idea of using a PUT document as a
         # token to ensure consistency in the removal.
 
         try:
             key = mbox, uid
+            if mbox in self._preload_waiters:
+                self._preload_removed[mbox].add(uid)
             self._new.discard(key)
             self._dirty.discard(key)
-            self._msg_store.pop(key, None)
+            self._new_mbox[mbox].discard(uid)
+            self._dirty_mbox[mbox].discard(uid)
+            self._evicted[mbox].discard(uid)
+            self._drop_message(key)
+            self._unindex_flags(mbox, uid)
+            self._fdoc_revs.pop(key, None)
+            # whatever was pending for it must not be replayed.
+            self._journal_done(key)
+            self._fire_flush_waiters(key)
         except Exception as exc:
             logger.exception(exc)
 
+    def _drop_message(self, key):
+        """
+        Drop a message from the internal storage and from the indexes
+        that refer to it.
+
+        Its generation is bumped, since the references to its documents
+        that were handed out are not valid anymore.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        """
+        mbox, uid = key
+        self._bump_generation(key)
+        with self._lru_lock:
+            self._clean_lru.pop(key, None)
+            self._account_size(key, {})
+        msg_dict = self._msg_store.pop(key, None)
+        if msg_dict is None:
+            return
+        self._remove_from_mbox_index(mbox, uid)
+
+        fdoc = msg_dict.get(MessagePartType.fdoc.key, None)
+        if fdoc:
+            chash = fdoc.get(fields.CONTENT_HASH_KEY, None)
+            docs_dict = self._chash_fdoc_store.get(chash, None)
+            if docs_dict is not None:
+                docs_dict.pop(mbox, None)
+                if not docs_dict:
+                    self._chash_fdoc_store.pop(chash, None)
+
+    def _add_to_mbox_index(self, mbox, uid):
+        """
+        Insert an UID in the sorted partition for a given mailbox.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        """
+        uids = self._mbox_uids[mbox]
+        if not uids or uid > uids[-1]:
+            # the common case: appending a new message
+            uids.append(uid)
+        else:
+            insort(uids, uid)
+
+    def _remove_from_mbox_index(self, mbox, uid):
+        """
+        Remove an UID from the sorted partition for a given mailbox.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        """
+        uids = self._mbox_uids.get(mbox, None)
+        if not uids:
+            return
+        index = bisect_left(uids, uid)
+        if index < len(uids) and uids[index] == uid:
+            del uids[index]
+
     # IMessageStoreWriter
 
     def write_messages(self, store):
@@ -428,6 +979,8 @@ class MemoryStore(object):
         Write the message documents in this MemoryStore to a different store.
 
         :param store: the IMessageStore to write to
+        :return: whether the messages were queued for writing.
+        :rtype: bool
         """
         # For now, we pass if the queue is not empty, to avoid duplicate
         # queuing.
@@ -437,11 +990,17 @@ class MemoryStore(object):
         # XXX this could return the deferred for all the enqueued operations
 
         if not self.producer.is_queue_empty():
-            return
+            return False
 
         if any(map(lambda i: not empty(i), (self._new, self._dirty))):
             logger.info("Writing messages to Soledad...")
 
+        # everything that is pending gets queued below, any change
+        # done from now on will need another write.
+        with self._pending_lock:
+            self._pending.clear()
+            self._pending_since = None
+
         # TODO change for lock, and make the property access
         # is accquired
         with set_bool_flag(self, self.WRITING_FLAG):
@@ -449,6 +1008,9 @@ class MemoryStore(object):
                 self.producer.push(rflags_doc_wrapper)
             for msg_wrapper in self.all_new_dirty_msg_iter():
                 self.producer.push(msg_wrapper)
+            d = self._write_last_uids()
+            d.addErrback(self._log_last_uids_error)
+        return True
 
     # MemoryStore specific methods.
 
@@ -460,8 +1022,7 @@ class MemoryStore(object):
         :type mbox: str or unicode
         :rtype: list
         """
-        all_keys = self._msg_store.keys()
-        return [uid for m, uid in all_keys if m == mbox]
+        return list(self._mbox_uids.get(mbox, []))
 
     def get_soledad_known_uids(self, mbox):
         """
@@ -484,8 +1045,8 @@ class MemoryStore(object):
         :type mbox: str or unicode
         :rtype: int
         """
-        uids = self.get_uids(mbox)
-        last_mem_uid = uids and max(uids) or 0
+        uids = self._mbox_uids.get(mbox, None)
+        last_mem_uid = uids[-1] if uids else 0
         last_soledad_uid = self.get_last_soledad_uid(mbox)
         return max(last_mem_uid, last_soledad_uid)
 
@@ -513,10 +1074,10 @@ class MemoryStore(object):
         leap_assert_type(value, int)
         logger.info("setting last soledad uid for %s to %s" %
                     (mbox, value))
-        # if we already have a value here, don't do anything
+        # if we already have a value here, it can only be ahead of
+        # the stored one (or come from the journal), so keep the highest.
         with self._last_uid_lock:
-            if not self._last_uid.get(mbox, None):
-                self._last_uid[mbox] = value
+            self._last_uid[mbox] = max(self._last_uid.get(mbox, 0), value)
 
     def set_known_uids(self, mbox, value):
         """
@@ -533,17 +1094,101 @@ class MemoryStore(object):
     def increment_last_soledad_uid(self, mbox):
         """
         Increment by one the soledad integer cache for the last_uid for
-        this mbox, and fire a defer-to-thread to update the soledad value.
-        The caller should lock the call tho this method.
+        this mbox. The new value will be written to soledad with the next
+        write of the pending messages.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :return: the new last uid
+        :rtype: int
+        """
+        return self.reserve_uids(mbox, 1)
+
+    def reserve_uids(self, mbox, count):
+        """
+        Reserve a contiguous range of UIDs for a given mbox, to be used
+        when adding several messages at once.
 
+        The new last uid will be written to soledad with the next write
+        of the pending messages.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param count: the number of UIDs to reserve
+        :type count: int
+        :return: the first reserved UID. The range goes from there to
+                 first + count - 1.
+        :rtype: int
+        """
+        leap_assert(count > 0, "Need to reserve at least one UID")
+        with self._last_uid_lock:
+            # starting from zero would hand out the UIDs of messages that
+            # are already stored.
+            leap_assert(mbox in self._last_uid,
+                        "The last uid for %s has not been primed" % (mbox,))
+            first = self._last_uid[mbox] + 1
+            value = first + count - 1
+            self._last_uid[mbox] = value
+            self._last_uid_pending[mbox] = value
+        self._mark_pending()
+        return first
+
+    def _write_last_uids(self):
+        """
+        Write to the permanent store the highest last uid reached by every
+        mailbox since the previous write.
+
+        :return: a deferred that will be fired when they are written.
+        :rtype: Deferred
+        """
+        if self._permanent_store is None:
+            return defer.succeed(None)
+        with self._last_uid_lock:
+            pending = self._last_uid_pending
+            self._last_uid_pending = {}
+        if not pending:
+            return defer.succeed(None)
+
+        deferreds = []
+        for mbox, value in pending.iteritems():
+            d = threads.deferToThread(
+                self._permanent_store.write_last_uid, mbox, value)
+            d.addErrback(self._last_uid_write_failed, mbox, value)
+            deferreds.append(d)
+        return defer.gatherResults(deferreds, consumeErrors=True)
+
+    def _last_uid_write_failed(self, failure, mbox, value):
+        """
+        Errback for a failed write of the last uid of a mailbox. The value
+        is pending again, so it will be written in the next round.
+
+        :param failure: the failure for the write
+        :type failure: twisted.python.failure.Failure
         :param mbox: the mailbox
         :type mbox: str or unicode
+        :param value: the value that could not be written
+        :type value: int
+        :return: the same failure
         """
         with self._last_uid_lock:
-            self._last_uid[mbox] += 1
-            value = self._last_uid[mbox]
-            self.write_last_uid(mbox, value)
-            return value
+            # a later reservation may already be pending, keep the highest.
+            self._last_uid_pending[mbox] = max(
+                self._last_uid_pending.get(mbox, 0), value)
+        self._mark_pending()
+        return failure
+
+    def _log_last_uids_error(self, failure):
+        """
+        Errback for the write of the last uids done by `write_messages`,
+        where nobody is waiting for the result.
+
+        :param failure: the failure for the write
+        :type failure: twisted.python.failure.Failure
+        """
+        if failure.check(defer.FirstError):
+            failure = failure.value.subFailure
+        logger.error("Error writing the last uids: %s"
+                     % (failure.getErrorMessage(),))
 
     @deferred_to_thread
     def write_last_uid(self, mbox, value):
@@ -570,7 +1215,7 @@ class MemoryStore(object):
         :return: number of new messages
         :rtype: int
         """
-        return len([(m, uid) for m, uid in self._new if mbox == mbox])
+        return len(self._new_mbox.get(mbox, []))
 
     # XXX used at all?
     def count_new(self):
@@ -661,9 +1306,10 @@ class MemoryStore(object):
         :return: generator of MessageWrappers
         :rtype: generator
         """
+        paused = self._paused_mboxes
         return (self.get_message(*key)
-                for key in sorted(self._msg_store.keys())
-                if key in self._new or key in self._dirty)
+                for key in sorted(self._new.union(self._dirty))
+                if key in self._msg_store and key[0] not in paused)
 
     def all_msg_dict_for_mbox(self, mbox):
         """
@@ -676,8 +1322,10 @@ class MemoryStore(object):
         """
         # This *needs* to return a fixed sequence. Otherwise the dictionary len
         # will change during iteration, when we modify it
-        return [self._msg_store[(mb, uid)]
-                for mb, uid in self._msg_store if mb == mbox]
+        msg_store = self._msg_store
+        return [msg_store[(mbox, uid)]
+                for uid in self._mbox_uids.get(mbox, [])
+                if (mbox, uid) in msg_store]
 
     def all_deleted_uid_iter(self, mbox):
         """
@@ -691,11 +1339,363 @@ class MemoryStore(object):
         """
         # This *needs* to return a fixed sequence. Otherwise the dictionary len
         # will change during iteration, when we modify it
-        all_deleted = [
-            msg['fdoc']['uid'] for msg in self.all_msg_dict_for_mbox(mbox)
-            if msg.get('fdoc', None)
-            and fields.DELETED_FLAG in msg['fdoc']['flags']]
-        return all_deleted
+        deleted = self.get_flag_uids(mbox, fields.DELETED_FLAG)
+        return sorted(uid for uid in deleted
+                      if (mbox, uid) in self._msg_store)
+
+    # Flags index
+
+    def _index_flags(self, mbox, uid, flags):
+        """
+        Update the flags index for a given message.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        :param flags: the flags for the message
+        :type flags: sequence
+        """
+        flags = set(flags)
+        with self._flags_lock:
+            flag_uids = self._flag_uids[mbox]
+            for flag in INDEXED_FLAGS:
+                if flag in flags:
+                    flag_uids[flag].add(uid)
+                else:
+                    flag_uids[flag].discard(uid)
+            self._flags_known[mbox].add(uid)
+
+    def _unindex_flags(self, mbox, uid):
+        """
+        Remove a message from the flags index.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        """
+        with self._flags_lock:
+            for uids in self._flag_uids[mbox].itervalues():
+                uids.discard(uid)
+            self._flags_known[mbox].discard(uid)
+
+    def load_fdocs(self, mbox, fdocs):
+        """
+        Load the flags documents for all the messages of a mailbox that are
+        in the permanent store, as clean messages. This also completes
+        the flags index and the known uids for that mailbox.
+
+        The messages that we already hold in memory are kept, since they
+        can be more recent than the stored ones.
+
+        It modifies the indexes, so it has to be called from the reactor
+        thread.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param fdocs: the flags documents
+        :type fdocs: iterable of SoledadDocument
+        """
+        for _ in self._iter_load_fdocs(mbox, fdocs):
+            pass
+
+    def _iter_load_fdocs(self, mbox, fdocs):
+        """
+        Generator that loads the flags documents of a mailbox, as
+        `load_fdocs` does, yielding after every chunk of them so that it
+        can be run cooperatively in the reactor.
+
+        The messages that we already hold, either in memory or evicted, are
+        skipped, and so are the ones that were removed while the documents
+        were being queried.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param fdocs: the flags documents
+        :type fdocs: iterable of SoledadDocument
+        """
+        FDOC = MessagePartType.fdoc.key
+        known_uids = self._known_uids[mbox]
+        # the same set that remove_message keeps updating meanwhile.
+        removed = self._preload_removed[mbox]
+        for i, doc in enumerate(fdocs):
+            if i and not i % PRELOAD_CHUNK_SIZE:
+                yield
+            uid = doc.content[fields.UID_KEY]
+            key = mbox, uid
+            if uid in removed:
+                continue
+            known_uids.add(uid)
+            self._fdoc_revs[key] = (doc.doc_id, doc.rev)
+            if key in self._msg_store or uid in self._evicted.get(mbox, ()):
+                continue
+            self._add_message(
+                mbox, uid, MessageWrapper(
+                    fdoc=doc.content, new=False, dirty=False,
+                    docs_id={FDOC: doc.doc_id}),
+                notify_on_disk=False)
+        self._preload_removed.pop(mbox, None)
+        self._flags_loaded.add(mbox)
+
+    def preload_fdocs(self, mbox, get_fdocs):
+        """
+        Load the flags documents of a mailbox into the store, only once.
+
+        The documents are got from the permanent store by the passed
+        callable, and loaded in chunks, cooperatively, in the reactor
+        thread. If the mailbox is already loaded, or being loaded, they
+        are not got again.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param get_fdocs: a callable that returns the flags documents for
+                          the mailbox, or a deferred for them, or None if
+                          they could not be got.
+        :type get_fdocs: callable
+        :return: a deferred that will be fired when the documents have
+                 been loaded.
+        :rtype: Deferred
+        """
+        d = defer.Deferred()
+        if mbox in self._flags_loaded:
+            d.callback(None)
+            return d
+        waiters = self._preload_waiters.get(mbox, None)
+        if waiters is not None:
+            waiters.append(d)
+            return d
+        self._preload_waiters[mbox] = [d]
+
+        def load(fdocs):
+            if fdocs is None:
+                return
+            logger.debug("Loading %s flags docs for %s into memstore"
+                         % (len(fdocs), mbox))
+            return task.cooperate(
+                self._iter_load_fdocs(mbox, fdocs)).whenDone()
+
+        def fire(result):
+            if isinstance(result, Failure):
+                logger.error("Error preloading %s: %s"
+                             % (mbox, result.getErrorMessage()))
+            self._preload_removed.pop(mbox, None)
+            for waiter in self._preload_waiters.pop(mbox, []):
+                waiter.callback(None)
+
+        loading = defer.maybeDeferred(get_fdocs)
+        loading.addCallback(load)
+        loading.addBoth(fire)
+        return d
+
+    def reconcile_counts(self):
+        """
+        Check the message counters of the mailboxes whose flags are loaded
+        against the permanent store, and reload the flags documents of the
+        ones that do not match.
+
+        This is meant to be called after a sync, that can bring the changes
+        done by other clients. It blocks, so it is expected to run in a
+        separate thread: only the queries to the permanent store are done
+        there, the counters are checked and the flags documents reloaded
+        in the reactor thread.
+        """
+        store = self._permanent_store
+        if store is None:
+            return
+        for mbox in self._call_in_reactor(list, self._flags_loaded):
+            try:
+                exists, unseen = store.count_flags_docs(mbox)
+                if self._call_in_reactor(
+                        self._counts_match, mbox, exists, unseen):
+                    continue
+                logger.debug("Counters for %s out of date, reloading "
+                             "the flags docs" % (mbox,))
+                fdocs = store.get_all_flags_docs(mbox)
+                self._call_in_reactor(self._reload_fdocs, mbox, fdocs)
+            except Exception as exc:
+                logger.exception(exc)
+
+    def _counts_match(self, mbox, exists, unseen):
+        """
+        Return whether the message counters of a mailbox match the ones in
+        the permanent store.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param exists: the number of messages in the permanent store
+        :type exists: int
+        :param unseen: the number of unseen messages in the permanent store
+        :type unseen: int
+        :rtype: bool
+        """
+        # the new messages are not in the permanent store yet,
+        # and the dirty ones can have other flags there.
+        new = self.count_new_mbox(mbox)
+        matches = exists == self.count_exists(mbox) - new
+        if matches and not new and not self._dirty_mbox.get(mbox):
+            matches = unseen == self.count_unseen(mbox)
+        return matches
+
+    def _call_in_reactor(self, f, *args):
+        """
+        Call a function in the reactor thread and return its result,
+        blocking the calling thread until it is done.
+
+        :param f: the function to call
+        :type f: callable
+        """
+        from twisted.internet import reactor
+        if isInIOThread():
+            return f(*args)
+        return threads.blockingCallFromThread(reactor, f, *args)
+
+    def _reload_fdocs(self, mbox, fdocs):
+        """
+        Replace the flags of the clean messages of a mailbox with the ones
+        in the permanent store, and forget the messages that are not there
+        anymore.
+
+        It modifies the indexes, so it has to be called from the reactor
+        thread.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param fdocs: all the flags documents for that mailbox
+        :type fdocs: iterable of SoledadDocument
+        """
+        FDOC = MessagePartType.fdoc.key
+        stored = set([])
+        for doc in fdocs:
+            uid = doc.content[fields.UID_KEY]
+            key = mbox, uid
+            stored.add(uid)
+            self._fdoc_revs[key] = (doc.doc_id, doc.rev)
+            if key in self._new or key in self._dirty:
+                continue
+            self._evicted[mbox].discard(uid)
+            self._add_message(
+                mbox, uid, MessageWrapper(
+                    fdoc=doc.content, new=False, dirty=False,
+                    docs_id={FDOC: doc.doc_id}),
+                notify_on_disk=False)
+            self._bump_generation(key)
+
+        pending = self._new_mbox[mbox].union(self._dirty_mbox[mbox])
+        with self._flags_lock:
+            gone = self._flags_known[mbox].difference(stored, pending)
+        for uid in gone:
+            self.remove_message(mbox, uid)
+        self._known_uids[mbox].difference_update(gone)
+        self._known_uids[mbox].update(stored)
+
+    def has_all_fdocs(self, mbox):
+        """
+        Return whether we hold in memory the flags documents for all the
+        messages of a mailbox.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: bool
+        """
+        return mbox in self._flags_loaded and not self._evicted.get(mbox)
+
+    def all_fdoc_iter(self, mbox):
+        """
+        Return an iterator through the flags documents that we hold in memory
+        for a given mailbox.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: generator
+        """
+        FDOC = MessagePartType.fdoc.key
+        return (msg[FDOC] for msg in self.all_msg_dict_for_mbox(mbox)
+                if msg.get(FDOC, None))
+
+    def is_flags_index_loaded(self, mbox):
+        """
+        Return whether the flags index for a mailbox knows about all
+        its messages.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: bool
+        """
+        return mbox in self._flags_loaded
+
+    def get_flag_uids(self, mbox, flag):
+        """
+        Return the UIDs of the messages in a mailbox that have a given flag.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param flag: one of the indexed flags, or \\Recent
+        :type flag: str
+        :rtype: set
+        """
+        if flag == fields.RECENT_FLAG:
+            return set(self.get_recent_flags(mbox) or [])
+        with self._flags_lock:
+            flag_uids = self._flag_uids.get(mbox, None)
+            if flag_uids is None:
+                return set([])
+            return set(flag_uids.get(flag, []))
+
+    def count_flag(self, mbox, flag):
+        """
+        Return the number of messages in a mailbox with a given flag.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param flag: one of the indexed flags, or \\Recent
+        :type flag: str
+        :rtype: int
+        """
+        if flag == fields.RECENT_FLAG:
+            return len(self.get_recent_flags(mbox) or [])
+        with self._flags_lock:
+            flag_uids = self._flag_uids.get(mbox, None)
+            if flag_uids is None:
+                return 0
+            return len(flag_uids.get(flag, []))
+
+    def count_exists(self, mbox):
+        """
+        Return the number of messages in a mailbox, as known by the
+        flags index.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: int
+        """
+        with self._flags_lock:
+            return len(self._flags_known.get(mbox, []))
+
+    def get_unseen_uids(self, mbox):
+        """
+        Return the UIDs of the messages in a mailbox without the \\Seen flag.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: set
+        """
+        with self._flags_lock:
+            return self._flags_known.get(mbox, set([])).difference(
+                self._flag_uids.get(mbox, {}).get(fields.SEEN_FLAG, []))
+
+    def count_unseen(self, mbox):
+        """
+        Return the number of messages in a mailbox without the \\Seen flag.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: int
+        """
+        with self._flags_lock:
+            return (len(self._flags_known.get(mbox, [])) -
+                    len(self._flag_uids.get(mbox, {}).get(
+                        fields.SEEN_FLAG, [])))
 
     # new, dirty flags
 
@@ -719,6 +1719,10 @@ class MemoryStore(object):
         :type key: tuple
         """
         self._new.add(key)
+        mbox, uid = key
+        self._new_mbox[mbox].add(uid)
+        self._bump_generation(key)
+        self._update_lru(key)
 
     def unset_new(self, key):
         """
@@ -728,6 +1732,8 @@ class MemoryStore(object):
         :type key: tuple
         """
         self._new.discard(key)
+        mbox, uid = key
+        self._new_mbox[mbox].discard(uid)
         deferreds = self._new_deferreds
         d = deferreds.get(key, None)
         if d:
@@ -735,6 +1741,10 @@ class MemoryStore(object):
             # when we check it in the other side.
             d.callback('%s, ok' % str(key))
             deferreds.pop(key)
+        self._journal_done(key)
+        self._fire_flush_waiters(key)
+        self._update_lru(key)
+        self._maybe_evict()
 
     def set_dirty(self, key):
         """
@@ -744,6 +1754,10 @@ class MemoryStore(object):
         :type key: tuple
         """
         self._dirty.add(key)
+        mbox, uid = key
+        self._dirty_mbox[mbox].add(uid)
+        self._bump_generation(key)
+        self._update_lru(key)
 
     def unset_dirty(self, key):
         """
@@ -753,17 +1767,47 @@ class MemoryStore(object):
         :type key: tuple
         """
         self._dirty.discard(key)
-        deferreds = self._dirty_deferreds
-        d = deferreds.get(key, None)
-        if d:
-            # XXX use a namedtuple for passing the result
-            # when we check it in the other side.
+        mbox, uid = key
+        self._dirty_mbox[mbox].discard(uid)
+        # XXX use a namedtuple for passing the result
+        # when we check it in the other side.
+        for d in self._dirty_deferreds.pop(key, []):
             d.callback('%s, ok' % str(key))
-            deferreds.pop(key)
+        self._journal_done(key)
+        self._fire_flush_waiters(key)
+        self._update_lru(key)
+        self._maybe_evict()
 
     # Recent Flags
 
-    # TODO --- nice but unused
+    def _change_recent_flag(self, mbox, uid, value):
+        """
+        Change the `Recent` flag for a given mailbox and UID, recording the
+        change to be written. Must be called with the recent-flags lock held.
+
+        A change that undoes a pending one just cancels it.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        :param value: whether the flag is set
+        :type value: bool
+        :return: True if the flag changed.
+        :rtype: bool
+        """
+        rset = self._rflags_store[mbox]['set']
+        if (uid in rset) == value:
+            return False
+        if value:
+            rset.add(uid)
+        else:
+            rset.discard(uid)
+        changes = self._rflags_changes[mbox]
+        if changes.pop(uid, None) is None:
+            changes[uid] = value
+        return True
+
     def set_recent_flag(self, mbox, uid):
         """
         Set the `Recent` flag for a given mailbox and UID.
@@ -773,10 +1817,11 @@ class MemoryStore(object):
         :param uid: the message UID
         :type uid: int
         """
-        self._rflags_dirty.add(mbox)
-        self._rflags_store[mbox]['set'].add(uid)
+        with self._rflags_lock:
+            changed = self._change_recent_flag(mbox, uid, True)
+        if changed:
+            self._mark_pending()
 
-    # TODO --- nice but unused
     def unset_recent_flag(self, mbox, uid):
         """
         Unset the `Recent` flag for a given mailbox and UID.
@@ -786,7 +1831,22 @@ class MemoryStore(object):
         :param uid: the message UID
         :type uid: int
         """
-        self._rflags_store[mbox]['set'].discard(uid)
+        self.unset_recent_flags(mbox, (uid,))
+
+    def unset_recent_flags(self, mbox, uids):
+        """
+        Unset the `Recent` flag for a given mailbox and a sequence of UIDs.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uids: the message UIDs
+        :type uids: sequence
+        """
+        with self._rflags_lock:
+            changed = [self._change_recent_flag(mbox, uid, False)
+                       for uid in uids]
+        if any(changed):
+            self._mark_pending()
 
     def set_recent_flags(self, mbox, value):
         """
@@ -798,65 +1858,138 @@ class MemoryStore(object):
         :param value: a sequence of flags to set
         :type value: sequence
         """
-        self._rflags_dirty.add(mbox)
-        self._rflags_store[mbox]['set'] = set(value)
+        value = set(value)
+        with self._rflags_lock:
+            rset = self._rflags_store[mbox]['set']
+            changed = [self._change_recent_flag(mbox, uid, uid in value)
+                       for uid in rset.symmetric_difference(value)]
+        if any(changed):
+            self._mark_pending()
 
     def load_recent_flags(self, mbox, flags_doc):
         """
         Load the passed flags document in the recent flags store, for a given
         mailbox.
 
+        The changes done before loading it, if any, are applied over the
+        loaded set.
+
         :param mbox: the mailbox
         :type mbox: str or unicode
-        :param flags_doc: A dictionary containing the `doc_id` of the Soledad
-                          flags-document for this mailbox, and the `set`
-                          of uids marked with that flag.
-        """
-        self._rflags_store[mbox] = flags_doc
+        :param flags_doc: A dictionary containing the `doc_id` and `rev` of
+                          the Soledad flags-document for this mailbox, and
+                          the `set` of uids marked with that flag.
+        """
+        with self._rflags_lock:
+            rset = set(flags_doc.get('set', []))
+            pending = dict(self._rflags_inflight.get(mbox, {}))
+            pending.update(self._rflags_changes.get(mbox, {}))
+            for uid, value in pending.iteritems():
+                if value:
+                    rset.add(uid)
+                else:
+                    rset.discard(uid)
+            self._rflags_store[mbox] = {
+                'doc_id': flags_doc.get('doc_id', None),
+                'rev': flags_doc.get('rev', None),
+                'set': rset}
 
     def get_recent_flags(self, mbox):
         """
         Return the set of UIDs with the `Recent` flag for this mailbox.
 
+        The returned set must not be modified, use the setters instead.
+
         :param mbox: the mailbox
         :type mbox: str or unicode
+        :return: the set, or None if the recent-flags document has not been
+                 loaded yet.
         :rtype: set, or None
         """
         rflag_for_mbox = self._rflags_store.get(mbox, None)
-        if not rflag_for_mbox:
+        if not rflag_for_mbox or rflag_for_mbox['doc_id'] is None:
             return None
-        return self._rflags_store[mbox]['set']
+        return rflag_for_mbox['set']
 
-    def all_rdocs_iter(self):
+    def set_rflags_rev(self, mbox, doc_id, rev):
         """
-        Return an iterator through all in-memory recent flag dicts, wrapped
-        under a RecentFlagsDoc namedtuple.
-        Used for saving to disk.
+        Record the revision of the recent-flags document for a given mailbox,
+        after it has been written.
 
-        :return: a generator of RecentFlagDoc
-        :rtype: generator
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param doc_id: the document id
+        :type doc_id: unicode
+        :param rev: the document revision
+        :type rev: unicode
         """
-        # XXX use enums
-        DOC_ID = "doc_id"
-        SET = "set"
+        with self._rflags_lock:
+            rdict = self._rflags_store.get(mbox, None)
+            if rdict is not None and rdict['doc_id'] == doc_id:
+                rdict['rev'] = rev
 
-        rflags_store = self._rflags_store
+    def confirm_recent_flags(self, mbox):
+        """
+        Forget the recent-flags changes that were being written for a given
+        mailbox, once the write has succeeded.
 
-        def get_rdoc(mbox, rdict):
-            mbox_rflag_set = rdict[SET]
-            recent_set = copy(mbox_rflag_set)
-            # zero it!
-            mbox_rflag_set.difference_update(mbox_rflag_set)
-            return RecentFlagsDoc(
-                doc_id=rflags_store[mbox][DOC_ID],
-                content={
-                    fields.TYPE_KEY: fields.TYPE_RECENT_VAL,
-                    fields.MBOX_KEY: mbox,
-                    fields.RECENTFLAGS_KEY: list(recent_set)
-                })
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        """
+        with self._rflags_lock:
+            self._rflags_inflight.pop(mbox, None)
+
+    def restore_recent_flags(self, mbox):
+        """
+        Put back the recent-flags changes that were being written for a given
+        mailbox, after the write has failed, so that they are written again.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        """
+        with self._rflags_lock:
+            inflight = self._rflags_inflight.pop(mbox, None)
+            if not inflight:
+                return
+            changes = self._rflags_changes[mbox]
+            for uid, value in inflight.iteritems():
+                # a newer change of the same uid undoes this one.
+                if changes.pop(uid, None) is None:
+                    changes[uid] = value
+        self._mark_pending()
 
-        return (get_rdoc(mbox, rdict) for mbox, rdict in rflags_store.items()
-                if not empty(rdict[SET]))
+    def all_rdocs_iter(self):
+        """
+        Return an iterator through the recent flag dicts that have changed
+        since they were last written, wrapped under a RecentFlagsDoc
+        namedtuple. Used for saving to disk.
+
+        The changes are kept in-flight until the write is confirmed, and
+        no other write is done for that mailbox meanwhile.
+
+        :return: an iterator of RecentFlagDoc
+        :rtype: iterable
+        """
+        rdocs = []
+        with self._rflags_lock:
+            for mbox, changes in self._rflags_changes.items():
+                if not changes or mbox in self._rflags_inflight:
+                    continue
+                rdict = self._rflags_store[mbox]
+                if rdict['doc_id'] is None:
+                    # not loaded yet, we will write it afterwards.
+                    continue
+                self._rflags_inflight[mbox] = self._rflags_changes.pop(mbox)
+                rdocs.append(RecentFlagsDoc(
+                    doc_id=rdict['doc_id'],
+                    rev=rdict['rev'],
+                    content={
+                        fields.TYPE_KEY: fields.TYPE_RECENT_VAL,
+                        fields.MBOX_KEY: mbox,
+                        fields.RECENTFLAGS_KEY: sorted(rdict['set'])
+                    },
+                    memstore=self))
+        return iter(rdocs)
 
     # Methods that mirror the IMailbox interface
 
@@ -875,100 +2008,411 @@ class MemoryStore(object):
             self.remove_message(mbox, uid)
         return mem_deleted
 
-    def expunge(self, mbox, observer):
+    def expunge(self, mbox, observer, progress=None):
         """
         Remove all messages flagged \\Deleted, from the Memory Store
         and from the permanent store also.
 
-        It first queues up a last write, and wait for the deferreds to be done
-        before continuing.
+        It first flushes the pending changes to the mailbox, and waits for
+        them to be written before continuing. The write-back for the
+        mailbox is paused while the messages are being deleted.
 
         :param mbox: the mailbox
         :type mbox: str or unicode
         :param observer: a deferred that will be fired when expunge is done
         :type observer: Deferred
+        :param progress: a callable that will be called with the number of
+                         messages deleted from the permanent store so far,
+                         and the total.
+        :type progress: callable or None
         """
-        soledad_store = self._permanent_store
         try:
-            # 1. Stop the writing call
-            self._stop_write_loop()
-            # 2. Enqueue a last write.
-            self.write_messages(soledad_store)
-            # 3. Wait on the writebacks to finish
-
-            pending_deferreds = (self._new_deferreds.get(mbox, []) +
-                                 self._dirty_deferreds.get(mbox, []))
-            d1 = defer.gatherResults(pending_deferreds, consumeErrors=True)
-            d1.addCallback(
-                self._delete_from_soledad_and_memory, mbox, observer)
+            d = self.flush(mbox)
+            d.addCallback(
+                self._delete_from_soledad_and_memory, mbox, observer,
+                progress)
+            d.addErrback(observer.errback)
         except Exception as exc:
             logger.exception(exc)
 
-    def _delete_from_soledad_and_memory(self, result, mbox, observer):
+    def _delete_from_soledad_and_memory(self, result, mbox, observer,
+                                        progress=None):
         """
         Remove all messages marked as deleted from soledad and memory.
 
-        :param result: ignored. the result of the deferredList that triggers
+        The messages are deleted from soledad in a worker thread.
+
+        :param result: ignored. the result of the flush that triggers
                        this as a callback from `expunge`.
         :param mbox: the mailbox
         :type mbox: str or unicode
         :param observer: a deferred that will be fired when expunge is done
         :type observer: Deferred
+        :param progress: a callable to report the deletion progress to
+        :type progress: callable or None
+        :rtype: Deferred
         """
-        all_deleted = []
         soledad_store = self._permanent_store
+        self._pause_mbox(mbox)
 
-        try:
-            # 1. Delete all messages marked as deleted in soledad.
+        # 1. Delete all messages marked as deleted in soledad.
+        if soledad_store:
+            d = defer.maybeDeferred(
+                soledad_store.remove_all_deleted, mbox, progress=progress)
+        else:
+            d = defer.succeed([])
 
-            # XXX this could be deferred for faster operation.
-            if soledad_store:
-                sol_deleted = soledad_store.remove_all_deleted(mbox)
-            else:
-                sol_deleted = []
+        # 2. Delete all messages marked as deleted in memory.
+        d.addCallback(self._remove_deleted_from_memory, mbox)
 
-            try:
-                self._known_uids[mbox].difference_update(set(sol_deleted))
-            except Exception as exc:
-                logger.exception(exc)
+        def done(all_deleted):
+            self._resume_mbox(mbox)
+            logger.debug("deleted %r" % all_deleted)
+            observer.callback(all_deleted)
 
-            # 2. Delete all messages marked as deleted in memory.
-            mem_deleted = self.remove_all_deleted(mbox)
+        def error(failure):
+            self._resume_mbox(mbox)
+            logger.error("Error while expunging %s" % (mbox,))
+            observer.errback(failure)
 
-            all_deleted = set(mem_deleted).union(set(sol_deleted))
-            logger.debug("deleted %r" % all_deleted)
+        d.addCallbacks(done, error)
+        return d
+
+    def _remove_deleted_from_memory(self, sol_deleted, mbox):
+        """
+        Forget the messages deleted from soledad, and remove them from
+        memory together with the deleted ones that were never written.
+
+        The messages whose deletion from soledad failed are kept, so they
+        are deleted in the next expunge.
+
+        :param sol_deleted: the UIDs deleted from soledad
+        :type sol_deleted: list
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :return: all the deleted UIDs
+        :rtype: set
+        """
+        # remove_all_deleted returns None if its thread failed
+        sol_deleted = set(sol_deleted or [])
+        try:
+            self._known_uids[mbox].difference_update(sol_deleted)
+            self._evicted[mbox].difference_update(sol_deleted)
+            for uid in sol_deleted:
+                self._unindex_flags(mbox, uid)
+                self._fdoc_revs.pop((mbox, uid), None)
+                self._bump_generation((mbox, uid))
         except Exception as exc:
             logger.exception(exc)
-        finally:
-            self._start_write_loop()
-        observer.callback(all_deleted)
+
+        deleted = sol_deleted.union(
+            uid for uid in self.all_deleted_uid_iter(mbox)
+            if (mbox, uid) in self._new)
+        for uid in sorted(deleted):
+            if (mbox, uid) in self._msg_store:
+                self.remove_message(mbox, uid)
+        return deleted
+
+    def _pause_mbox(self, mbox):
+        """
+        Pause the write-back of the messages of a given mailbox.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        """
+        self._paused_mboxes.add(mbox)
+
+    def _resume_mbox(self, mbox):
+        """
+        Resume the write-back of the messages of a given mailbox, and
+        schedule the write of the changes done meanwhile.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        """
+        self._paused_mboxes.discard(mbox)
+        uids = self._new_mbox.get(mbox, set()) | \
+            self._dirty_mbox.get(mbox, set())
+        for uid in uids:
+            self._mark_pending((mbox, uid))
 
     # Dump-to-disk controls.
 
+    def flush(self, mbox=None):
+        """
+        Write to the permanent store every message that is new or dirty
+        at the time of the call.
+
+        Used by CHECK, EXPUNGE and the service shutdown, so that they can
+        rely on the changes being on disk, no matter how long the write
+        period is.
+
+        :param mbox: only wait for the messages of this mailbox, or None
+                     to wait for all of them.
+        :type mbox: str or unicode or None
+        :return: a deferred that will be fired when all those messages
+                 have been written.
+        :rtype: Deferred
+        """
+        if self._permanent_store is None:
+            return defer.succeed(None)
+
+        waiters = []
+        with self._flush_lock:
+            for key in self._new | self._dirty:
+                if mbox is not None and key[0] != mbox:
+                    continue
+                d = defer.Deferred()
+                self._flush_waiters[key].append(d)
+                waiters.append(d)
+        if not waiters:
+            return self._write_last_uids()
+
+        # the messages already queued will fire their waiters when written,
+        # the rest need a write right now.
+        self._write_now()
+        d = defer.gatherResults(waiters, consumeErrors=True)
+        d.addCallbacks(lambda _: None,
+                       lambda failure: failure.value.subFailure)
+        return d
+
+    def write_failed(self, key, failure):
+        """
+        Called by the permanent store when it gives up writing a message.
+
+        The message is marked as pending again, so that it is written in
+        the next write-back, and the flush deferreds waiting for it are
+        errbacked, so that a write that keeps failing is reported instead
+        of waited for forever.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        :param failure: the error of the last attempt
+        :type failure: Failure or Exception
+        """
+        if key in self._new or key in self._dirty:
+            self._mark_pending(key)
+        self._fire_flush_waiters(key, failure=failure)
+
+    def requeue_message(self, mbox, uid):
+        """
+        Called by the permanent store when it has written a message, but it
+        has changed again meanwhile and the newer content was not written.
+
+        The message is kept as dirty, and marked as pending, so that its
+        current content is written in the next write-back. If it was new,
+        it is not anymore, since it is in the permanent store now.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        """
+        key = mbox, uid
+        if key not in self._msg_store:
+            return
+        self.set_dirty(key)
+        if key in self._new:
+            self.unset_new(key)
+        self._mark_pending(key)
+
+    def _fire_flush_waiters(self, key, failure=None):
+        """
+        Fire the flush deferreds waiting for a given message, if it is
+        neither new nor dirty anymore, or errback them with a failure.
+
+        The deferreds are always fired in the reactor thread.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        :param failure: the failure to errback the deferreds with, or None
+                        to fire them if the message has been written.
+        :type failure: Failure or Exception or None
+        """
+        from twisted.internet import reactor
+        with self._flush_lock:
+            if failure is None and (key in self._new or key in self._dirty):
+                return
+            waiters = self._flush_waiters.pop(key, None)
+        if not waiters:
+            return
+
+        def fire():
+            for d in waiters:
+                if failure is None:
+                    d.callback(key)
+                else:
+                    d.errback(failure)
+
+        if isInIOThread():
+            fire()
+        else:
+            reactor.callFromThread(fire)
+
     @property
     def is_writing(self):
         """
         Property that returns whether the store is currently writing its
         internal state to a permanent storage.
 
-        Used to evaluate whether the CHECK command can inform that the field
-        is clear to proceed, or waiting for the write operations to complete
-        is needed instead.
+        To wait for the writes to be done, use `flush` instead.
 
         :rtype: bool
         """
-        # FIXME this should return a deferred !!!
-        # XXX ----- can fire when all new + dirty deferreds
-        # are done (gatherResults)
         return getattr(self, self.WRITING_FLAG)
 
     # Memory management.
 
     def get_size(self):
         """
-        Return the size of the internal storage.
+        Return the estimated size of the internal storage, in bytes.
         Use for calculating the limit beyond which we should flush the store.
 
+        This is a running counter, so it is cheap to read it as often
+        as needed.
+
         :rtype: int
         """
-        return size.get_size(self._msg_store)
+        return self._store_size
+
+    def get_mbox_size(self, mbox):
+        """
+        Return the estimated size of the messages for a given mailbox
+        that are kept in the internal storage, in bytes.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: int
+        """
+        return self._mbox_sizes.get(mbox, 0)
+
+    def get_part_sizes(self):
+        """
+        Return the estimated size of the internal storage, in bytes,
+        broken down by message part type (fdoc, hdoc, cdocs...)
+
+        :rtype: dict
+        """
+        return dict(self._part_sizes)
+
+    def _update_size(self, key, msg_dict):
+        """
+        Update the estimated size for a given message, and the running totals.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        :param msg_dict: the internal dict for the message
+        :type msg_dict: dict
+        """
+        part_sizes = dict((part, size.get_doc_size(doc))
+                          for part, doc in msg_dict.iteritems())
+        with self._lru_lock:
+            self._account_size(key, part_sizes)
+
+    def _account_size(self, key, part_sizes):
+        """
+        Replace the accounted sizes for a message, updating the running
+        totals with the difference. Passing an empty dict forgets the message.
+
+        Must be called holding the lru lock.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        :param part_sizes: the size of each part of the message
+        :type part_sizes: dict
+        """
+        mbox, uid = key
+        old_sizes = self._msg_sizes.pop(key, {})
+        if part_sizes:
+            self._msg_sizes[key] = part_sizes
+        for part, part_size in old_sizes.iteritems():
+            self._part_sizes[part] -= part_size
+            self._mbox_sizes[mbox] -= part_size
+            self._store_size -= part_size
+        for part, part_size in part_sizes.iteritems():
+            self._part_sizes[part] += part_size
+            self._mbox_sizes[mbox] += part_size
+            self._store_size += part_size
+        if not self._mbox_sizes[mbox]:
+            del self._mbox_sizes[mbox]
+
+    def _update_lru(self, key):
+        """
+        Add a message to the eviction candidates if it is clean (that is,
+        neither new nor dirty), or remove it from there otherwise.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        """
+        with self._lru_lock:
+            clean = (key in self._msg_store and
+                     key not in self._new and key not in self._dirty)
+            self._clean_lru.pop(key, None)
+            if clean:
+                self._clean_lru[key] = None
+
+    def _touch(self, key):
+        """
+        Mark a message as the most recently used, if it is a candidate
+        for eviction.
+
+        :param key: the key for the message, in the form mbox, uid
+        :type key: tuple
+        """
+        with self._lru_lock:
+            if key in self._clean_lru:
+                del self._clean_lru[key]
+                self._clean_lru[key] = None
+
+    def _maybe_evict(self, keep=None):
+        """
+        Evict the least recently used clean messages until the store
+        fits again in the memory budget.
+
+        Only messages that have already been written to the permanent store
+        are evicted, and they will be reloaded from there on the next access.
+
+        :param keep: the key of a message that should not be evicted, because
+                     we have just added it.
+        :type keep: tuple or None
+        """
+        if self._max_size is None or self._permanent_store is None:
+            return
+        with self._lru_lock:
+            evicted = 0
+            while self._store_size > self._max_size and self._clean_lru:
+                key, _ = self._clean_lru.popitem(last=False)
+                if key == keep:
+                    self._clean_lru[key] = None
+                    break
+                mbox, uid = key
+                self._drop_message(key)
+                # we still know about this message, it just lives
+                # in the permanent store now.
+                self._known_uids[mbox].add(uid)
+                self._evicted[mbox].add(uid)
+                evicted += 1
+        if evicted:
+            logger.debug("evicted %s messages from memstore" % (evicted,))
+
+    def _reload_evicted(self, mbox, uid):
+        """
+        Reload a message that was evicted from the permanent store.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :param uid: the message UID
+        :type uid: int
+        :return: the internal dict for the message, or None if it was not
+                 evicted or it could not be found.
+        :rtype: dict or None
+        """
+        evicted = self._evicted.get(mbox, None)
+        if not evicted or uid not in evicted:
+            return None
+        evicted.discard(uid)
+        message = self._permanent_store.get_message(mbox, uid)
+        if message is None:
+            return None
+        self._add_message(mbox, uid, message)
+        return self._msg_store.get((mbox, uid), None)
@@ -16,6 +16,7 @@
 """
 MessagePart implementation. Used from LeapMessage.
 """
+import copy
 import logging
 import StringIO
 import weakref
@@ -30,7 +31,8 @@ from leap.common.decorators import memoized_method
 from leap.common.mail import get_email_charset
 from leap.mail.imap import interfaces
 from leap.mail.imap.fields import fields
-from leap.mail.utils import empty, first, find_charset
+from leap.mail.imap.payloadcache import payload_cache
+from leap.mail.utils import empty, find_charset
 
 MessagePartType = Enum("hdoc", "fdoc", "cdoc", "cdocs", "docs_id")
 
@@ -69,11 +71,12 @@ MessagePartDoc = namedtuple(
 
 """
 A RecentFlagsDoc is used to send the recent-flags document payload to the
-SoledadWriter during dumps.
+SoledadWriter during dumps, along with the revision of the stored document
+if it is known, and the memstore to report back to.
 """
 RecentFlagsDoc = namedtuple(
     'RecentFlagsDoc',
-    ['content', 'doc_id'])
+    ['content', 'doc_id', 'rev', 'memstore'])
 
 
 class ReferenciableDict(dict):
@@ -87,6 +90,270 @@ class ReferenciableDict(dict):
     """
 
 
+# Mailbox names are repeated in every flags document, so we keep only
+# one copy of each.
+_mbox_names = {}
+
+
+class CompactFlagsDoc(object):
+    """
+    A compact, weak-referenciable representation of a flags document.
+
+    The flags documents are by far the most numerous documents in the
+    MemoryStore, but a dict with their ten string keys takes around 1KB
+    for about 40 bytes of real state. Here we keep that state in slots:
+    the uid, the content hash, the size, an interned mailbox name and a
+    bitmask for the boolean fields and the system flags. The rest of the
+    flags are kept in a tuple.
+
+    It offers the dict interface that the rest of the code expects from a
+    flags document. Keys or values that do not fit in the compact
+    representation are kept in an extra dict, so nothing gets lost.
+    """
+
+    __slots__ = ["_mbox", "_uid", "_chash", "_size", "_bits", "_keywords",
+                 "_extra", "__weakref__"]
+
+    # The keys we know how to store compactly, in the order they are
+    # returned. The bit for each key in the bitmask tells if it is present.
+    _KEYS = (fields.TYPE_KEY, fields.MBOX_KEY, fields.UID_KEY,
+             fields.CONTENT_HASH_KEY, fields.SIZE_KEY, fields.MULTIPART_KEY,
+             fields.SEEN_KEY, fields.DEL_KEY, fields.RECENT_KEY,
+             fields.FLAGS_KEY)
+    _PRESENT_BITS = dict((key, 1 << i) for i, key in enumerate(_KEYS))
+
+    _BOOL_BITS = {
+        fields.MULTIPART_KEY: 1 << 10,
+        fields.SEEN_KEY: 1 << 11,
+        fields.DEL_KEY: 1 << 12,
+        fields.RECENT_KEY: 1 << 13,
+    }
+
+    _SYSTEM_FLAGS = (fields.SEEN_FLAG, fields.ANSWERED_FLAG,
+                     fields.FLAGGED_FLAG, fields.DELETED_FLAG,
+                     fields.DRAFT_FLAG, fields.RECENT_FLAG)
+    _FLAG_BITS = dict((flag, 1 << (16 + i))
+                      for i, flag in enumerate(_SYSTEM_FLAGS))
+    _ALL_FLAG_BITS = sum(_FLAG_BITS.values())
+
+    def __init__(self, doc=None):
+        """
+        Initialize a CompactFlagsDoc.
+
+        :param doc: the flags document to initialize from, if any.
+        :type doc: dict
+        """
+        self._mbox = None
+        self._uid = None
+        self._chash = None
+        self._size = None
+        self._bits = 0
+        self._keywords = ()
+        self._extra = None
+        if doc is not None:
+            self.update(doc)
+
+    def _fits(self, key, value):
+        """
+        Return whether a value for a key fits in the compact representation.
+
+        :rtype: bool
+        """
+        if key == fields.TYPE_KEY:
+            return value == fields.TYPE_FLAGS_VAL
+        if key in (fields.MBOX_KEY, fields.CONTENT_HASH_KEY):
+            return isinstance(value, basestring)
+        if key in (fields.UID_KEY, fields.SIZE_KEY):
+            return isinstance(value, (int, long)) and \
+                not isinstance(value, bool)
+        if key in self._BOOL_BITS:
+            return isinstance(value, bool)
+        if key == fields.FLAGS_KEY:
+            return isinstance(value, (list, tuple)) and \
+                all(isinstance(flag, basestring) for flag in value)
+        return False
+
+    # dict interface
+
+    def __getitem__(self, key):
+        bit = self._PRESENT_BITS.get(key, None)
+        if bit is None or not self._bits & bit:
+            if self._extra is not None and key in self._extra:
+                return self._extra[key]
+            raise KeyError(key)
+
+        if key == fields.TYPE_KEY:
+            return fields.TYPE_FLAGS_VAL
+        if key == fields.MBOX_KEY:
+            return self._mbox
+        if key == fields.UID_KEY:
+            return self._uid
+        if key == fields.CONTENT_HASH_KEY:
+            return self._chash
+        if key == fields.SIZE_KEY:
+            return self._size
+        if key == fields.FLAGS_KEY:
+            return [flag for flag in self._SYSTEM_FLAGS
+                    if self._bits & self._FLAG_BITS[flag]] + \
+                list(self._keywords)
+        return bool(self._bits & self._BOOL_BITS[key])
+
+    def __setitem__(self, key, value):
+        if not self._fits(key, value):
+            if key in self._PRESENT_BITS:
+                self._bits &= ~self._PRESENT_BITS[key]
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            return
+
+        if self._extra is not None:
+            self._extra.pop(key, None)
+            if not self._extra:
+                self._extra = None
+        self._bits |= self._PRESENT_BITS[key]
+
+        if key == fields.MBOX_KEY:
+            self._mbox = _mbox_names.setdefault(value, value)
+        elif key == fields.UID_KEY:
+            self._uid = value
+        elif key == fields.CONTENT_HASH_KEY:
+            self._chash = value
+        elif key == fields.SIZE_KEY:
+            self._size = value
+        elif key == fields.FLAGS_KEY:
+            bits = self._bits & ~self._ALL_FLAG_BITS
+            keywords = []
+            for flag in value:
+                flag_bit = self._FLAG_BITS.get(flag, None)
+                if flag_bit is not None:
+                    bits |= flag_bit
+                elif flag not in keywords:
+                    keywords.append(flag)
+            self._bits = bits
+            self._keywords = tuple(keywords)
+        elif key in self._BOOL_BITS:
+            if value:
+                self._bits |= self._BOOL_BITS[key]
+            else:
+                self._bits &= ~self._BOOL_BITS[key]
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self._PRESENT_BITS:
+            self._bits &= ~self._PRESENT_BITS[key]
+        if self._extra is not None:
+            self._extra.pop(key, None)
+            if not self._extra:
+                self._extra = None
+
+    def __contains__(self, key):
+        bit = self._PRESENT_BITS.get(key, None)
+        if bit is not None and self._bits & bit:
+            return True
+        return self._extra is not None and key in self._extra
+
+    has_key = __contains__
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, CompactFlagsDoc)):
+            return dict(self.iteritems()) == dict(other.iteritems())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, dict(self.iteritems()))
+
+    def __sizeof__(self):
+        size = object.__sizeof__(self)
+        if self._chash is not None:
+            size += len(self._chash)
+        size += sum(len(flag) for flag in self._keywords)
+        if self._extra is not None:
+            size += self._extra.__sizeof__()
+        return size
+
+    def __copy__(self):
+        return self.__class__(self)
+
+    def __deepcopy__(self, memo):
+        return self.__class__(copy.deepcopy(dict(self.iteritems()), memo))
+
+    def __reduce__(self):
+        return self.__class__, (dict(self.iteritems()),)
+
+    def keys(self):
+        keys = [key for key in self._KEYS
+                if self._bits & self._PRESENT_BITS[key]]
+        if self._extra is not None:
+            keys.extend(self._extra.keys())
+        return keys
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def itervalues(self):
+        return (self[key] for key in self.keys())
+
+    def iteritems(self):
+        return ((key, self[key]) for key in self.keys())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, other=None, **kwargs):
+        if other is not None:
+            if hasattr(other, "iteritems"):
+                other = other.iteritems()
+            elif hasattr(other, "keys"):
+                other = ((key, other[key]) for key in other.keys())
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.iteritems():
+            self[key] = value
+
+    def copy(self):
+        return self.__copy__()
+
+
 class MessageWrapper(object):
     """
     A simple nested dictionary container around the different message subparts.
@@ -122,7 +389,7 @@ class MessageWrapper(object):
             self.from_dict(from_dict)
         else:
             if fdoc is not None:
-                self._dict[self.FDOC] = ReferenciableDict(fdoc)
+                self._dict[self.FDOC] = CompactFlagsDoc(fdoc)
             if hdoc is not None:
                 self._dict[self.HDOC] = ReferenciableDict(hdoc)
             if cdocs is not None:
@@ -315,8 +582,8 @@ class MessageWrapper(object):
             lambda part: msg_dict.get(part, None),
             [self.FDOC, self.HDOC, self.CDOCS])
 
-        for t, doc in ((self.FDOC, fdoc), (self.HDOC, hdoc),
-                       (self.CDOCS, cdocs)):
+        self._dict[self.FDOC] = CompactFlagsDoc(fdoc) if fdoc else None
+        for t, doc in ((self.HDOC, hdoc), (self.CDOCS, cdocs)):
             self._dict[t] = ReferenciableDict(doc) if doc else None
 
 
@@ -396,17 +663,16 @@ class MessagePart(object):
             if phash is None:
                 logger.warning("Could not find phash for this subpart!")
                 payload = ""
+                content_type = ""
             else:
-                payload = self._get_payload_from_document_memoized(phash)
-                if empty(payload):
-                    payload = self._get_payload_from_document(phash)
+                payload, content_type = self._get_payload_from_document(
+                    phash)
 
         else:
             logger.warning("Message with no part_map!")
             payload = ""
 
         if payload:
-            content_type = self._get_ctype_from_document(phash)
             charset = find_charset(content_type)
             logger.debug("Got charset from header: %s" % (charset,))
             if charset is None:
@@ -424,62 +690,21 @@ class MessagePart(object):
         fd.seek(0)
         return fd
 
-    # TODO should memory-bound this memoize!!!
-    @memoized_method
-    def _get_payload_from_document_memoized(self, phash):
-        """
-        Memoized method call around the regular method, to be able
-        to call the non-memoized method in case we got a None.
-
-        :param phash: the payload hash to retrieve by.
-        :type phash: str or unicode
-        :rtype: str or unicode or None
-        """
-        return self._get_payload_from_document(phash)
-
     def _get_payload_from_document(self, phash):
         """
-        Return the message payload from the content document.
-
-        :param phash: the payload hash to retrieve by.
-        :type phash: str or unicode
-        :rtype: str or unicode or None
-        """
-        cdocs = self._soledad.get_from_index(
-            fields.TYPE_P_HASH_IDX,
-            fields.TYPE_CONTENT_VAL, str(phash))
-
-        cdoc = first(cdocs)
-        if cdoc is None:
-            logger.warning(
-                "Could not find the content doc "
-                "for phash %s" % (phash,))
-            payload = ""
-        else:
-            payload = cdoc.content.get(fields.RAW_KEY, "")
-        return payload
-
-    # TODO should memory-bound this memoize!!!
-    @memoized_method
-    def _get_ctype_from_document(self, phash):
-        """
-        Reeturn the content-type from the content document.
+        Return the message payload and its content-type from the content
+        document, going through the shared payload cache.
 
         :param phash: the payload hash to retrieve by.
         :type phash: str or unicode
-        :rtype: str or unicode
-        """
-        cdocs = self._soledad.get_from_index(
-            fields.TYPE_P_HASH_IDX,
-            fields.TYPE_CONTENT_VAL, str(phash))
-
-        cdoc = first(cdocs)
-        if not cdoc:
-            logger.warning(
-                "Could not find the content doc "
-                "for phash %s" % (phash,))
-        ctype = cdoc.content.get('ctype', "")
-        return ctype
+        :return: a tuple with the payload and the content-type, that will be
+                 empty strings if the document could not be found.
+        :rtype: tuple
+        """
+        cached = payload_cache.get_from_soledad(self._soledad, phash)
+        if cached is None:
+            return "", ""
+        return cached.payload, cached.ctype
 
     @memoized_method
     def _get_charset(self, stuff):
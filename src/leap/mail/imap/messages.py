@@ -19,7 +19,9 @@ LeapMessage and MessageCollection.
 """
 import copy
 import logging
+import multiprocessing
 import re
+import signal
 import threading
 import StringIO
 
@@ -42,8 +44,10 @@ from leap.mail.decorators import deferred_to_thread
 from leap.mail.imap.index import IndexedDB
 from leap.mail.imap.fields import fields, WithMsgFields
 from leap.mail.imap.memorystore import MessageWrapper
-from leap.mail.imap.messageparts import MessagePart
+from leap.mail.imap.messageparts import MessagePart, MessagePartDoc
+from leap.mail.imap.messageparts import MessagePartType
 from leap.mail.imap.parser import MailParser, MBoxParser
+from leap.mail.imap.payloadcache import payload_cache
 
 logger = logging.getLogger(__name__)
 
@@ -61,6 +65,16 @@ logger = logging.getLogger(__name__)
 MSGID_PATTERN = r"""<([\w@.]+)>"""
 MSGID_RE = re.compile(MSGID_PATTERN)
 
+# The number of messages parsed together in a worker thread by add_msgs.
+ADD_MSGS_CHUNK_SIZE = 50
+
+# The maximum number of chunks that add_msgs parses at the same time.
+ADD_MSGS_WORKERS = 4
+
+# The number of worker processes that parse the incoming messages, started
+# with the service. 0 parses them in the worker threads instead.
+PARSE_PROCESSES = 2
+
 
 def try_unique_query(curried):
     """
@@ -126,8 +140,65 @@ class LeapMessage(fields, MailParser, MBoxParser):
         self._collection = collection
         self._container = container
 
+        # The documents are loaded at most once per instance. The flags
+        # document is loaded again only if the message changes in the
+        # memory store, the others never change for a given content hash.
         self.__chash = None
+        self.__fdoc = None
+        self.__hdoc = None
         self.__bdoc = None
+        self.__generation = self._get_generation()
+
+    def _get_memstore(self):
+        """
+        Return the memory store for this message, if any.
+
+        :rtype: MemoryStore or None
+        """
+        if self._collection is not None:
+            return self._collection.memstore
+        if self._container is not None:
+            return self._container.memstore
+
+    def _get_generation(self):
+        """
+        Return the generation of this message in the memory store, or None
+        if there is no memory store.
+
+        :rtype: int or None
+        """
+        memstore = self._get_memstore()
+        if memstore is None:
+            return None
+        return memstore.get_generation(self._mbox, self._uid)
+
+    def _check_generation(self):
+        """
+        Drop the cached flags document, and get the message again from the
+        memory store, if it has changed since we loaded it.
+        """
+        generation = self._get_generation()
+        if generation == self.__generation:
+            return
+        self.__generation = generation
+        self.__fdoc = None
+        memstore = self._get_memstore()
+        if memstore is not None:
+            # we only need the flags if we already hold the headers.
+            self._container = memstore.get_message(
+                self._mbox, self._uid, flags_only=self.__hdoc is not None)
+
+    def _detach(self, doc):
+        """
+        Return a copy of a document from the memory store whose content is
+        not a weak reference, so that it can be cached after the message
+        changes or is evicted there.
+
+        :param doc: the document
+        :type doc: MessagePartDoc
+        :rtype: MessagePartDoc
+        """
+        return doc._replace(content=dict(doc.content))
 
     # XXX make these properties public
 
@@ -137,15 +208,19 @@ class LeapMessage(fields, MailParser, MBoxParser):
         An accessor to the flags document.
         """
         if all(map(bool, (self._uid, self._mbox))):
+            self._check_generation()
+            if self.__fdoc is not None:
+                return self.__fdoc
             fdoc = None
             if self._container is not None:
                 fdoc = self._container.fdoc
-            if not fdoc:
+            if not fdoc or empty(fdoc.content):
                 fdoc = self._get_flags_doc()
             if fdoc:
                 fdoc_content = fdoc.content
                 self.__chash = fdoc_content.get(
                     fields.CONTENT_HASH_KEY, None)
+                self.__fdoc = fdoc
             return fdoc
 
     @property
@@ -153,22 +228,31 @@ class LeapMessage(fields, MailParser, MBoxParser):
         """
         An accessor to the headers document.
         """
+        if self.__hdoc is not None:
+            return self.__hdoc
+        hdoc = None
         if self._container is not None:
             hdoc = self._container.hdoc
-            if hdoc and not empty(hdoc.content):
-                return hdoc
-        # XXX cache this into the memory store !!!
-        return self._get_headers_doc()
+            if not hdoc or empty(hdoc.content):
+                hdoc = None
+            else:
+                hdoc = self._detach(hdoc)
+        if hdoc is None:
+            hdoc = self._get_headers_doc()
+        if hdoc:
+            self.__hdoc = hdoc
+        return hdoc
 
     @property
     def _chash(self):
         """
         An accessor to the content hash for this message.
         """
-        if not self._fdoc:
-            return None
-        if not self.__chash and self._fdoc:
-            self.__chash = self._fdoc.content.get(
+        if not self.__chash:
+            fdoc = self._fdoc
+            if not fdoc:
+                return None
+            self.__chash = fdoc.content.get(
                 fields.CONTENT_HASH_KEY, None)
         return self.__chash
 
@@ -177,9 +261,9 @@ class LeapMessage(fields, MailParser, MBoxParser):
         """
         An accessor to the body document.
         """
-        if not self._hdoc:
-            return None
         if not self.__bdoc:
+            if not self._hdoc:
+                return None
             self.__bdoc = self._get_body_doc()
         return self.__bdoc
 
@@ -302,8 +386,9 @@ class LeapMessage(fields, MailParser, MBoxParser):
 
         fd = StringIO.StringIO()
 
-        if self._bdoc is not None:
-            bdoc_content = self._bdoc.content
+        bdoc = self._bdoc
+        if bdoc is not None:
+            bdoc_content = bdoc.content
             if empty(bdoc_content):
                 logger.warning("No BDOC content found for message!!!")
                 return write_fd("")
@@ -352,9 +437,9 @@ class LeapMessage(fields, MailParser, MBoxParser):
         :rtype: int
         """
         size = None
-        if self._fdoc:
-            fdoc_content = self._fdoc.content
-            size = fdoc_content.get(self.SIZE_KEY, False)
+        fdoc = self._fdoc
+        if fdoc:
+            size = fdoc.content.get(self.SIZE_KEY, False)
         else:
             logger.warning("No FLAGS doc for %s:%s" % (self._mbox,
                                                        self._uid))
@@ -422,9 +507,9 @@ class LeapMessage(fields, MailParser, MBoxParser):
         """
         Return the headers dict for this message.
         """
-        if self._hdoc is not None:
-            hdoc_content = self._hdoc.content
-            headers = hdoc_content.get(self.HEADERS_KEY, {})
+        hdoc = self._hdoc
+        if hdoc is not None:
+            headers = hdoc.content.get(self.HEADERS_KEY, {})
             return headers
 
         else:
@@ -437,9 +522,9 @@ class LeapMessage(fields, MailParser, MBoxParser):
         """
         Return True if this message is multipart.
         """
-        if self._fdoc:
-            fdoc_content = self._fdoc.content
-            is_multipart = fdoc_content.get(self.MULTIPART_KEY, False)
+        fdoc = self._fdoc
+        if fdoc:
+            is_multipart = fdoc.content.get(self.MULTIPART_KEY, False)
             return is_multipart
         else:
             logger.warning(
@@ -477,11 +562,12 @@ class LeapMessage(fields, MailParser, MBoxParser):
         :raises: KeyError if key does not exist
         :rtype: dict
         """
-        if not self._hdoc:
+        hdoc = self._hdoc
+        if not hdoc:
             logger.warning("Tried to get part but no HDOC found!")
             return None
 
-        hdoc_content = self._hdoc.content
+        hdoc_content = hdoc.content
         pmap = hdoc_content.get(fields.PARTS_MAP_KEY, {})
 
         # remember, lads, soledad is using strings in its keys,
@@ -530,22 +616,24 @@ class LeapMessage(fields, MailParser, MBoxParser):
             logger.warning("No body phash for this document!")
             return None
 
-        # XXX get from memstore too...
-        # if memstore: memstore.get_phrash
-        # memstore should keep a dict with weakrefs to the
-        # phash doc...
-
         if self._container is not None:
             bdoc = self._container.memstore.get_cdoc_from_phash(body_phash)
             if not empty(bdoc) and not empty(bdoc.content):
-                return bdoc
+                return self._detach(bdoc)
 
-        # no memstore, or no body doc found there
+        # no memstore, or no body doc found there. We try the shared
+        # payload cache, that will query soledad if needed.
         if self._soledad:
-            body_docs = self._soledad.get_from_index(
-                fields.TYPE_P_HASH_IDX,
-                fields.TYPE_CONTENT_VAL, str(body_phash))
-            return first(body_docs)
+            cached = payload_cache.get_from_soledad(
+                self._soledad, body_phash)
+            if cached is None:
+                return None
+            return MessagePartDoc(
+                new=False, dirty=False, store="cache",
+                part=MessagePartType.cdoc,
+                content={self.RAW_KEY: cached.payload,
+                         'content-type': cached.ctype},
+                doc_id=None)
         else:
             logger.error("No phash in container, and no soledad found!")
 
@@ -560,7 +648,10 @@ class LeapMessage(fields, MailParser, MBoxParser):
         :return: The content value indexed by C{key} or None
         :rtype: str
         """
-        return self._fdoc.content.get(key, None)
+        fdoc = self._fdoc
+        if not fdoc:
+            return None
+        return fdoc.content.get(key, None)
 
     def does_exist(self):
         """
@@ -761,18 +852,16 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
     def _do_parse(self, raw):
         """
         Parse raw message and return it along with
-        relevant information about its outer level.
+        relevant information about its outer level and its parts.
 
         :param raw: the raw message
         :type raw: StringIO or basestring
-        :return: msg, chash, size, multi
+        :return: the parsed message, and its analysis (see
+                 `walk.analyze_msg`)
         :rtype: tuple
         """
         msg = self._get_parsed_msg(raw)
-        chash = self._get_hash(msg)
-        size = len(msg.as_string())
-        multi = msg.is_multipart()
-        return msg, chash, size, multi
+        return msg, walk.analyze_msg(msg)
 
     def _populate_flags(self, flags, uid, chash, size, multi):
         """
@@ -879,62 +968,50 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
             flags = tuple()
         leap_assert_type(flags, tuple)
 
-        d = defer.Deferred()
-        self._do_add_msg(raw, flags, subject, date, notify_on_disk, d)
-        return d
-
-    # We SHOULD defer this (or the heavy load here) to the thread pool,
-    # but it gives troubles with the QSocketNotifier used by Qt...
-    def _do_add_msg(self, raw, flags, subject, date, notify_on_disk, observer):
-        """
-        Helper that creates a new message document.
-        Here lives the magic of the leap mail. Well, in soledad, really.
-
-        See `add_msg` docstring for parameter info.
-
-        :param observer: a deferred that will be fired with the message
-                         uid when the adding succeed.
-        :type observer: deferred
-        """
         # TODO signal that we can delete the original message!-----
         # when all the processing is done.
 
         # TODO add the linked-from info !
         # TODO add reference to the original message
 
-        # parse
-        msg, chash, size, multi = self._do_parse(raw)
-
-        # check for uniqueness --------------------------------
-        # XXX profiler says that this test is costly.
-        # So we probably should just do an in-memory check and
-        # move the complete check to the soledad writer?
-        # Watch out! We're reserving a UID right after this!
-        existing_uid = self._fdoc_already_exists(chash)
-        if existing_uid:
-            logger.warning("We already have that message in this "
-                           "mailbox, unflagging as deleted")
-            uid = existing_uid
-            msg = self.get_msg_by_uid(uid)
-            msg.setFlags((fields.DELETED_FLAG,), -1)
-
-            # XXX if this is deferred to thread again we should not use
-            # the callback in the deferred thread, but return and
-            # call the callback from the caller fun...
-            observer.callback(uid)
-            return
+        # The parsing happens in the pool of worker processes, so this
+        # is the same as adding a batch of one message.
+        d = self.add_msgs([(raw, flags, subject, date)],
+                          notify_on_disk=notify_on_disk)
+        d.addCallback(self._get_added_uid)
+        return d
+
+    def _get_added_uid(self, uids):
+        """
+        Return the UID of a message added with `add_msg`.
+
+        :param uids: the result of `add_msgs`, with a single UID
+        :type uids: list
+        :rtype: int
+        """
+        uid = first(uids)
+        if uid is None:
+            raise imap4.MailboxException("Could not parse the message")
+        return uid
+
+    def _build_docs(self, msg, analysis, flags, subject, date, uid=None):
+        """
+        Build the flags, headers and content documents for a parsed
+        message.
 
-        uid = self.memstore.increment_last_soledad_uid(self.mbox)
-        logger.info("ADDING MSG WITH UID: %s" % uid)
+        See `_do_parse` and `add_msg` for parameter info.
 
-        fd = self._populate_flags(flags, uid, chash, size, multi)
+        :return: a tuple with the flags doc, the headers doc and the
+                 content docs.
+        :rtype: tuple
+        """
+        chash = analysis.chash
+        fd = self._populate_flags(
+            flags, uid, chash, analysis.size, analysis.multi)
         hd = self._populate_headr(msg, chash, subject, date)
 
-        parts = walk.get_parts(msg)
-        body_phash_fun = [walk.get_body_phash_simple,
-                          walk.get_body_phash_multi][int(multi)]
-        body_phash = body_phash_fun(walk.get_payloads(msg))
-        parts_map = walk.walk_msg_tree(parts, body_phash=body_phash)
+        parts_map = walk.walk_msg_tree(
+            analysis.parts, body_phash=analysis.body_phash)
 
         # add parts map to header doc
         # (body, multi, part_map)
@@ -945,13 +1022,170 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         hd = stringify_parts_map(hd)
 
         # The MessageContainer expects a dict, one-indexed
-        cdocs = dict(enumerate(walk.get_raw_docs(msg, parts), 1))
+        cdocs = dict(enumerate(analysis.raw_docs, 1))
+        return fd, hd, cdocs
+
+    def add_msgs(self, msgs, notify_on_disk=False):
+        """
+        Add several messages at once.
+
+        The messages are parsed in chunks in the pool of worker processes,
+        if the service started it (see `start_parse_pool`), or in worker
+        threads otherwise. A range of UIDs is reserved for all of them,
+        and they are handed to the memory store in a single batch. Nothing
+        of the parsing and hashing happens in the reactor thread.
+
+        :param msgs: the raw messages, or tuples with the raw message, the
+                     flags, the subject and the date, as in `add_msg`.
+        :type msgs: iterable
+        :param notify_on_disk: whether the returned deferred should wait
+                               until the messages are written to disk to
+                               be fired.
+        :type notify_on_disk: bool
+        :return: a deferred that will be fired with the list of UIDs, in the
+                 same order as the messages. A message that is already in
+                 this mailbox gets its existing UID, and one that could not
+                 be parsed gets None.
+        :rtype: Deferred
+        """
+        leap_assert(self.memstore is not None,
+                    "Need a memory store to add messages in bulk")
+        msgs = [self._get_add_args(msg) for msg in msgs]
+        if not msgs:
+            return defer.succeed([])
+        chunks = [msgs[i:i + ADD_MSGS_CHUNK_SIZE]
+                  for i in xrange(0, len(msgs), ADD_MSGS_CHUNK_SIZE)]
+
+        semaphore = defer.DeferredSemaphore(ADD_MSGS_WORKERS)
+        d = defer.gatherResults(
+            [semaphore.run(self._parse_msgs, chunk) for chunk in chunks])
+        d.addCallback(self._create_msgs, chunks, notify_on_disk)
+        return d
 
-        self.set_recent_flag(uid)
-        msg_container = MessageWrapper(fd, hd, cdocs)
-        self.memstore.create_message(self.mbox, uid, msg_container,
-                                     observer=observer,
-                                     notify_on_disk=notify_on_disk)
+    def _get_add_args(self, msg):
+        """
+        Return the raw message, flags, subject and date for one of the
+        items passed to `add_msgs`.
+
+        :rtype: tuple
+        """
+        if isinstance(msg, basestring) or hasattr(msg, "getvalue"):
+            msg = (msg,)
+        raw, flags, subject, date = (tuple(msg) + (None,) * 4)[:4]
+        # the raw message has to be pickled to reach the worker processes.
+        if hasattr(raw, "getvalue"):
+            raw = raw.getvalue()
+        return raw, tuple(flags or ()), subject, date
+
+    @deferred_to_thread
+    def _parse_msgs(self, msgs):
+        """
+        Parse a chunk of messages and build their documents, without UIDs,
+        and check which ones are already in this mailbox.
+
+        :param msgs: tuples with the raw message, flags, subject and date
+        :type msgs: list
+        :return: for every message, a tuple with the content hash, the UID
+                 if it already exists in this mailbox, and the documents.
+                 None for the messages that could not be parsed.
+        :rtype: list
+        """
+        args = [(self.mbox,) + tuple(msg) for msg in msgs]
+        built = None
+        pool = get_parse_pool()
+        if pool is not None:
+            try:
+                built = pool.map(build_msg_docs, args)
+            except Exception as exc:
+                logger.exception(exc)
+        if built is None:
+            built = map(build_msg_docs, args)
+
+        results = []
+        for item in built:
+            if item is None:
+                results.append(None)
+                continue
+            chash, docs = item[0], item[1:]
+            # XXX profiler says that this test is costly.
+            # So we probably should just do an in-memory check and
+            # move the complete check to the soledad writer?
+            try:
+                existing_uid = self._fdoc_already_exists(chash)
+            except Exception as exc:
+                logger.exception(exc)
+                results.append(None)
+                continue
+            if existing_uid:
+                results.append((chash, existing_uid, None))
+            else:
+                results.append((chash, None, docs))
+        return results
+
+    def _create_msgs(self, results, chunks, notify_on_disk):
+        """
+        Reserve the UIDs for the parsed messages, and create them in the
+        memory store.
+
+        :param results: the results of `_parse_msgs` for every chunk
+        :type results: list
+        :param chunks: the chunks passed to `_parse_msgs`
+        :type chunks: list
+        :param notify_on_disk: see `add_msgs`
+        :type notify_on_disk: bool
+        :rtype: Deferred
+        """
+        parsed = []
+        for chunk, result in zip(chunks, results):
+            # the worker returns None if the whole chunk failed.
+            parsed.extend(result or [None] * len(chunk))
+
+        # the duplicates in the batch are added only once.
+        new_chashes = []
+        for item in parsed:
+            if item is not None and item[1] is None and \
+                    item[0] not in new_chashes:
+                new_chashes.append(item[0])
+        new_uids = {}
+        if new_chashes:
+            first_uid = self.memstore.reserve_uids(
+                self.mbox, len(new_chashes))
+            new_uids = dict((chash, first_uid + i)
+                            for i, chash in enumerate(new_chashes))
+            logger.info("ADDING %s MSGS WITH UIDS: %s-%s" % (
+                len(new_chashes), first_uid,
+                first_uid + len(new_chashes) - 1))
+
+        uids = []
+        messages = []
+        added = set([])
+        for item in parsed:
+            if item is None:
+                uids.append(None)
+                continue
+            chash, existing_uid, docs = item
+            if existing_uid:
+                logger.warning("We already have that message in this "
+                               "mailbox, unflagging as deleted")
+                msg = self.get_msg_by_uid(existing_uid)
+                if msg is not None:
+                    msg.setFlags((fields.DELETED_FLAG,), -1)
+                uids.append(existing_uid)
+                continue
+            uid = new_uids[chash]
+            uids.append(uid)
+            if chash in added:
+                continue
+            added.add(chash)
+            fd, hd, cdocs = docs
+            fd[self.UID_KEY] = uid
+            messages.append((uid, MessageWrapper(fd, hd, cdocs)))
+
+        self.set_recent_flags([new_uid for new_uid, _ in messages])
+        d = self.memstore.create_messages(
+            self.mbox, messages, notify_on_disk=notify_on_disk)
+        d.addCallback(lambda _: uids)
+        return d
 
     #
     # getters: specific queries
@@ -970,7 +1204,7 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         if self.memstore is not None:
             with self._rdoc_lock:
                 rflags = self.memstore.get_recent_flags(self.mbox)
-                if not rflags:
+                if rflags is None:
                     # not loaded in the memory store yet.
                     # let's fetch them from soledad...
                     rdoc = self._get_recent_doc()
@@ -979,7 +1213,9 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
                     # ...and cache them now.
                     self.memstore.load_recent_flags(
                         self.mbox,
-                        {'doc_id': rdoc.doc_id, 'set': rflags})
+                        {'doc_id': rdoc.doc_id, 'rev': rdoc.rev,
+                         'set': rflags})
+                    rflags = self.memstore.get_recent_flags(self.mbox)
             return rflags
 
         #else:
@@ -1036,8 +1272,10 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         :type uid: sequence
         """
         with self._rdoc_property_lock:
-            self.recent_flags.difference_update(
-                set(uids))
+            if self.memstore is not None:
+                # make sure they are loaded before changing them.
+                self._get_recent_flags()
+                self.memstore.unset_recent_flags(self.mbox, uids)
 
     # Individual flags operations
 
@@ -1049,8 +1287,23 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         :type uid: int
         """
         with self._rdoc_property_lock:
-            self.recent_flags.difference_update(
-                set([uid]))
+            if self.memstore is not None:
+                self._get_recent_flags()
+                self.memstore.unset_recent_flag(self.mbox, uid)
+
+    @deferred_to_thread
+    def set_recent_flags(self, uids):
+        """
+        Set Recent flag for a sequence of uids.
+
+        :param uids: the uids to set
+        :type uids: sequence
+        """
+        with self._rdoc_property_lock:
+            if self.memstore is not None:
+                self._get_recent_flags()
+                for uid in uids:
+                    self.memstore.set_recent_flag(self.mbox, uid)
 
     @deferred_to_thread
     def set_recent_flag(self, uid):
@@ -1061,8 +1314,9 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         :type uid: int
         """
         with self._rdoc_property_lock:
-            self.recent_flags = self.recent_flags.union(
-                set([uid]))
+            if self.memstore is not None:
+                self._get_recent_flags()
+                self.memstore.set_recent_flag(self.mbox, uid)
 
     # individual doc getters, message layer.
 
@@ -1253,9 +1507,10 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         """
         Return a dict with all flags documents for this mailbox.
         """
-        # XXX get all from memstore and cache it there
-        # FIXME should get all uids, get them fro memstore,
-        # and get only the missing ones from disk.
+        if self._fdocs_in_memory():
+            return dict(((
+                fdoc[self.UID_KEY], fdoc[self.FLAGS_KEY]) for fdoc in
+                self.memstore.all_fdoc_iter(self.mbox)))
 
         all_flags = dict(((
             doc.content[self.UID_KEY],
@@ -1277,6 +1532,11 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         Return a dict with the content-hash for all flag documents
         for this mailbox.
         """
+        if self._fdocs_in_memory():
+            return dict(((
+                fdoc[self.UID_KEY], fdoc[self.CONTENT_HASH_KEY]) for fdoc in
+                self.memstore.all_fdoc_iter(self.mbox)))
+
         all_flags_chash = dict(((
             doc.content[self.UID_KEY],
             doc.content[self.CONTENT_HASH_KEY]) for doc in
@@ -1302,14 +1562,35 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
 
         :rtype: int
         """
-        # XXX We should cache this in memstore too until next write...
+        if self._flags_index_loaded():
+            return self.memstore.count_exists(self.mbox)
         count = self._soledad.get_count_from_index(
             fields.TYPE_MBOX_IDX,
             fields.TYPE_FLAGS_VAL, self.mbox)
         if self.memstore is not None:
-            count += self.memstore.count_new()
+            count += self.memstore.count_new_mbox(self.mbox)
         return count
 
+    def _fdocs_in_memory(self):
+        """
+        Return whether the memory store holds the flags documents for all
+        the messages in this mailbox.
+
+        :rtype: bool
+        """
+        return (self.memstore is not None and
+                self.memstore.has_all_fdocs(self.mbox))
+
+    def _flags_index_loaded(self):
+        """
+        Return whether the memory store has a complete flags index for
+        this mailbox, so we can answer flag queries without soledad.
+
+        :rtype: bool
+        """
+        return (self.memstore is not None and
+                self.memstore.is_flags_index_loaded(self.mbox))
+
     # unseen messages
 
     def unseen_iter(self):
@@ -1320,6 +1601,8 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         :return: iterator through unseen message doc UIDs
         :rtype: iterable
         """
+        if self._flags_index_loaded():
+            return iter(sorted(self.memstore.get_unseen_uids(self.mbox)))
         return (doc.content[self.UID_KEY] for doc in
                 self._soledad.get_from_index(
                     fields.TYPE_MBOX_SEEN_IDX,
@@ -1332,6 +1615,8 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
         :returns: count
         :rtype: int
         """
+        if self._flags_index_loaded():
+            return self.memstore.count_unseen(self.mbox)
         count = self._soledad.get_count_from_index(
             fields.TYPE_MBOX_SEEN_IDX,
             fields.TYPE_FLAGS_VAL, self.mbox, '0')
@@ -1389,3 +1674,149 @@ class MessageCollection(WithMsgFields, IndexedDB, MailParser, MBoxParser):
 
     # XXX should implement __eq__ also !!!
     # use chash...
+
+
+class MessageDocsBuilder(MessageCollection):
+    """
+    A MessageCollection that only builds the documents for new messages.
+
+    It is not backed by soledad nor by a memory store, so it can be used in
+    the worker processes of the parse pool.
+    """
+
+    def __init__(self, mbox):
+        """
+        Initialize a MessageDocsBuilder.
+
+        :param mbox: the name of the mailbox the messages are added to
+        :type mbox: str
+        """
+        MailParser.__init__(self)
+        self.mbox = self._parse_mailbox_name(mbox)
+        self._soledad = None
+        self.memstore = None
+
+    def build(self, raw, flags, subject, date):
+        """
+        Parse a raw message and build its documents, without UID.
+
+        See `MessageCollection.add_msg` for parameter info.
+
+        :return: a tuple with the content hash, the flags doc, the headers
+                 doc and the content docs.
+        :rtype: tuple
+        """
+        msg, analysis = self._do_parse(raw)
+        return (analysis.chash,) + self._build_docs(
+            msg, analysis, flags, subject, date)
+
+
+# The builders of this process, by mailbox.
+_builders = {}
+
+
+def build_msg_docs(args):
+    """
+    Parse a raw message and build its documents, without UID.
+
+    This is what runs in the worker processes of the parse pool, so it gets
+    and returns only plain, picklable, objects.
+
+    :param args: a tuple with the mailbox name, the raw message, the flags,
+                 the subject and the date.
+    :type args: tuple
+    :return: a tuple with the content hash, the flags doc, the headers doc
+             and the content docs, or None if the message could not be
+             parsed.
+    :rtype: tuple or None
+    """
+    mbox, raw, flags, subject, date = args
+    try:
+        builder = _builders.get(mbox, None)
+        if builder is None:
+            builder = _builders[mbox] = MessageDocsBuilder(mbox)
+        return builder.build(raw, flags, subject, date)
+    except Exception as exc:
+        logger.exception(exc)
+        return None
+
+
+def _init_parse_worker():
+    """
+    Initialize a worker process of the parse pool.
+
+    The workers inherit the signal handlers of the reactor, which would
+    never run in them, so they could not be terminated. They also leave the
+    interrupts to the parent process.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def new_parse_pool(processes=PARSE_PROCESSES):
+    """
+    Start a new pool of worker processes for `build_msg_docs`.
+
+    :param processes: the number of processes
+    :type processes: int
+    :rtype: multiprocessing.Pool
+    """
+    return multiprocessing.Pool(processes, initializer=_init_parse_worker)
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def start_parse_pool(processes=PARSE_PROCESSES):
+    """
+    Start the pool of worker processes that parse the incoming messages.
+
+    This has to be called from the reactor thread when the service starts,
+    before it runs any other thread, since forking a process with threads
+    running is not safe. The pool is terminated when the reactor shuts
+    down.
+
+    :param processes: the number of processes, 0 to parse the messages in
+                      threads instead.
+    :type processes: int
+    :return: the pool, or None if it was not started.
+    :rtype: multiprocessing.Pool or None
+    """
+    from twisted.internet import reactor
+    global _parse_pool
+    if not processes:
+        return None
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            try:
+                _parse_pool = new_parse_pool(processes)
+            except Exception as exc:
+                logger.warning("Could not start the parse pool, parsing "
+                               "in threads instead: %r" % (exc,))
+                return None
+            reactor.addSystemEventTrigger(
+                "before", "shutdown", close_parse_pool)
+        return _parse_pool
+
+
+def get_parse_pool():
+    """
+    Return the pool of worker processes that parse the incoming messages.
+
+    :return: the pool, or None if it was not started and the messages
+             have to be parsed in this process.
+    :rtype: multiprocessing.Pool or None
+    """
+    return _parse_pool
+
+
+def close_parse_pool():
+    """
+    Terminate the pool of worker processes, if it was started.
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.terminate()
+            _parse_pool = None
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+# payloadcache.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A bounded cache for the payloads of the content documents.
+
+Bodies and attachments are stored only once, indexed by their payload hash,
+so a single process-wide cache serves every message that refers to them.
+"""
+import logging
+import threading
+
+from collections import namedtuple, OrderedDict
+
+from leap.mail.imap.fields import fields
+from leap.mail.utils import first
+
+logger = logging.getLogger(__name__)
+
+
+# The default size of the payload cache, in bytes.
+PAYLOAD_CACHE_SIZE = 32 * 1024 * 1024
+
+"""
+A CachedPayload keeps the raw payload of a content document and
+its content-type.
+"""
+CachedPayload = namedtuple('CachedPayload', ['payload', 'ctype'])
+
+
+def get_ctype(content):
+    """
+    Return the content-type of a content document.
+
+    We store the whole content-type header, but older documents might only
+    have the short ctype field.
+
+    :param content: the content of the document
+    :type content: dict
+    :rtype: str or unicode
+    """
+    return content.get("content-type", None) or \
+        content.get(fields.CTYPE_KEY, "")
+
+
+class PayloadCache(object):
+    """
+    A least-recently-used cache of payloads, keyed by payload hash and
+    bounded by the total size of the payloads it holds.
+    """
+
+    def __init__(self, max_size=PAYLOAD_CACHE_SIZE):
+        """
+        Initialize a PayloadCache.
+
+        :param max_size: the maximum size of the cached payloads, in bytes.
+        :type max_size: int
+        """
+        self._max_size = max_size
+        self._size = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_size(self, entry):
+        """
+        Return the size accounted for a cache entry.
+
+        :rtype: int
+        """
+        return len(entry.payload) + len(entry.ctype)
+
+    def get(self, phash):
+        """
+        Return the cached payload for a given payload hash.
+
+        :param phash: the payload hash
+        :type phash: str or unicode
+        :rtype: CachedPayload or None
+        """
+        with self._lock:
+            entry = self._cache.pop(phash, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._cache[phash] = entry
+            self.hits += 1
+            return entry
+
+    def put(self, phash, payload, ctype=""):
+        """
+        Add a payload to the cache, evicting the least recently used ones
+        if needed. Payloads bigger than the whole cache are not kept.
+
+        :param phash: the payload hash
+        :type phash: str or unicode
+        :param payload: the raw payload
+        :type payload: str or unicode
+        :param ctype: the content-type of the payload
+        :type ctype: str or unicode
+        """
+        entry = CachedPayload(payload or "", ctype or "")
+        size = self._entry_size(entry)
+        if size > self._max_size:
+            return
+        with self._lock:
+            old = self._cache.pop(phash, None)
+            if old is not None:
+                self._size -= self._entry_size(old)
+            self._cache[phash] = entry
+            self._size += size
+            while self._size > self._max_size:
+                _, evicted = self._cache.popitem(last=False)
+                self._size -= self._entry_size(evicted)
+
+    def get_from_soledad(self, soledad, phash):
+        """
+        Return the payload for a given payload hash, from the cache or,
+        if it is not there, from the content document in soledad.
+
+        :param soledad: a Soledad instance
+        :type soledad: Soledad
+        :param phash: the payload hash
+        :type phash: str or unicode
+        :rtype: CachedPayload or None
+        """
+        entry = self.get(phash)
+        if entry is not None:
+            return entry
+
+        cdoc = first(soledad.get_from_index(
+            fields.TYPE_P_HASH_IDX,
+            fields.TYPE_CONTENT_VAL, str(phash)))
+        if cdoc is None:
+            logger.warning(
+                "Could not find the content doc "
+                "for phash %s" % (phash,))
+            return None
+        content = cdoc.content
+        payload = content.get(fields.RAW_KEY, "")
+        ctype = get_ctype(content)
+        self.put(phash, payload, ctype)
+        return CachedPayload(payload, ctype)
+
+    def stats(self):
+        """
+        Return the usage statistics for this cache.
+
+        :rtype: dict
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "items": len(self._cache), "size": self._size,
+                    "max_size": self._max_size}
+
+    def clear(self):
+        """
+        Remove all the payloads from the cache.
+        """
+        with self._lock:
+            self._cache.clear()
+            self._size = 0
+
+
+# The cache shared by all the messages in this process.
+payload_cache = PayloadCache()
@@ -212,6 +212,8 @@ class LeapIMAPServer(imap4.IMAP4Server):
         a deferred, the client will only be informed of success (or failure)
         when the deferred's callback (or errback) is invoked.
         """
-        # TODO return the output of _memstore.is_writing
-        # XXX and that should return a deferred!
-        return None
+        # CHECK is only valid in the selected state, we flush the
+        # pending changes to the selected mailbox.
+        if self.mbox is None:
+            return None
+        return self.mbox.flush()
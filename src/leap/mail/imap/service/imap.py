@@ -30,8 +30,11 @@ from leap.common import events as leap_events
 from leap.common.check import leap_assert, leap_assert_type, leap_check
 from leap.keymanager import KeyManager
 from leap.mail.imap.account import SoledadBackedAccount
+from leap.mail.imap.collector import OrphanCollector, COLLECT_PERIOD
 from leap.mail.imap.fetch import LeapIncomingMail
+from leap.mail.imap.journal import MessageJournal
 from leap.mail.imap.memorystore import MemoryStore
+from leap.mail.imap.messages import start_parse_pool, PARSE_PROCESSES
 from leap.mail.imap.server import LeapIMAPServer
 from leap.mail.imap.soledadstore import SoledadStore
 from leap.soledad.client import Soledad
@@ -86,7 +89,8 @@ class LeapIMAPFactory(ServerFactory):
     capabilities.
     """
 
-    def __init__(self, uuid, userid, soledad):
+    def __init__(self, uuid, userid, soledad, journal_path=None,
+                 collect_dry_run=True):
         """
         Initializes the server factory.
 
@@ -98,12 +102,31 @@ class LeapIMAPFactory(ServerFactory):
 
         :param soledad: soledad instance
         :type soledad: Soledad
+
+        :param journal_path: path to the journal of pending writes, or None
+                             to run without journal.
+        :type journal_path: str or None
+
+        :param collect_dry_run: whether the orphan collector only reports
+                                the orphaned documents, without deleting
+                                them.
+        :type collect_dry_run: bool
         """
         self._uuid = uuid
         self._userid = userid
         self._soledad = soledad
+
+        journal = None
+        if journal_path is not None:
+            journal = MessageJournal(journal_path)
+        soledad_store = SoledadStore(soledad)
+        soledad_store.load_known_hashes()
         self._memstore = MemoryStore(
-            permanent_store=SoledadStore(soledad))
+            permanent_store=soledad_store,
+            journal=journal)
+        self.collector = OrphanCollector(
+            soledad, memstore=self._memstore, soledad_store=soledad_store,
+            dry_run=collect_dry_run)
 
         theAccount = SoledadBackedAccount(
             uuid, soledad=soledad,
@@ -112,6 +135,15 @@ class LeapIMAPFactory(ServerFactory):
 
         # XXX how to pass the store along?
 
+    def flush(self):
+        """
+        Write all the pending changes in the memory store to disk.
+
+        :return: a deferred that will be fired when the changes are written.
+        :rtype: Deferred
+        """
+        return self._memstore.flush()
+
     def buildProtocol(self, addr):
         "Return a protocol suitable for the job."
         imapProtocol = LeapIMAPServer(
@@ -144,9 +176,20 @@ def run_service(*args, **kwargs):
     userid = kwargs.get('userid', None)
     leap_check(userid is not None, "need an user id")
     offline = kwargs.get('offline', False)
+    journal_path = kwargs.get('journal_path', None)
+    collect_period = kwargs.get('collect_period', COLLECT_PERIOD)
+    # the other devices of the account may refer to documents that look
+    # like orphans here, see leap.mail.imap.collector.
+    collect_dry_run = kwargs.get('collect_dry_run', True)
+    parse_processes = kwargs.get('parse_processes', PARSE_PROCESSES)
+
+    # fork the parse workers before the service starts its own threads.
+    start_parse_pool(parse_processes)
 
     uuid = soledad._get_uuid()
-    factory = LeapIMAPFactory(uuid, userid, soledad)
+    factory = LeapIMAPFactory(uuid, userid, soledad,
+                              journal_path=journal_path,
+                              collect_dry_run=collect_dry_run)
 
     try:
         tport = reactor.listenTCP(port, factory,
@@ -178,6 +221,13 @@ def run_service(*args, **kwargs):
                 "boss", "leap")
             reactor.listenTCP(manhole.MANHOLE_PORT, manhole_factory,
                               interface="127.0.0.1")
+        # do not lose the pending writes when the reactor stops.
+        reactor.addSystemEventTrigger("before", "shutdown", factory.flush)
+
+        # look for the header and content docs of the expunged messages.
+        if collect_period:
+            factory.collector.start(collect_period)
+
         logger.debug("IMAP4 Server is RUNNING in port  %s" % (port,))
         leap_events.signal(IMAP_SERVICE_STARTED, str(port))
         return fetcher, tport, factory
@@ -20,6 +20,7 @@ A MessageStore that writes to Soledad.
 import logging
 import threading
 
+from collections import namedtuple, OrderedDict
 from itertools import chain
 
 from u1db import errors as u1db_errors
@@ -28,6 +29,7 @@ from twisted.python import log
 from zope.interface import implements
 
 from leap.common.check import leap_assert_type
+from leap.soledad.common.document import SoledadDocument
 from leap.mail.decorators import deferred_to_thread
 from leap.mail.imap.messageparts import MessagePartType
 from leap.mail.imap.messageparts import MessageWrapper
@@ -35,16 +37,45 @@ from leap.mail.imap.messageparts import RecentFlagsDoc
 from leap.mail.imap.fields import fields
 from leap.mail.imap.interfaces import IMessageStore
 from leap.mail.messageflow import IMessageConsumer
-from leap.mail.utils import first
+from leap.mail.utils import first, empty
 
 logger = logging.getLogger(__name__)
 
 
+# The maximum number of items written to Soledad in a single batch.
+WRITE_BATCH_SIZE = 100
+
+# The maximum time an item waits for its batch to be filled, in seconds.
+WRITE_BATCH_LATENCY = 0.1
+
+
+# The number of deleted documents between two expunge progress reports.
+EXPUNGE_PROGRESS_STEP = 500
+
+# The delay before the first retry of a failed write, in seconds. It is
+# doubled after every failed retry, up to the maximum.
+WRITE_RETRY_DELAY = 1
+WRITE_RETRY_MAX_DELAY = 60
+
+# The number of times a failed write is retried before giving up.
+WRITE_MAX_RETRIES = 8
+
+"""
+A RetryEntry keeps the parts of a document wrapper whose write failed.
+
+:param wrapper: the MessageWrapper or RecentFlagsDoc
+:param deferred: the deferred to be fired when the write is done
+:param items: a list of tuples with the part payload and its call, or
+              None if the whole wrapper has to be written again
+:param attempts: the number of retries done so far
+"""
+RetryEntry = namedtuple('RetryEntry',
+                        ['wrapper', 'deferred', 'items', 'attempts'])
+
+
 # TODO
 # [ ] Delete original message from the incoming queue after all successful
 #     writes.
-# [ ] Implement a retry queue.
-# [ ] Consider journaling of operations.
 
 
 class ContentDedup(object):
@@ -68,6 +99,96 @@ class ContentDedup(object):
     """
     # TODO refactor using unique_query
 
+    def __init__(self):
+        """
+        Initialize the sets of known hashes.
+
+        Until `load_known_hashes` has finished, a hash that is not in the
+        sets is looked up in the database. After that, the sets are trusted
+        also for the hashes that are not there.
+
+        Documents that arrive with a sync are not added to the sets, so
+        we can end up storing a copy of them. That was already possible
+        with two devices writing at the same time, and the index queries
+        do cope with more than one copy.
+        """
+        self._known_chashes = set([])
+        self._known_phashes = set([])
+        self._known_hashes_loaded = False
+        self._known_hashes_lock = threading.Lock()
+
+    @deferred_to_thread
+    def load_known_hashes(self):
+        """
+        Load the content hashes of all the header documents, and the
+        payload hashes of all the content documents, from the database.
+        """
+        chashes = set(
+            key[1] for key in self._soledad.get_index_keys(
+                fields.TYPE_C_HASH_IDX)
+            if key[0] == fields.TYPE_HEADERS_VAL)
+        phashes = set(
+            key[1] for key in self._soledad.get_index_keys(
+                fields.TYPE_P_HASH_IDX)
+            if key[0] == fields.TYPE_CONTENT_VAL)
+        with self._known_hashes_lock:
+            self._known_chashes.update(chashes)
+            self._known_phashes.update(phashes)
+            self._known_hashes_loaded = True
+        logger.debug("Loaded %s header and %s content hashes"
+                     % (len(chashes), len(phashes)))
+
+    def add_known_hash(self, doc):
+        """
+        Record the hash of a header or content document that has just
+        been written.
+
+        :param doc: the content of the document
+        :type doc: dict
+        """
+        doctype = doc.get(fields.TYPE_KEY, None)
+        with self._known_hashes_lock:
+            if doctype == fields.TYPE_HEADERS_VAL:
+                self._known_chashes.add(str(doc[fields.CONTENT_HASH_KEY]))
+            elif doctype == fields.TYPE_CONTENT_VAL:
+                self._known_phashes.add(str(doc[fields.PAYLOAD_HASH_KEY]))
+
+    def forget_known_hash(self, doc):
+        """
+        Forget the hash of a header or content document that has been
+        deleted.
+
+        :param doc: the content of the document
+        :type doc: dict
+        """
+        doctype = doc.get(fields.TYPE_KEY, None)
+        with self._known_hashes_lock:
+            if doctype == fields.TYPE_HEADERS_VAL:
+                self._known_chashes.discard(
+                    str(doc[fields.CONTENT_HASH_KEY]))
+            elif doctype == fields.TYPE_CONTENT_VAL:
+                self._known_phashes.discard(
+                    str(doc[fields.PAYLOAD_HASH_KEY]))
+
+    def _is_known_hash(self, known, hash_):
+        """
+        Check a hash against one of the sets of known hashes.
+
+        :param known: the set of known hashes
+        :type known: set
+        :param hash_: the hash
+        :type hash_: str
+        :return: True or False if the set has the answer, None if we have
+                 to ask the database.
+        :rtype: bool or None
+        """
+        with self._known_hashes_lock:
+            if hash_ in known:
+                return True
+            if self._known_hashes_loaded:
+                return False
+        return None
+
     def _header_does_exist(self, doc):
         """
         Check whether we already have a header document for this
@@ -80,6 +201,9 @@ class ContentDedup(object):
         if not doc:
             return False
         chash = doc[fields.CONTENT_HASH_KEY]
+        known = self._is_known_hash(self._known_chashes, str(chash))
+        if known is not None:
+            return known
         header_docs = self._soledad.get_from_index(
             fields.TYPE_C_HASH_IDX,
             fields.TYPE_HEADERS_VAL, str(chash))
@@ -89,6 +213,8 @@ class ContentDedup(object):
         if len(header_docs) != 1:
             logger.warning("Found more than one copy of chash %s!"
                            % (chash,))
+        with self._known_hashes_lock:
+            self._known_chashes.add(str(chash))
         logger.debug("Found header doc with that hash! Skipping save!")
         return True
 
@@ -104,6 +230,9 @@ class ContentDedup(object):
         if not doc:
             return False
         phash = doc[fields.PAYLOAD_HASH_KEY]
+        known = self._is_known_hash(self._known_phashes, str(phash))
+        if known is not None:
+            return known
         attach_docs = self._soledad.get_from_index(
             fields.TYPE_P_HASH_IDX,
             fields.TYPE_CONTENT_VAL, str(phash))
@@ -113,6 +242,8 @@ class ContentDedup(object):
         if len(attach_docs) != 1:
             logger.warning("Found more than one copy of phash %s!"
                            % (phash,))
+        with self._known_hashes_lock:
+            self._known_phashes.add(str(phash))
         logger.debug("Found attachment doc with that hash! Skipping save!")
         return True
 
@@ -131,14 +262,46 @@ class SoledadStore(ContentDedup):
 
     implements(IMessageConsumer, IMessageStore)
 
-    def __init__(self, soledad):
+    def __init__(self, soledad, batch_size=WRITE_BATCH_SIZE,
+                 batch_latency=WRITE_BATCH_LATENCY):
         """
         Initialize the permanent store that writes to Soledad database.
 
         :param soledad: the soledad instance
         :type soledad: Soledad
+        :param batch_size: the maximum number of items written together.
+        :type batch_size: int
+        :param batch_latency: the maximum time an item can wait for its
+                              batch to be filled, in seconds.
+        :type batch_latency: float
         """
+        ContentDedup.__init__(self)
         self._soledad = soledad
+        self._batch_size = batch_size
+        self._batch_latency = batch_latency
+
+        # the items waiting to be written, and the call that will write them
+        # if the batch is not filled before.
+        self._batch = []
+        self._batch_call = None
+        self._batch_lock = defer.DeferredLock()
+
+        """
+        retries keeps the document wrappers that could not be written
+        completely, with the parts still to be written, by key.
+
+        {('mbox-a', 1): RetryEntry(...)}
+        """
+        self._retries = OrderedDict()
+        self._retry_calls = {}
+
+        # the keys of the messages that have changed again while their
+        # write was being retried.
+        self._superseded = set([])
+
+        self._stats = {"written": 0, "failed": 0, "retried": 0,
+                       "given_up": 0}
+        self._stats_lock = threading.Lock()
 
     # IMessageStore
 
@@ -185,12 +348,30 @@ class SoledadStore(ContentDedup):
         """
         Get a IMessageContainer for the given mbox and uid combination.
 
+        Only the flags and headers documents are retrieved, the content
+        documents are fetched on demand by the message.
+
         :param mbox: the mbox this message belongs.
         :type mbox: str or unicode
         :param uid: the UID that identifies this message in this mailbox.
         :type uid: int
+        :return: a MessageWrapper, or None if not found.
+        :rtype: MessageWrapper or None
         """
-        raise NotImplementedError()
+        fdoc = self.get_flags_doc(mbox, uid)
+        if empty(fdoc):
+            return None
+        docs_id = {MessageWrapper.FDOC: fdoc.doc_id}
+
+        hdoc_content = None
+        hdoc = self.get_headers_doc(
+            fdoc.content.get(fields.CONTENT_HASH_KEY, None))
+        if not empty(hdoc):
+            hdoc_content = hdoc.content
+            docs_id[MessageWrapper.HDOC] = hdoc.doc_id
+
+        return MessageWrapper(fdoc=fdoc.content, hdoc=hdoc_content,
+                              new=False, dirty=False, docs_id=docs_id)
 
     # IMessageConsumer
 
@@ -200,6 +381,10 @@ class SoledadStore(ContentDedup):
         """
         Creates a new document in soledad db.
 
+        The items are not written one by one, but grouped in batches of up
+        to `batch_size` items. A batch that is not full is written anyway
+        after `batch_latency` seconds.
+
         :param queue: queue to get item from, with content of the document
                       to be inserted.
         :type queue: Queue
@@ -219,20 +404,289 @@ class SoledadStore(ContentDedup):
                 # If everything went well, we can unset the new flag
                 # in the source store (memory store)
                 self._unset_new_dirty(doc_wrapper)
+            elif isinstance(doc_wrapper, RecentFlagsDoc):
+                if doc_wrapper.memstore is not None:
+                    doc_wrapper.memstore.confirm_recent_flags(
+                        doc_wrapper.content[fields.MBOX_KEY])
 
-        def docWriteErrorBack(failure):
+        def docWriteErrorBack(failure, doc_wrapper):
             """
             Errorback for write operations.
             """
-            log.error("Error while processing item.")
-            log.msg(failure.getTraceBack())
+            logger.error("Error while processing item.")
+            logger.error(failure.getTraceback())
+            memstore = getattr(doc_wrapper, "memstore", None)
+            if memstore is None:
+                return
+            if isinstance(doc_wrapper, MessageWrapper):
+                # it stays pending, and whoever waits for it is told.
+                memstore.write_failed(
+                    self._get_wrapper_key(doc_wrapper), failure)
+            elif isinstance(doc_wrapper, RecentFlagsDoc):
+                # the changes will be written in the next round.
+                memstore.restore_recent_flags(
+                    doc_wrapper.content[fields.MBOX_KEY])
 
         while not queue.empty():
             doc_wrapper = queue.get()
+            key = self._get_wrapper_key(doc_wrapper)
+            if key in self._retries:
+                # only its failed parts are written, by the retry. The
+                # newer content is written once the retry is over.
+                if isinstance(doc_wrapper, MessageWrapper):
+                    self._superseded.add(key)
+                continue
             d = defer.Deferred()
-            d.addCallbacks(docWriteCallBack, docWriteErrorBack)
+            d.addCallbacks(docWriteCallBack, docWriteErrorBack,
+                           errbackArgs=(doc_wrapper,))
+            self._batch.append((doc_wrapper, d))
+            if len(self._batch) >= self._batch_size:
+                self._write_batch()
+
+        if self._batch:
+            self._schedule_batch()
+
+    def _schedule_batch(self):
+        """
+        Schedule the write of the current batch, if it is not scheduled yet.
+        """
+        from twisted.internet import reactor
+        if self._batch_latency <= 0:
+            self._write_batch()
+            return
+        call = self._batch_call
+        if call is None or not call.active():
+            self._batch_call = reactor.callLater(
+                self._batch_latency, self._write_batch)
+
+    def _write_batch(self):
+        """
+        Write the current batch in a worker thread.
+
+        Batches are written one after the other, in the order they
+        were queued.
+
+        :return: a deferred that will be fired when the batch is written.
+        :rtype: Deferred
+        """
+        call = self._batch_call
+        if call is not None and call.active():
+            call.cancel()
+        self._batch_call = None
+
+        batch, self._batch = self._batch, []
+        if not batch:
+            return defer.succeed(None)
+        d = self._batch_lock.run(self._write_and_report, batch)
+        d.addErrback(lambda f: log.err(f, "Error while writing batch."))
+        return d
+
+    def _write_and_report(self, batch):
+        """
+        Write a batch, and report back the result for every item in it.
+
+        :param batch: a list of tuples with a document wrapper and the
+                      deferred to be fired when it has been written.
+        :type batch: list
+        :rtype: Deferred
+        """
+        d = defer.maybeDeferred(self._consume_batch, batch)
+        d.addCallback(self._fire_batch_results)
+        return d
+
+    @deferred_to_thread
+    def _consume_batch(self, batch):
+        """
+        Consume a batch of document wrappers in a single worker thread.
+
+        Soledad commits every write on its own, so the batch is not atomic:
+        each document wrapper gets its own result, and an error only
+        affects the wrapper it happened in.
+
+        :param batch: a list of tuples with a MessageWrapper or
+                      RecentFlagsDoc instance and the deferred to be fired
+                      when its write operation has finished.
+        :type batch: list
+        :return: a list of tuples with the deferred for each item and either
+                 the written wrapper or the error.
+        :rtype: list
+        """
+        results = []
+        for doc_wrapper, deferred in batch:
+            try:
+                result = self._consume_doc(doc_wrapper)
+            except Exception as exc:
+                logger.exception(exc)
+                result = self._get_whole_retry(doc_wrapper)
+            results.append((deferred, result))
+        return results
+
+    def _fire_batch_results(self, results):
+        """
+        Report back the result of the write operation for every item in a
+        batch.
+
+        :param results: the result of `_consume_batch`
+        :type results: list
+        """
+        for deferred, result in results:
+            if isinstance(result, RetryEntry):
+                self._schedule_retry(result._replace(deferred=deferred))
+            elif isinstance(result, Exception):
+                deferred.errback(result)
+            else:
+                deferred.callback(result)
+
+    # Retries
+
+    def _get_wrapper_key(self, doc_wrapper):
+        """
+        Return the key for a document wrapper in the retry queue.
+
+        :param doc_wrapper: a MessageWrapper or RecentFlagsDoc instance
+        :type doc_wrapper: MessageWrapper or RecentFlagsDoc
+        :rtype: tuple or unicode or None
+        """
+        if isinstance(doc_wrapper, MessageWrapper):
+            content = doc_wrapper.fdoc.content
+            return (content.get(fields.MBOX_KEY, None),
+                    content.get(fields.UID_KEY, None))
+        return getattr(doc_wrapper, "doc_id", None)
+
+    def _schedule_retry(self, entry):
+        """
+        Schedule the write of the failed parts of a document wrapper, with
+        an exponential backoff. After too many attempts, we give up and
+        errback its deferred.
+
+        :param entry: the failed parts
+        :type entry: RetryEntry
+        """
+        from twisted.internet import reactor
+        key = self._get_wrapper_key(entry.wrapper)
+        if entry.attempts >= WRITE_MAX_RETRIES:
+            self._retries.pop(key, None)
+            self._superseded.discard(key)
+            self._count("given_up")
+            entry.deferred.errback(MsgWriteError(
+                "Giving up writing the message after %s retries"
+                % (entry.attempts,)))
+            return
+
+        self._retries[key] = entry
+        delay = min(WRITE_RETRY_DELAY * 2 ** entry.attempts,
+                    WRITE_RETRY_MAX_DELAY)
+        if entry.items is None:
+            logger.debug("Retrying %r in %s seconds" % (key, delay))
+        else:
+            logger.debug("Retrying %s parts of %r in %s seconds"
+                         % (len(entry.items), key, delay))
+        self._retry_calls[key] = reactor.callLater(delay, self._retry, key)
+
+    def _retry(self, key):
+        """
+        Retry the write of the failed parts for a given key.
+
+        :param key: the key in the retry queue
+        :type key: tuple or unicode
+        :rtype: Deferred
+        """
+        self._retry_calls.pop(key, None)
+        entry = self._retries.get(key, None)
+        if entry is None:
+            return defer.succeed(None)
+        self._count("retried")
+
+        def report(failed):
+            if failed is None or failed:
+                self._schedule_retry(entry._replace(
+                    items=failed, attempts=entry.attempts + 1))
+                return
+            self._retries.pop(key, None)
+            superseded = key in self._superseded
+            self._superseded.discard(key)
+            memstore = getattr(entry.wrapper, "memstore", None)
+            if superseded and memstore is not None:
+                # what we wrote is not the last version of the message,
+                # so it cannot be marked as clean.
+                memstore.requeue_message(*key)
+            else:
+                entry.deferred.callback(entry.wrapper)
+
+        def write():
+            d = defer.maybeDeferred(self._write_retry, entry)
+            d.addCallback(report)
+            return d
+
+        d = self._batch_lock.run(write)
+        d.addErrback(lambda f: log.err(f, "Error while retrying write."))
+        return d
+
+    @deferred_to_thread
+    def _write_retry(self, entry):
+        """
+        Write the failed parts of a retry entry.
+
+        :param entry: the failed parts
+        :type entry: RetryEntry
+        :return: the parts that failed again, or None if the whole wrapper
+                 has to be written again.
+        :rtype: list or None
+        """
+        try:
+            if entry.items is not None:
+                return self._write_items(entry.wrapper, iter(entry.items))
+            result = self._consume_doc(entry.wrapper)
+        except Exception as exc:
+            logger.exception(exc)
+            return entry.items
+        if isinstance(result, RetryEntry):
+            return result.items
+        if isinstance(result, Exception):
+            return None
+        return []
+
+    def _get_whole_retry(self, doc_wrapper):
+        """
+        Return the result for a document wrapper whose write failed before
+        we could tell which of its parts were left.
+
+        A message is written again as a whole by the retries, so that
+        whoever waits for it is told in any case. The recent flags are
+        restored by the errback and written in the next round.
 
-            self._consume_doc(doc_wrapper, d)
+        :param doc_wrapper: a MessageWrapper or RecentFlagsDoc instance
+        :type doc_wrapper: MessageWrapper or RecentFlagsDoc
+        :rtype: RetryEntry or MsgWriteError
+        """
+        if isinstance(doc_wrapper, MessageWrapper):
+            return RetryEntry(doc_wrapper, None, None, 0)
+        return MsgWriteError("There was an error writing the message")
+
+    def _count(self, counter, value=1):
+        """
+        Increment one of the write counters.
+
+        :param counter: the name of the counter
+        :type counter: str
+        :param value: the increment
+        :type value: int
+        """
+        with self._stats_lock:
+            self._stats[counter] += value
+
+    def stats(self):
+        """
+        Return the counters of parts written and failed, retries done and
+        messages that could not be written, and the current size of the
+        retry queue.
+
+        :rtype: dict
+        """
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["retry_queue"] = len(self._retries)
+        return stats
 
     @deferred_to_thread
     def _unset_new_dirty(self, doc_wrapper):
@@ -248,38 +702,67 @@ class SoledadStore(ContentDedup):
         doc_wrapper.new = False
         doc_wrapper.dirty = False
 
-    @deferred_to_thread
-    def _consume_doc(self, doc_wrapper, deferred):
+    def _consume_doc(self, doc_wrapper):
         """
-        Consume each document wrapper in a separate thread.
+        Consume a document wrapper, writing all of its parts.
 
         :param doc_wrapper: a MessageWrapper or RecentFlagsDoc instance
         :type doc_wrapper: MessageWrapper or RecentFlagsDoc
-        :param deferred: a deferred that will be fired when the write operation
-                         has finished, either calling its callback or its
-                         errback depending on whether it succeed.
-        :type deferred: Deferred
+        :return: the document wrapper if all the writes succeeded, a
+                 RetryEntry with what has to be written again, or a
+                 MsgWriteError if it cannot be written.
+        :rtype: MessageWrapper or RecentFlagsDoc or RetryEntry or
+                MsgWriteError
         """
         items = self._process(doc_wrapper)
 
         # we prime the generator, that should return the
         # message or flags wrapper item in the first place.
-        doc_wrapper = items.next()
+        try:
+            doc_wrapper = items.next()
+        except StopIteration:
+            return MsgWriteError("Cannot process item %r" % (doc_wrapper,))
 
         # From here, we unpack the subpart items and
         # the right soledad call.
-        failed = False
+        try:
+            failed = self._write_items(doc_wrapper, items)
+        except Exception as exc:
+            # the generator itself failed, ie, querying for dedup, so
+            # we do not know which parts are left.
+            logger.exception(exc)
+            return self._get_whole_retry(doc_wrapper)
+        if failed:
+            return RetryEntry(doc_wrapper, None, failed, 0)
+        return doc_wrapper
+
+    def _write_items(self, doc_wrapper, items):
+        """
+        Write the parts of a document wrapper, keeping track of the ones
+        that fail.
+
+        :param doc_wrapper: a MessageWrapper or RecentFlagsDoc instance
+        :type doc_wrapper: MessageWrapper or RecentFlagsDoc
+        :param items: an iterator of tuples with the part payload and the
+                      call that writes it.
+        :type items: iterable
+        :return: the tuples for the parts that could not be written.
+        :rtype: list
+        """
+        failed = []
         for item, call in items:
             try:
-                self._try_call(call, item)
+                result = self._try_call(call, item)
+                if call == self._soledad.create_doc:
+                    self.add_known_hash(item)
+                if result is not None:
+                    self._remember_rev(doc_wrapper, result)
+                self._count("written")
             except Exception as exc:
-                failed = exc
-                continue
-        if failed:
-            deferred.errback(MsgWriteError(
-                "There was an error writing the mesage"))
-        else:
-            deferred.callback(doc_wrapper)
+                logger.warning("Error writing part: %r" % (exc,))
+                failed.append((item, call))
+                self._count("failed")
+        return failed
 
     #
     # SoledadStore specific methods.
@@ -312,11 +795,12 @@ class SoledadStore(ContentDedup):
         :type call: callable
         :param item: the payload to pass to the call as argument
         :type item: object
+        :return: the document written, if the call returns it.
         """
         if call is None:
             return
         try:
-            call(item)
+            return call(item)
         except u1db_errors.RevisionConflict as exc:
             logger.exception("Error: %r" % (exc,))
             raise exc
@@ -353,16 +837,15 @@ class SoledadStore(ContentDedup):
         # the flags doc.
 
         elif msg_wrapper.dirty:
-            call = self._soledad.put_doc
+            call = self._put_doc
             # item is expected to be a MessagePartDoc
             for item in msg_wrapper.walk():
                 # XXX FIXME Give error if dirty and not doc_id !!!
                 doc_id = item.doc_id  # defend!
                 if not doc_id:
                     continue
-                doc = self._soledad.get_doc(doc_id)
-                doc.content = dict(item.content)
                 if item.part == MessagePartType.fdoc:
+                    doc = self._get_fdoc_for_put(msg_wrapper, item)
                     logger.debug("PUT dirty fdoc")
                     yield doc, call
 
@@ -370,24 +853,103 @@ class SoledadStore(ContentDedup):
         else:
             logger.error("Cannot delete documents yet from the queue...!")
 
+    def _get_fdoc_for_put(self, msg_wrapper, item):
+        """
+        Return a document with the new content of a dirty flags document,
+        ready to be put.
+
+        If the memory store knows the revision of the stored document we
+        build it from there, otherwise we have to get it from Soledad.
+
+        :param msg_wrapper: the MessageWrapper for the flags document
+        :type msg_wrapper: MessageWrapper
+        :param item: the flags document part
+        :type item: MessagePartDoc
+        :rtype: SoledadDocument
+        """
+        content = dict(item.content)
+        memstore = msg_wrapper.memstore
+        rev = None
+        if memstore is not None:
+            rev = memstore.get_fdoc_rev(
+                content[fields.MBOX_KEY], content[fields.UID_KEY])
+        if rev is not None and rev[0] == item.doc_id:
+            doc = SoledadDocument(doc_id=item.doc_id, rev=rev[1])
+        else:
+            doc = self._soledad.get_doc(item.doc_id)
+        doc.content = content
+        return doc
+
+    def _put_doc(self, doc):
+        """
+        Put a document whose revision might be out of date.
+
+        If the document has changed since we saw it (ie, because of a sync)
+        we put the new content over the current revision, as we would have
+        done after getting it.
+
+        :param doc: the document to put
+        :type doc: SoledadDocument
+        :return: the document, with its new revision
+        :rtype: SoledadDocument
+        """
+        try:
+            self._soledad.put_doc(doc)
+        except u1db_errors.RevisionConflict:
+            logger.debug("Revision of %s out of date, retrying"
+                         % (doc.doc_id,))
+            current = self._soledad.get_doc(doc.doc_id)
+            current.content = doc.content
+            self._soledad.put_doc(current)
+            doc = current
+        return doc
+
+    def _remember_rev(self, doc_wrapper, doc):
+        """
+        Let the memory store know the revision of a flags or recent-flags
+        document that has just been written.
+
+        :param doc_wrapper: the wrapper the document belongs to
+        :type doc_wrapper: MessageWrapper or RecentFlagsDoc
+        :param doc: the written document
+        :type doc: SoledadDocument
+        """
+        memstore = getattr(doc_wrapper, "memstore", None)
+        if memstore is None:
+            return
+        content = getattr(doc, "content", None)
+        if not isinstance(content, dict):
+            return
+        doc_type = content.get(fields.TYPE_KEY, None)
+        if doc_type == fields.TYPE_FLAGS_VAL:
+            memstore.set_fdoc_rev(
+                content[fields.MBOX_KEY], content[fields.UID_KEY],
+                doc.doc_id, doc.rev)
+        elif doc_type == fields.TYPE_RECENT_VAL:
+            memstore.set_rflags_rev(
+                content[fields.MBOX_KEY], doc.doc_id, doc.rev)
+
     def _get_calls_for_rflags_doc(self, rflags_wrapper):
         """
-        We always put these documents.
+        We always put these documents, over the revision known by the
+        memory store if there is one.
 
         :param rflags_wrapper: A wrapper around recent flags doc.
-        :type rflags_wrapper: RecentFlagsWrapper
+        :type rflags_wrapper: RecentFlagsDoc
         :return: a tuple with recent-flags doc payload and callable
         :rtype: tuple
         """
-        call = self._soledad.put_doc
-        rdoc = self._soledad.get_doc(rflags_wrapper.doc_id)
-
         payload = rflags_wrapper.content
         logger.debug("Saving RFLAGS to Soledad...")
 
         if payload:
+            if rflags_wrapper.rev is not None:
+                rdoc = SoledadDocument(
+                    doc_id=rflags_wrapper.doc_id, rev=rflags_wrapper.rev)
+            else:
+                rdoc = self._soledad.get_doc(rflags_wrapper.doc_id)
             rdoc.content = payload
-            yield rdoc, call
+            yield rdoc, self._put_doc
 
     def _get_mbox_document(self, mbox):
         """
@@ -430,13 +992,67 @@ class SoledadStore(ContentDedup):
         finally:
             return result
 
+    def get_headers_doc(self, chash):
+        """
+        Return the SoledadDocument for the headers with the given
+        content-hash.
+
+        :param chash: the content hash of the message
+        :type chash: str or unicode
+        :rtype: SoledadDocument or None
+        """
+        if chash is None:
+            return None
+        result = None
+        try:
+            head_docs = self._soledad.get_from_index(
+                fields.TYPE_C_HASH_IDX,
+                fields.TYPE_HEADERS_VAL, str(chash))
+            result = first(head_docs)
+        except Exception as exc:
+            logger.warning("ERROR while getting headers for chash: %s"
+                           % (chash,))
+            logger.exception(exc)
+        finally:
+            return result
+
+    def count_flags_docs(self, mbox):
+        """
+        Return the number of flags documents for a given mailbox, and the
+        number of those without the seen flag.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :return: a tuple with both counts
+        :rtype: tuple
+        """
+        exists = self._soledad.get_count_from_index(
+            fields.TYPE_MBOX_IDX,
+            fields.TYPE_FLAGS_VAL, mbox)
+        unseen = self._soledad.get_count_from_index(
+            fields.TYPE_MBOX_SEEN_IDX,
+            fields.TYPE_FLAGS_VAL, mbox, '0')
+        return exists, unseen
+
+    def get_all_flags_docs(self, mbox):
+        """
+        Return all the flags documents for a given mailbox.
+
+        :param mbox: the mailbox
+        :type mbox: str or unicode
+        :rtype: list of SoledadDocument
+        """
+        return self._soledad.get_from_index(
+            fields.TYPE_MBOX_IDX,
+            fields.TYPE_FLAGS_VAL, mbox)
+
     def write_last_uid(self, mbox, value):
         """
         Write the `last_uid` integer to the proper mailbox document
         in Soledad.
         This is called from the deferred triggered by
-        memorystore.increment_last_soledad_uid, which is expected to
-        run in a separate thread.
+        memorystore._write_last_uids, once per mailbox and write, which is
+        expected to run in a separate thread.
 
         :param mbox: the mailbox
         :type mbox: str or unicode
@@ -471,17 +1087,38 @@ class SoledadStore(ContentDedup):
                 fields.TYPE_MBOX_DEL_IDX,
                 fields.TYPE_FLAGS_VAL, mbox, '1'))
 
-    # TODO can deferToThread this?
-    def remove_all_deleted(self, mbox):
+    @deferred_to_thread
+    def remove_all_deleted(self, mbox, progress=None):
         """
         Remove from Soledad all messages flagged as deleted for a given
         mailbox.
 
+        This runs in a worker thread. Soledad commits every deletion on its
+        own, so if one of them fails we stop there and report the ones
+        already done. The rest will be deleted in the next expunge.
+
         :param mbox: the mailbox
         :type mbox: str or unicode
+        :param progress: a callable that will be called from the reactor
+                         thread every `EXPUNGE_PROGRESS_STEP` deletions,
+                         with the number of deleted messages and the total.
+        :type progress: callable or None
+        :return: the UIDs of the deleted messages.
+        :rtype: list
         """
+        from twisted.internet import reactor
+        docs = list(self.deleted_iter(mbox))
+        total = len(docs)
         deleted = []
-        for doc in self.deleted_iter(mbox):
+        for doc in docs:
+            try:
+                self._soledad.delete_doc(doc)
+            except Exception as exc:
+                logger.exception(exc)
+                break
             deleted.append(doc.content[fields.UID_KEY])
-            self._soledad.delete_doc(doc)
+            count = len(deleted)
+            if progress is not None and (
+                    count % EXPUNGE_PROGRESS_STEP == 0 or count == total):
+                reactor.callFromThread(progress, count, total)
         return deleted
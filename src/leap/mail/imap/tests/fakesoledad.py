@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# fakesoledad.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+An in-process stand-in for Soledad, for tests and benchmarks.
+
+It implements the subset of the Soledad API that leap.mail uses on top of
+a plain u1db SQLite database, in memory or in a file, so the index
+semantics are the ones of the SQLCipher backend. Every call can be delayed
+to simulate the cost of the encrypted database, and the calls are counted.
+
+    >>> soledad = FakeSoledad(latency=0.001, latencies={"sync": 2})
+    >>> soledad.create_index("by-type", "type")
+    >>> doc = soledad.create_doc({"type": "flags"})
+    >>> soledad.calls["create_doc"]
+    1
+"""
+import threading
+import time
+import uuid
+
+from collections import Counter
+from sqlite3 import dbapi2
+
+from u1db.backends import sqlite_backend
+
+from leap.soledad.common.document import SoledadDocument
+
+
+class _SQLiteDatabase(sqlite_backend.SQLitePartialExpandDatabase):
+    """
+    A u1db SQLite database that can be used from several threads.
+
+    The calls are serialized by the FakeSoledad lock.
+    """
+
+    def __init__(self, sqlite_file, replica_uid):
+        self._db_handle = dbapi2.connect(
+            sqlite_file, check_same_thread=False)
+        self._real_replica_uid = None
+        self._ensure_schema()
+        self._factory = SoledadDocument
+        self._set_replica_uid(replica_uid)
+
+
+class FakeSoledad(object):
+    """
+    A fake Soledad instance, with real u1db indexes and configurable
+    latency.
+
+    The methods take the same arguments as their Soledad counterparts.
+    """
+
+    def __init__(self, path=None, latency=0, latencies=None,
+                 user_uuid=None):
+        """
+        Initialize a FakeSoledad.
+
+        :param path: the path to a SQLite file to keep the documents in,
+                     or None to keep them in memory.
+        :type path: str or None
+        :param latency: the time every call takes, in seconds.
+        :type latency: float
+        :param latencies: the time taken by particular calls, by method
+                          name, overriding `latency`.
+        :type latencies: dict
+        :param user_uuid: the uuid of the user.
+        :type user_uuid: str
+        """
+        self.uuid = user_uuid or uuid.uuid4().hex
+        self._latency = latency
+        self._latencies = latencies or {}
+        self._lock = threading.RLock()
+
+        # how many times each method has been called.
+        self.calls = Counter()
+
+        self._db = _SQLiteDatabase(path or ":memory:", self.uuid)
+
+    def _delay(self, name):
+        """
+        Count a call, and wait for its configured latency.
+
+        :param name: the name of the method
+        :type name: str
+        """
+        self.calls[name] += 1
+        delay = self._latencies.get(name, self._latency)
+        if delay:
+            time.sleep(delay)
+
+    def _call(self, name, *args, **kwargs):
+        """
+        Call a method of the u1db database, after the configured latency.
+
+        :param name: the name of the method
+        :type name: str
+        """
+        self._delay(name)
+        with self._lock:
+            return getattr(self._db, name)(*args, **kwargs)
+
+    # Documents
+
+    def create_doc(self, content, doc_id=None):
+        return self._call("create_doc", content, doc_id=doc_id)
+
+    def put_doc(self, doc):
+        return self._call("put_doc", doc)
+
+    def get_doc(self, doc_id, include_deleted=False):
+        return self._call("get_doc", doc_id, include_deleted=include_deleted)
+
+    def get_docs(self, doc_ids, check_for_conflicts=True,
+                 include_deleted=False):
+        return self._call("get_docs", doc_ids,
+                          check_for_conflicts=check_for_conflicts,
+                          include_deleted=include_deleted)
+
+    def get_all_docs(self, include_deleted=False):
+        return self._call("get_all_docs", include_deleted=include_deleted)
+
+    def delete_doc(self, doc):
+        return self._call("delete_doc", doc)
+
+    # Indexes
+
+    def create_index(self, index_name, *index_expressions):
+        return self._call("create_index", index_name, *index_expressions)
+
+    def delete_index(self, index_name):
+        return self._call("delete_index", index_name)
+
+    def list_indexes(self):
+        return self._call("list_indexes")
+
+    def get_from_index(self, index_name, *key_values):
+        return self._call("get_from_index", index_name, *key_values)
+
+    def get_count_from_index(self, index_name, *key_values):
+        self._delay("get_count_from_index")
+        with self._lock:
+            return len(self._db.get_from_index(index_name, *key_values))
+
+    def get_index_keys(self, index_name):
+        return self._call("get_index_keys", index_name)
+
+    # Sync
+
+    def sync(self):
+        """
+        Pretend to sync with the server, taking the configured latency.
+
+        :return: the local generation.
+        :rtype: int
+        """
+        self._delay("sync")
+        with self._lock:
+            return self._db._get_generation()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
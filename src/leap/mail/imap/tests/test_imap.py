@@ -26,17 +26,24 @@ XXX add authors from the original twisted tests.
 """
 # XXX review license of the original tests!!!
 from email import parser
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
+import copy
+import hashlib
 import os
+import Queue
+import sys
 import types
 import tempfile
 import shutil
 import time
+import weakref
 
 from itertools import chain
 
@@ -62,9 +69,21 @@ import twisted.cred.portal
 # import u1db
 
 from leap.common.testing.basetest import BaseLeapTest
+from leap.mail import walk
 from leap.mail.imap.account import SoledadBackedAccount
+from leap.mail.imap.collector import OrphanCollector
+from leap.mail.imap.fields import fields
+from leap.mail.imap.journal import MessageJournal
 from leap.mail.imap.mailbox import SoledadMailbox
-from leap.mail.imap.messages import MessageCollection
+from leap.mail.imap.memorystore import MemoryStore
+from leap.mail.imap.messageparts import CompactFlagsDoc
+from leap.mail.imap.messageparts import MessageWrapper
+from leap.mail.imap.messages import LeapMessage, MessageCollection
+from leap.mail.imap.messages import build_msg_docs, new_parse_pool
+from leap.mail.imap.payloadcache import PayloadCache
+from leap.mail.imap.soledadstore import SoledadStore
+from leap.mail.imap.tests.fakesoledad import FakeSoledad
+from leap.mail.imap.tests.walkcompare import compare as compare_walks
 
 from leap.soledad.client import Soledad
 from leap.soledad.client import SoledadCrypto
@@ -508,6 +527,1372 @@ class MessageCollectionTestCase(IMAP4HelperMixin, unittest.TestCase):
             len(mc._soledad.get_from_index(mc.TYPE_IDX, "flags")), 4)
 
 
+class CompactFlagsDocTestCase(unittest.TestCase):
+    """
+    Tests for the compact representation of the flags documents.
+    """
+
+    fdoc = {
+        "type": "flags", "mbox": "INBOX", "uid": 3,
+        "chash": "a" * 64, "size": 1024, "multi": False,
+        "seen": True, "deleted": False,
+        "flags": ["\\Seen", "$Junk"],
+    }
+
+    def testDictView(self):
+        """
+        Test that the compact doc behaves like the dict it was built from.
+        """
+        doc = CompactFlagsDoc(self.fdoc)
+        self.assertEqual(doc, self.fdoc)
+        self.assertEqual(dict(doc), self.fdoc)
+        self.assertEqual(len(doc), len(self.fdoc))
+        self.assertFalse("recent" in doc)
+        self.assertEqual(doc.get("recent", "nope"), "nope")
+
+        doc["flags"] = ("\\Deleted", "$Junk", "\\Seen")
+        self.assertEqual(set(doc["flags"]),
+                         set(["\\Deleted", "$Junk", "\\Seen"]))
+
+        # values that do not fit are kept aside
+        doc["uid"] = "3"
+        doc["custom"] = [1, 2]
+        self.assertEqual(doc["uid"], "3")
+        self.assertEqual(doc["custom"], [1, 2])
+        doc["uid"] = 4
+        self.assertEqual(doc["uid"], 4)
+
+        copied = copy.deepcopy(weakref.proxy(doc))
+        self.assertEqual(copied, doc)
+        self.assertTrue(isinstance(copied, CompactFlagsDoc))
+
+    def testSmallerThanDict(self):
+        """
+        Test that the compact doc is much smaller than the dict.
+        """
+        from leap.mail.size import get_size
+        doc = CompactFlagsDoc(self.fdoc)
+        self.assertTrue(sys.getsizeof(doc) * 4 < get_size(dict(self.fdoc)))
+
+
+class MemoryStoreTestCase(unittest.TestCase):
+    """
+    Tests for the MemoryStore internal indexes.
+    """
+
+    def setUp(self):
+        """
+        setUp method for each test.
+        We use a MemoryStore with no permanent store, so nothing is written.
+        """
+        self.memstore = MemoryStore()
+
+    def tearDown(self):
+        """
+        tearDown method for each test
+        """
+        del self.memstore
+
+    def _add(self, mbox, uid, flags=None):
+        """
+        Add a minimal message to the memory store.
+        """
+        fdoc = {"mbox": mbox, "uid": uid, "chash": "chash-%s-%s" % (
+            mbox, uid), "flags": list(flags or []), "size": 42,
+            "multi": False, "type": "flags"}
+        self.memstore.create_message(
+            mbox, uid, MessageWrapper(fdoc=fdoc), observer=defer.Deferred(),
+            notify_on_disk=False)
+
+    def _fdoc_mock(self, mbox, uid, flags):
+        """
+        Return something that looks like a flags document from soledad.
+        """
+        return Mock(content={"type": "flags", "mbox": mbox, "uid": uid,
+                             "flags": flags},
+                    doc_id="fdoc-%s-%s" % (mbox, uid))
+
+    def testMailboxPartitions(self):
+        """
+        Test that the uids are partitioned by mailbox, and kept sorted.
+        """
+        for uid in (3, 1, 2):
+            self._add("INBOX", uid)
+        self._add("Sent", 7)
+
+        self.assertEqual(self.memstore.get_uids("INBOX"), [1, 2, 3])
+        self.assertEqual(self.memstore.get_uids("Sent"), [7])
+        self.assertEqual(self.memstore.get_last_uid("INBOX"), 3)
+        self.assertEqual(self.memstore.count_new_mbox("INBOX"), 3)
+        self.assertEqual(self.memstore.count_new_mbox("Sent"), 1)
+
+        self.memstore.remove_message("INBOX", 2)
+        self.assertEqual(self.memstore.get_uids("INBOX"), [1, 3])
+        self.assertEqual(self.memstore.count_new_mbox("INBOX"), 2)
+        self.assertEqual(
+            len(self.memstore.all_msg_dict_for_mbox("INBOX")), 2)
+
+    def testDeletedUidsByMailbox(self):
+        """
+        Test that only the deleted messages for a given mailbox are returned.
+        """
+        self._add("INBOX", 1, flags=("\\Deleted",))
+        self._add("INBOX", 2)
+        self._add("Trash", 1, flags=("\\Deleted",))
+        self.assertEqual(self.memstore.all_deleted_uid_iter("INBOX"), [1])
+
+    def testEvictCleanMessages(self):
+        """
+        Test that clean messages are evicted when going over the memory
+        budget, and reloaded from the permanent store on the next access.
+        """
+        store = Mock()
+        memstore = MemoryStore(permanent_store=store, max_size=1)
+        memstore._stop_write_loop()
+        self.addCleanup(memstore.producer.stop)
+        self.memstore = memstore
+
+        self._add("INBOX", 1)
+        self.assertEqual(memstore.get_uids("INBOX"), [1])
+
+        # new messages are never evicted, only after being written.
+        generation = memstore.get_generation("INBOX", 1)
+        memstore.unset_new(("INBOX", 1))
+        self.assertEqual(memstore.get_uids("INBOX"), [])
+        self.assertTrue(memstore.get_generation("INBOX", 1) > generation)
+        self.assertEqual(memstore.get_soledad_known_uids("INBOX"), set([1]))
+
+        store.get_message.return_value = MessageWrapper(
+            fdoc={"mbox": "INBOX", "uid": 1, "flags": []},
+            new=False, dirty=False, docs_id={})
+        msg = memstore.get_message("INBOX", 1)
+        store.get_message.assert_called_once_with("INBOX", 1)
+        self.assertEqual(msg.fdoc.content["uid"], 1)
+
+    def testSizeAccounting(self):
+        """
+        Test that the running size counters follow additions and removals.
+        """
+        memstore = self.memstore
+        self.assertEqual(memstore.get_size(), 0)
+        self._add("INBOX", 1)
+        self._add("Sent", 1)
+        inbox_size = memstore.get_mbox_size("INBOX")
+        self.assertTrue(inbox_size > 0)
+        self.assertEqual(memstore.get_size(),
+                         inbox_size + memstore.get_mbox_size("Sent"))
+        self.assertEqual(sum(memstore.get_part_sizes().values()),
+                         memstore.get_size())
+        self.assertTrue(memstore.get_part_sizes()["fdoc"] > 0)
+
+        memstore.remove_message("Sent", 1)
+        self.assertEqual(memstore.get_size(), inbox_size)
+        self.assertEqual(memstore.get_mbox_size("Sent"), 0)
+        memstore.remove_message("INBOX", 1)
+        self.assertEqual(memstore.get_size(), 0)
+
+    def testFlagsIndex(self):
+        """
+        Test that the flags index follows the flag changes, and that the
+        flags loaded from the permanent store do not override newer ones.
+        """
+        memstore = self.memstore
+        self._add("INBOX", 1, ["\\Seen"])
+        self._add("INBOX", 2, ["\\Seen", "\\Deleted"])
+        memstore.load_fdocs("INBOX", [
+            self._fdoc_mock("INBOX", 1, []),
+            self._fdoc_mock("INBOX", 3, ["\\Flagged"]),
+            self._fdoc_mock("INBOX", 4, [])])
+        self.assertTrue(memstore.is_flags_index_loaded("INBOX"))
+        self.assertFalse(memstore.is_flags_index_loaded("Sent"))
+
+        self.assertEqual(memstore.get_flag_uids("INBOX", "\\Seen"),
+                         set([1, 2]))
+        self.assertEqual(memstore.count_flag("INBOX", "\\Flagged"), 1)
+        self.assertEqual(memstore.get_unseen_uids("INBOX"), set([3, 4]))
+        self.assertEqual(memstore.count_unseen("INBOX"), 2)
+        self.assertEqual(memstore.all_deleted_uid_iter("INBOX"), [2])
+
+        memstore.put_message(
+            "INBOX", 1, MessageWrapper(
+                fdoc={"mbox": "INBOX", "uid": 1, "flags": []},
+                new=False, dirty=True),
+            notify_on_disk=False)
+        self.assertEqual(memstore.count_unseen("INBOX"), 3)
+
+        memstore.remove_message("INBOX", 2)
+        self.assertEqual(memstore.get_flag_uids("INBOX", "\\Seen"), set())
+        self.assertEqual(memstore.count_flag("INBOX", "\\Deleted"), 0)
+
+    def testLoadFdocs(self):
+        """
+        Test that the preloaded flags documents are kept as clean messages.
+        """
+        memstore = self.memstore
+        self._add("INBOX", 1, ["\\Seen"])
+        memstore.load_fdocs("INBOX", [
+            self._fdoc_mock("INBOX", 1, []),
+            self._fdoc_mock("INBOX", 2, ["\\Answered"])])
+
+        self.assertTrue(memstore.has_all_fdocs("INBOX"))
+        self.assertFalse(memstore.has_all_fdocs("Sent"))
+        self.assertEqual(memstore.get_uids("INBOX"), [1, 2])
+        self.assertEqual(memstore.get_soledad_known_uids("INBOX"),
+                         set([1, 2]))
+        self.assertEqual(memstore.count_new_mbox("INBOX"), 1)
+        self.assertEqual(
+            dict((fdoc["uid"], fdoc["flags"])
+                 for fdoc in memstore.all_fdoc_iter("INBOX")),
+            {1: ["\\Seen"], 2: ["\\Answered"]})
+        self.assertEqual(memstore.get_docid_for_fdoc("INBOX", 2),
+                         "fdoc-INBOX-2")
+
+    @deferred(timeout=5)
+    def testPreloadFdocs(self):
+        """
+        Test that the flags documents of a mailbox are queried only once,
+        and that a message removed meanwhile is not loaded back.
+        """
+        from leap.mail.imap import memorystore
+        self.patch(memorystore, "PRELOAD_CHUNK_SIZE", 2)
+        memstore = self.memstore
+        queried = defer.Deferred()
+        get_fdocs = Mock(return_value=queried)
+
+        first = memstore.preload_fdocs("INBOX", get_fdocs)
+        second = memstore.preload_fdocs("INBOX", get_fdocs)
+        self.assertEqual(get_fdocs.call_count, 1)
+        memstore.remove_message("INBOX", 2)
+        queried.callback([self._fdoc_mock("INBOX", uid, [])
+                          for uid in range(1, 6)])
+
+        def check(_):
+            self.assertEqual(memstore.get_uids("INBOX"), [1, 3, 4, 5])
+            self.assertTrue(memstore.has_all_fdocs("INBOX"))
+            third = memstore.preload_fdocs("INBOX", get_fdocs)
+            self.assertTrue(third.called)
+            self.assertEqual(get_fdocs.call_count, 1)
+
+        d = defer.gatherResults([first, second])
+        d.addCallback(check)
+        return d
+
+    @deferred(timeout=5)
+    def testWriteBackThresholds(self):
+        """
+        Test that the write-back waits for the write period, unless the
+        number of pending messages goes beyond the threshold.
+        """
+        from twisted.internet import reactor
+        from twisted.internet.task import deferLater
+
+        memstore = MemoryStore(permanent_store=Mock(), write_period=60,
+                               max_pending=2)
+        self.addCleanup(memstore.producer.stop)
+        self.addCleanup(memstore._stop_write_loop)
+        memstore.write_messages = Mock(return_value=True)
+        self.memstore = memstore
+
+        def add_first(_):
+            self._add("INBOX", 1)
+            self._add("INBOX", 1)
+            self.assertEqual(memstore._pending, set([("INBOX", 1)]))
+            return deferLater(reactor, 0.01, lambda: None)
+
+        def check_delayed(_):
+            self.assertFalse(memstore.write_messages.called)
+            self.assertTrue(memstore._write_call.getTime() >
+                            reactor.seconds() + 50)
+            self._add("INBOX", 2)
+            return deferLater(reactor, 0.01, lambda: None)
+
+        def check_written(_):
+            self.assertEqual(memstore.write_messages.call_count, 1)
+
+        # the scheduling happens in the reactor thread.
+        d = deferLater(reactor, 0, lambda: None)
+        d.addCallback(add_first)
+        d.addCallback(check_delayed)
+        d.addCallback(check_written)
+        return d
+
+    def testCoalescedDirtyDeferreds(self):
+        """
+        Test that putting the same message several times before it is
+        written fires all the returned deferreds.
+        """
+        msg = MessageWrapper(fdoc={"mbox": "INBOX", "uid": 1, "flags": []})
+        d1 = self.memstore.put_message("INBOX", 1, msg)
+        d2 = self.memstore.put_message("INBOX", 1, msg)
+        self.memstore.unset_dirty(("INBOX", 1))
+        self.assertTrue(d1.called)
+        self.assertTrue(d2.called)
+
+    def testExpunge(self):
+        """
+        Test that expunge removes the deleted messages from soledad and
+        from memory, pausing only the write-back of its mailbox.
+        """
+        store = Mock()
+        memstore = MemoryStore(permanent_store=store, write_period=60)
+        self.addCleanup(memstore.producer.stop)
+        self.addCleanup(memstore._stop_write_loop)
+        self.memstore = memstore
+        self._add("INBOX", 1, flags=("\\Deleted",))
+        self._add("INBOX", 2)
+        self._add("INBOX", 4, flags=("\\Deleted",))
+        self._add("Trash", 1, flags=("\\Deleted",))
+        for uid in (1, 2, 4):
+            memstore.unset_new(("INBOX", uid))
+        progress = []
+
+        def remove_all_deleted(mbox, progress=None):
+            self.assertEqual(memstore._paused_mboxes, set(["INBOX"]))
+            # a message that was never written only lives in memory.
+            self._add("INBOX", 5, flags=("\\Deleted",))
+            progress(2, 3)
+            # the deletion of the message 4 fails.
+            return [1, 3]
+
+        store.remove_all_deleted.side_effect = remove_all_deleted
+
+        def check(deleted):
+            self.assertEqual(deleted, set([1, 3, 5]))
+            self.assertEqual(progress, [(2, 3)])
+            self.assertEqual(memstore._paused_mboxes, set([]))
+            self.assertEqual(memstore.get_uids("INBOX"), [2, 4])
+            self.assertEqual(memstore.get_uids("Trash"), [1])
+
+        d = defer.Deferred()
+        d.addCallback(check)
+        memstore.expunge("INBOX", d, lambda *args: progress.append(args))
+        return d
+
+    @deferred(timeout=5)
+    def testCoalescedLastUid(self):
+        """
+        Test that the last uid is written only once per mailbox, with the
+        highest value reached.
+        """
+        store = Mock()
+        memstore = MemoryStore(permanent_store=store, write_period=60)
+        self.addCleanup(memstore.producer.stop)
+        self.addCleanup(memstore._stop_write_loop)
+        memstore.set_last_soledad_uid("INBOX", 3)
+
+        self.assertEqual(memstore.increment_last_soledad_uid("INBOX"), 4)
+        self.assertEqual(memstore.reserve_uids("INBOX", 10), 5)
+        self.assertEqual(memstore.increment_last_soledad_uid("INBOX"), 15)
+        self.assertEqual(memstore.get_last_uid("INBOX"), 15)
+        self.assertFalse(store.write_last_uid.called)
+
+        def check(_):
+            store.write_last_uid.assert_called_once_with("INBOX", 15)
+
+        return memstore.flush().addCallback(check)
+
+    @deferred(timeout=5)
+    def testLastUidWriteFailed(self):
+        """
+        Test that a last uid that could not be written is pending again,
+        without going back from a higher value reserved in the meantime.
+        """
+        store = Mock()
+        memstore = MemoryStore(permanent_store=store, write_period=60)
+        self.addCleanup(memstore.producer.stop)
+        self.addCleanup(memstore._stop_write_loop)
+        memstore.set_last_soledad_uid("INBOX", 3)
+        memstore.reserve_uids("INBOX", 2)
+
+        def fail_and_reserve(mbox, value):
+            memstore.reserve_uids("INBOX", 3)
+            raise Exception("boom")
+        store.write_last_uid.side_effect = fail_and_reserve
+
+        def failed(failure):
+            self.assertEqual(memstore._last_uid_pending, {"INBOX": 8})
+            store.write_last_uid.side_effect = None
+            return memstore.flush()
+
+        def check(_):
+            store.write_last_uid.assert_called_with("INBOX", 8)
+            self.assertEqual(memstore._last_uid_pending, {})
+
+        d = memstore.flush()
+        d.addCallbacks(lambda _: self.fail("The write should fail"), failed)
+        return d.addCallback(check)
+
+    def testReserveUnprimed(self):
+        """
+        Test that no UIDs are handed out for a mailbox whose last uid has
+        not been loaded.
+        """
+        memstore = MemoryStore()
+        self.assertRaises(AssertionError, memstore.reserve_uids, "INBOX", 1)
+        memstore.set_last_soledad_uid("INBOX", 3)
+        self.assertEqual(memstore.reserve_uids("INBOX", 1), 4)
+
+    @deferred(timeout=5)
+    def testFlush(self):
+        """
+        Test that flush forces a write, and fires only when all the messages
+        that were pending at call time have been written.
+        """
+        from twisted.internet import reactor
+        from twisted.internet.task import deferLater
+
+        memstore = MemoryStore(permanent_store=Mock(), write_period=60)
+        self.addCleanup(memstore.producer.stop)
+        self.addCleanup(memstore._stop_write_loop)
+        memstore.write_messages = Mock(return_value=True)
+        self.memstore = memstore
+        self.assertTrue(memstore.flush().called)
+
+        def add_and_flush(_):
+            self._add("INBOX", 1)
+            self._add("INBOX", 2)
+            self._add("Trash", 1)
+            self.flushed = memstore.flush("INBOX")
+            return deferLater(reactor, 0.01, lambda: None)
+
+        def check_written(_):
+            self.assertEqual(memstore.write_messages.call_count, 1)
+            memstore.unset_new(("INBOX", 1))
+            self.assertFalse(self.flushed.called)
+            memstore.unset_new(("INBOX", 2))
+            self.assertTrue(self.flushed.called)
+            self.assertEqual(memstore._flush_waiters.keys(), [])
+
+        def check_failed(_):
+            # the permanent store gives up on a message.
+            self._add("INBOX", 3)
+            failed = memstore.flush("INBOX")
+            memstore.write_failed(("INBOX", 3), RuntimeError("boom"))
+            return self.assertFailure(failed, RuntimeError)
+
+        d = deferLater(reactor, 0, lambda: None)
+        d.addCallback(add_and_flush)
+        d.addCallback(check_written)
+        d.addCallback(check_failed)
+        return d
+
+    def testRequeueMessage(self):
+        """
+        Test that a message written while it was changing is kept dirty and
+        pending, and that a message we gave up writing is pending again.
+        """
+        memstore = MemoryStore(permanent_store=Mock(), write_period=60)
+        self.addCleanup(memstore.producer.stop)
+        memstore._stop_write_loop()
+        self.memstore = memstore
+        self._add("INBOX", 1)
+        self._add("INBOX", 2)
+        memstore._pending.clear()
+
+        memstore.requeue_message("INBOX", 1)
+        self.assertEqual(memstore._get_new_dirty_state(("INBOX", 1)),
+                         [False, True])
+        self.assertEqual(memstore._pending, set([("INBOX", 1)]))
+
+        memstore.write_failed(("INBOX", 2), RuntimeError("boom"))
+        self.assertEqual(memstore._get_new_dirty_state(("INBOX", 2)),
+                         [True, False])
+        self.assertEqual(memstore._pending,
+                         set([("INBOX", 1), ("INBOX", 2)]))
+
+    def testReconcileCounts(self):
+        """
+        Test that the counters are answered from memory, and reloaded from
+        the permanent store only when they do not match it.
+        """
+        store = Mock()
+        memstore = MemoryStore(permanent_store=store, write_period=60)
+        self.addCleanup(memstore.producer.stop)
+        self.addCleanup(memstore._stop_write_loop)
+        self.memstore = memstore
+        memstore.load_fdocs("INBOX", [
+            self._fdoc_mock("INBOX", 1, []),
+            self._fdoc_mock("INBOX", 2, ["\\Seen"])])
+        self.assertEqual(memstore.count_exists("INBOX"), 2)
+        self.assertEqual(memstore.count_unseen("INBOX"), 1)
+
+        store.count_flags_docs.return_value = (2, 1)
+        memstore.reconcile_counts()
+        self.assertFalse(store.get_all_flags_docs.called)
+
+        # another client expunged 2 and added 3.
+        store.count_flags_docs.return_value = (2, 2)
+        store.get_all_flags_docs.return_value = [
+            self._fdoc_mock("INBOX", 1, []),
+            self._fdoc_mock("INBOX", 3, [])]
+        memstore.reconcile_counts()
+        self.assertEqual(memstore.count_exists("INBOX"), 2)
+        self.assertEqual(memstore.count_unseen("INBOX"), 2)
+        self.assertEqual(memstore.get_uids("INBOX"), [1, 3])
+
+        # the new messages are not in the store yet.
+        self._add("INBOX", 4)
+        store.get_all_flags_docs.reset_mock()
+        memstore.reconcile_counts()
+        self.assertFalse(store.get_all_flags_docs.called)
+        self.assertEqual(memstore.count_exists("INBOX"), 3)
+
+    def testRecentFlagsChanges(self):
+        """
+        Test that the recent flags are written only when they have changed
+        since the last write, and that writing them keeps the set.
+        """
+        memstore = self.memstore
+        memstore.set_recent_flag("INBOX", 3)
+        self.assertEqual(memstore.get_recent_flags("INBOX"), None)
+        memstore.load_recent_flags(
+            "INBOX", {"doc_id": "rdoc", "rev": "rev1", "set": set([1, 2])})
+        self.assertEqual(memstore.get_recent_flags("INBOX"), set([1, 2, 3]))
+
+        rdoc, = list(memstore.all_rdocs_iter())
+        self.assertEqual(rdoc.doc_id, "rdoc")
+        self.assertEqual(rdoc.rev, "rev1")
+        self.assertEqual(rdoc.content["rct"], [1, 2, 3])
+        self.assertEqual(memstore.get_recent_flags("INBOX"), set([1, 2, 3]))
+
+        # nothing to write while the write is in flight...
+        memstore.unset_recent_flags("INBOX", [1])
+        self.assertEqual(list(memstore.all_rdocs_iter()), [])
+        memstore.set_rflags_rev("INBOX", "rdoc", "rev2")
+        memstore.confirm_recent_flags("INBOX")
+        rdoc, = list(memstore.all_rdocs_iter())
+        self.assertEqual(rdoc.rev, "rev2")
+        self.assertEqual(rdoc.content["rct"], [2, 3])
+
+        # ...and if it fails, the changes are written in the next round.
+        memstore.restore_recent_flags("INBOX")
+        rdoc, = list(memstore.all_rdocs_iter())
+        self.assertEqual(rdoc.content["rct"], [2, 3])
+        memstore.confirm_recent_flags("INBOX")
+
+        # changes that undo each other are not written.
+        memstore.set_recent_flag("INBOX", 4)
+        memstore.unset_recent_flag("INBOX", 4)
+        memstore.set_recent_flags("INBOX", [2, 3])
+        self.assertEqual(list(memstore.all_rdocs_iter()), [])
+
+
+class MessageJournalTestCase(unittest.TestCase):
+    """
+    Tests for the write-ahead journal of the MemoryStore.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="leap_tests-")
+        self.path = os.path.join(self.tempdir, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _fdoc(self, uid, flags=None):
+        return {"mbox": "INBOX", "uid": uid, "flags": flags or []}
+
+    def testPendingSurvivesReopen(self):
+        """
+        Test that the records not marked as done are read back, and that
+        a put after a create is still replayed as a create.
+        """
+        journal = MessageJournal(self.path, sync=False)
+        journal.append("create", "INBOX", 1, {"fdoc": self._fdoc(1)})
+        journal.append("create", "INBOX", 2, {"fdoc": self._fdoc(2)})
+        journal.append("put", "INBOX", 1,
+                       {"fdoc": self._fdoc(1, ["\\Seen"])})
+        journal.mark_done("INBOX", 2)
+        journal.close()
+
+        pending = MessageJournal(self.path).pending()
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(pending[0].op, "create")
+        self.assertEqual(pending[0].content["fdoc"]["flags"], ["\\Seen"])
+
+    def testAppendMany(self):
+        """
+        Test that several records can be appended at once.
+        """
+        journal = MessageJournal(self.path, sync=False)
+        journal.append_many(
+            ("create", "INBOX", uid, {"fdoc": self._fdoc(uid)})
+            for uid in (1, 2, 3))
+        journal.close()
+
+        pending = MessageJournal(self.path).pending()
+        self.assertEqual([r.uid for r in pending], [1, 2, 3])
+
+    def testTruncatedRecordIsDiscarded(self):
+        """
+        Test that a partially written record at the end is ignored.
+        """
+        journal = MessageJournal(self.path, sync=False)
+        journal.append("create", "INBOX", 1, {"fdoc": self._fdoc(1)})
+        journal.append("create", "INBOX", 2, {"fdoc": self._fdoc(2)})
+        journal.close()
+        with open(self.path, "r+b") as fd:
+            fd.truncate(os.path.getsize(self.path) - 3)
+
+        pending = MessageJournal(self.path).pending()
+        self.assertEqual([r.uid for r in pending], [1])
+
+    def testReplayIntoMemoryStore(self):
+        """
+        Test that the MemoryStore replays the pending records as new
+        messages, and marks them as done once they are written.
+        """
+        journal = MessageJournal(self.path, sync=False)
+        journal.append("create", "INBOX", 7, {"fdoc": self._fdoc(7)})
+
+        memstore = MemoryStore(journal=journal)
+        self.assertEqual(memstore.get_uids("INBOX"), [7])
+        self.assertEqual(memstore.count_new_mbox("INBOX"), 1)
+        memstore.set_last_soledad_uid("INBOX", 3)
+        self.assertEqual(memstore.get_last_soledad_uid("INBOX"), 7)
+
+        memstore.unset_new(("INBOX", 7))
+        self.assertEqual(journal.pending(), [])
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def testRemovedIsNotReplayed(self):
+        """
+        Test that the pending records of an expunged message are dropped
+        from the journal.
+        """
+        journal = MessageJournal(self.path, sync=False)
+        memstore = MemoryStore(journal=journal)
+        memstore.create_message(
+            "INBOX", 1, MessageWrapper(fdoc=self._fdoc(1, ["\\Deleted"])),
+            observer=defer.Deferred(), notify_on_disk=False)
+        self.assertEqual(memstore.remove_all_deleted("INBOX"), [1])
+        self.assertEqual(journal.pending(), [])
+        journal.close()
+
+        self.assertEqual(MessageJournal(self.path).pending(), [])
+
+    def testCompaction(self):
+        """
+        Test that the journal file is rewritten with only the pending
+        records once it goes beyond the compaction size, and that a put
+        keeps the parts of the create it follows.
+        """
+        journal = MessageJournal(self.path, sync=False, compact_size=1024)
+        journal.append("create", "INBOX", 1,
+                       {"fdoc": self._fdoc(1), "hdoc": {"chash": "c1"}})
+        journal.append("put", "INBOX", 1,
+                       {"fdoc": self._fdoc(1, ["\\Seen"]), "hdoc": None})
+        for uid in range(2, 50):
+            journal.append("create", "INBOX", uid, {"fdoc": self._fdoc(uid)})
+            journal.mark_done("INBOX", uid)
+        self.assertTrue(os.path.getsize(self.path) < 1024)
+        journal.close()
+
+        pending = MessageJournal(self.path).pending()
+        self.assertEqual([r.uid for r in pending], [1])
+        self.assertEqual(pending[0].op, "create")
+        self.assertEqual(pending[0].content["fdoc"]["flags"], ["\\Seen"])
+        self.assertEqual(pending[0].content["hdoc"], {"chash": "c1"})
+
+
+class PayloadCacheTestCase(unittest.TestCase):
+    """
+    Tests for the shared payload cache.
+    """
+
+    def testBoundedLRU(self):
+        """
+        Test that the least recently used payloads are evicted when going
+        over the size bound, and that hits and misses are counted.
+        """
+        cache = PayloadCache(max_size=10)
+        cache.put("a", "1234")
+        cache.put("b", "5678")
+        self.assertEqual(cache.get("a").payload, "1234")
+        cache.put("c", "90ab")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("c").payload, "90ab")
+        cache.put("huge", "x" * 11)
+        self.assertEqual(cache.get("huge"), None)
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 2))
+        self.assertEqual(stats["size"], 8)
+
+    def testGetFromSoledad(self):
+        """
+        Test that soledad is queried only once for the same payload hash,
+        and that the content-type is taken from the full header.
+        """
+        soledad = Mock()
+        soledad.get_from_index.return_value = [Mock(content={
+            "raw": "hello", "content-type": "text/plain; charset=utf-8",
+            "ctype": "text/plain"})]
+        cache = PayloadCache()
+        for i in range(3):
+            cached = cache.get_from_soledad(soledad, "phash")
+        self.assertEqual(cached.payload, "hello")
+        self.assertEqual(cached.ctype, "text/plain; charset=utf-8")
+        self.assertEqual(soledad.get_from_index.call_count, 1)
+
+
+class SoledadStoreTestCase(unittest.TestCase):
+    """
+    Tests for the batched writes of the SoledadStore.
+    """
+
+    def _queue(self, *uids):
+        queue = Queue.Queue()
+        for uid in uids:
+            queue.put(MessageWrapper(
+                fdoc={"mbox": "INBOX", "uid": uid, "flags": []},
+                new=True))
+        return queue
+
+    def _soledad(self):
+        return Mock(spec=["create_doc", "put_doc", "get_doc", "delete_doc",
+                          "get_from_index"])
+
+    @deferred(timeout=5)
+    def testBatchedWrites(self):
+        """
+        Test that the queued messages are written in batches, and that the
+        result is reported back for each one of them.
+        """
+        soledad = self._soledad()
+        store = SoledadStore(soledad, batch_size=2, batch_latency=0)
+        store._unset_new_dirty = Mock()
+        store._consume_batch = Mock(wraps=store._consume_batch)
+
+        store.consume(self._queue(1, 2, 3))
+
+        def check(_):
+            self.assertEqual(store._consume_batch.call_count, 2)
+            self.assertEqual(soledad.create_doc.call_count, 3)
+            written = [c[0][0].fdoc.content["uid"]
+                       for c in store._unset_new_dirty.call_args_list]
+            self.assertEqual(written, [1, 2, 3])
+
+        # the lock is released only when the previous batches are done.
+        return store._batch_lock.run(lambda: None).addCallback(check)
+
+    @deferred(timeout=5)
+    def testBatchErrorsPerMessage(self):
+        """
+        Test that a failed write only affects its own message, and that
+        only the failed parts are retried.
+        """
+        soledad = self._soledad()
+        soledad.create_doc.side_effect = [Exception("boom"), None, None]
+        store = SoledadStore(soledad, batch_size=10, batch_latency=0)
+        store._unset_new_dirty = Mock()
+
+        store.consume(self._queue(1, 2))
+
+        def check_failed(_):
+            self.assertEqual(store._unset_new_dirty.call_count, 1)
+            wrapper = store._unset_new_dirty.call_args[0][0]
+            self.assertEqual(wrapper.fdoc.content["uid"], 2)
+            self.assertEqual(store.stats()["failed"], 1)
+            self.assertEqual(store.stats()["retry_queue"], 1)
+
+            # the message is not written again while it is being retried.
+            store.consume(self._queue(1))
+            self.assertEqual(store._batch, [])
+
+            store._retry_calls[("INBOX", 1)].cancel()
+            return store._retry(("INBOX", 1))
+
+        def check_retried(_):
+            self.assertEqual(soledad.create_doc.call_count, 3)
+            self.assertEqual(store._unset_new_dirty.call_count, 2)
+            stats = store.stats()
+            self.assertEqual(stats["written"], 2)
+            self.assertEqual(stats["retried"], 1)
+            self.assertEqual(stats["retry_queue"], 0)
+
+        d = store._batch_lock.run(lambda: None)
+        d.addCallback(check_failed)
+        d.addCallback(check_retried)
+        return d
+
+    @deferred(timeout=5)
+    def testRetrySuperseded(self):
+        """
+        Test that a message that changes while its write is being retried
+        is requeued instead of being marked as clean, and that the memory
+        store is told when we give up writing a message.
+        """
+        from leap.mail.imap.soledadstore import WRITE_MAX_RETRIES
+        soledad = self._soledad()
+        soledad.create_doc.side_effect = [
+            Exception("boom"), Exception("boom"), None]
+        store = SoledadStore(soledad, batch_size=10, batch_latency=0)
+        store._unset_new_dirty = Mock()
+        memstore = Mock()
+
+        def queue(*uids):
+            queue = self._queue(*uids)
+            for wrapper in queue.queue:
+                wrapper.memstore = memstore
+            return queue
+
+        store.consume(queue(1, 2))
+
+        def check_superseded(_):
+            store.consume(queue(1))
+            store._retry_calls.pop(("INBOX", 1)).cancel()
+            return store._retry(("INBOX", 1))
+
+        def check_requeued(_):
+            memstore.requeue_message.assert_called_once_with("INBOX", 1)
+            self.assertFalse(store._unset_new_dirty.called)
+
+            # we give up on the other message.
+            store._retry_calls.pop(("INBOX", 2)).cancel()
+            entry = store._retries[("INBOX", 2)]
+            store._schedule_retry(
+                entry._replace(attempts=WRITE_MAX_RETRIES))
+            self.assertEqual(memstore.write_failed.call_count, 1)
+            self.assertEqual(memstore.write_failed.call_args[0][0],
+                             ("INBOX", 2))
+            self.assertEqual(store.stats()["given_up"], 1)
+            self.assertEqual(store.stats()["retry_queue"], 0)
+
+        d = store._batch_lock.run(lambda: None)
+        d.addCallback(check_superseded)
+        d.addCallback(check_requeued)
+        return d
+
+    @deferred(timeout=5)
+    def testRetryWholeMessage(self):
+        """
+        Test that a message whose write fails before any of its parts is
+        written is retried as a whole, and that flushing the memory store
+        waits for it.
+        """
+        from leap.mail.imap import soledadstore
+        self.patch(soledadstore, "WRITE_RETRY_DELAY", 0.01)
+        soledad = self._soledad()
+        store = SoledadStore(soledad, batch_size=10, batch_latency=0)
+        process = store._process
+        calls = []
+
+        def fail_first(doc_wrapper):
+            calls.append(doc_wrapper)
+            if len(calls) == 1:
+                raise Exception("boom")
+            return process(doc_wrapper)
+        store._process = fail_first
+
+        memstore = MemoryStore(permanent_store=store, write_period=60)
+        self.addCleanup(memstore.producer.stop)
+        self.addCleanup(memstore._stop_write_loop)
+        memstore.create_message(
+            "INBOX", 1, MessageWrapper(fdoc={
+                "type": "flags", "mbox": "INBOX", "uid": 1, "flags": [],
+                "chash": "chash-1", "size": 42, "multi": False}),
+            observer=defer.Deferred(), notify_on_disk=False)
+
+        def check(_):
+            self.assertEqual(len(calls), 2)
+            self.assertEqual(soledad.create_doc.call_count, 1)
+            self.assertEqual(memstore.count_new_mbox("INBOX"), 0)
+            stats = store.stats()
+            self.assertEqual(stats["retried"], 1)
+            self.assertEqual(stats["retry_queue"], 0)
+
+        return memstore.flush().addCallback(check)
+
+    def _dirty_wrapper(self, rev):
+        memstore = Mock()
+        memstore.get_docid_for_fdoc.return_value = "fdoc-id"
+        memstore.get_fdoc_rev.return_value = ("fdoc-id", rev)
+        wrapper = MessageWrapper(
+            fdoc={"type": "flags", "mbox": "INBOX", "uid": 1,
+                  "flags": ["\\Seen"]},
+            new=False, dirty=True, docs_id={"fdoc": "fdoc-id"},
+            memstore=memstore)
+        return wrapper, memstore
+
+    def testPutDirtyFdocFromCachedRev(self):
+        """
+        Test that a dirty flags document is put using the cached revision,
+        without getting it from soledad first.
+        """
+        soledad = self._soledad()
+        store = SoledadStore(soledad)
+        wrapper, memstore = self._dirty_wrapper("rev-1")
+
+        self.assertEqual(store._consume_doc(wrapper), wrapper)
+        self.assertFalse(soledad.get_doc.called)
+        doc = soledad.put_doc.call_args[0][0]
+        self.assertEqual((doc.doc_id, doc.rev), ("fdoc-id", "rev-1"))
+        self.assertEqual(doc.content["flags"], ["\\Seen"])
+        memstore.set_fdoc_rev.assert_called_with(
+            "INBOX", 1, "fdoc-id", "rev-1")
+
+    def testPutDirtyFdocConflict(self):
+        """
+        Test that we get the current document when the cached revision
+        is out of date.
+        """
+        from u1db.errors import RevisionConflict
+        soledad = self._soledad()
+        soledad.put_doc.side_effect = [RevisionConflict(), None]
+        current = Mock()
+        current.doc_id, current.rev = "fdoc-id", "rev-2"
+        soledad.get_doc.return_value = current
+        store = SoledadStore(soledad)
+        wrapper, memstore = self._dirty_wrapper("rev-1")
+
+        self.assertEqual(store._consume_doc(wrapper), wrapper)
+        self.assertEqual(soledad.put_doc.call_count, 2)
+        soledad.get_doc.assert_called_once_with("fdoc-id")
+        self.assertEqual(current.content["flags"], ["\\Seen"])
+
+    @deferred(timeout=5)
+    def testRemoveAllDeleted(self):
+        """
+        Test that the deleted messages are removed from soledad, reporting
+        the progress.
+        """
+        soledad = self._soledad()
+        soledad.get_from_index.return_value = [
+            Mock(content={"uid": uid}) for uid in (1, 2, 3)]
+        store = SoledadStore(soledad)
+        progress = []
+
+        def check(deleted):
+            self.assertEqual(deleted, [1, 2, 3])
+            self.assertEqual(soledad.delete_doc.call_count, 3)
+            self.assertEqual(progress, [(3, 3)])
+
+        d = defer.maybeDeferred(
+            store.remove_all_deleted, "INBOX",
+            progress=lambda *args: progress.append(args))
+        d.addCallback(check)
+        return d
+
+    @deferred(timeout=5)
+    def testRemoveAllDeletedFailed(self):
+        """
+        Test that, when a deletion fails, the messages deleted before it
+        are reported as deleted and the rest are left for the next time.
+        """
+        from leap.mail.imap import soledadstore
+        self.patch(soledadstore, "EXPUNGE_PROGRESS_STEP", 2)
+        soledad = self._soledad()
+        soledad.get_from_index.return_value = [
+            Mock(content={"uid": uid}) for uid in (1, 2, 3, 4)]
+        soledad.delete_doc.side_effect = [None, None, None, Exception("boom")]
+        store = SoledadStore(soledad)
+        progress = []
+
+        def check(deleted):
+            self.assertEqual(deleted, [1, 2, 3])
+            self.assertEqual(soledad.delete_doc.call_count, 4)
+            self.assertEqual(progress, [(2, 4)])
+
+        d = defer.maybeDeferred(
+            store.remove_all_deleted, "INBOX",
+            progress=lambda *args: progress.append(args))
+        d.addCallback(check)
+        return d
+
+    @deferred(timeout=5)
+    def testKnownHashes(self):
+        """
+        Test that the dedup checks are answered from the known hashes once
+        they are loaded, and that the written documents are added to them.
+        """
+        soledad = Mock()
+        soledad.get_index_keys.side_effect = [
+            [("head", "chash1"), ("flags", "chash2")],
+            [("cnt", "phash1")]]
+        soledad.get_from_index.return_value = []
+        store = SoledadStore(soledad)
+
+        def check(_):
+            self.assertTrue(store._header_does_exist({"chash": "chash1"}))
+            self.assertFalse(store._header_does_exist({"chash": "chash2"}))
+            self.assertTrue(store._content_does_exist({"phash": "phash1"}))
+            self.assertFalse(soledad.get_from_index.called)
+
+            store.add_known_hash({"type": "cnt", "phash": "phash2"})
+            self.assertTrue(store._content_does_exist({"phash": "phash2"}))
+            store.forget_known_hash({"type": "head", "chash": "chash1"})
+            self.assertFalse(store._header_does_exist({"chash": "chash1"}))
+
+        d = defer.maybeDeferred(store.load_known_hashes)
+        d.addCallback(check)
+        return d
+
+
+class OrphanCollectorTestCase(unittest.TestCase):
+    """
+    Tests for the collector of orphaned header and content documents.
+    """
+
+    def setUp(self):
+        doc = lambda **content: Mock(content=content)
+        self.hdocs = [
+            doc(type="head", chash="chash1", body="phash1",
+                part_map={1: {"phash": "phash2"}}),
+            doc(type="head", chash="chash2", body="phash3")]
+        self.cdocs = dict(
+            (phash, doc(type="cnt", phash=phash))
+            for phash in ("phash1", "phash2", "phash3", "phash4"))
+
+        soledad = Mock()
+        soledad.get_index_keys.side_effect = lambda index: {
+            "by-type-and-contenthash": [
+                ("flags", "chash1"), ("head", "chash1"), ("head", "chash2")],
+            "by-type-and-payloadhash": [
+                ("cnt", phash) for phash in self.cdocs]}[index]
+
+        def get_from_index(index, *values):
+            if index == "by-type":
+                return self.hdocs
+            return [self.cdocs[values[-1]]]
+
+        soledad.get_from_index.side_effect = get_from_index
+        self.soledad = soledad
+
+    @deferred(timeout=5)
+    def testDryRun(self):
+        """
+        Test that the dry-run mode, the default one, reports the orphans
+        without deleting them.
+        """
+        collector = OrphanCollector(self.soledad)
+
+        def check(report):
+            self.assertEqual(report["headers"], ["chash2"])
+            self.assertEqual(report["contents"], ["phash3", "phash4"])
+            self.assertEqual(report["deleted"], 0)
+            self.assertFalse(self.soledad.delete_doc.called)
+
+        return collector.collect().addCallback(check)
+
+    @deferred(timeout=5)
+    def testCollect(self):
+        """
+        Test that the orphans are deleted, except the ones referred to
+        by pending messages, and forgotten by the dedup check.
+        """
+        memstore = Mock()
+        memstore.all_new_dirty_msg_iter.return_value = [Mock(
+            fdoc=Mock(content={"chash": "chash3"}),
+            hdoc=Mock(content={"body": "phash4"}), cdocs={})]
+        soledad_store = Mock()
+        collector = OrphanCollector(
+            self.soledad, memstore=memstore, soledad_store=soledad_store,
+            rate=10000, dry_run=False)
+
+        def check(report):
+            self.assertEqual(report["deleted"], 2)
+            deleted = [c[0][0] for c in
+                       self.soledad.delete_doc.call_args_list]
+            self.assertEqual(
+                sorted(d.content.get("chash", d.content.get("phash"))
+                       for d in deleted), ["chash2", "phash3"])
+            self.assertEqual(soledad_store.forget_known_hash.call_count, 2)
+
+        return collector.collect().addCallback(check)
+
+
+class FakeSoledadTestCase(unittest.TestCase):
+    """
+    Tests for the fake soledad used for benchmarks.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix="leap_tests-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _soledad(self, **kwargs):
+        soledad = FakeSoledad(**kwargs)
+        for name, expression in fields.INDEXES.items():
+            soledad.create_index(name, *expression)
+        return soledad
+
+    def _write_message(self, soledad):
+        store = SoledadStore(soledad)
+        wrapper = MessageWrapper(
+            fdoc={"type": "flags", "mbox": "INBOX", "uid": 1,
+                  "chash": "chash1", "flags": [], "seen": False,
+                  "deleted": False, "recent": True},
+            hdoc={"type": "head", "chash": "chash1", "body": "phash1"},
+            new=True)
+        self.assertEqual(store._consume_doc(wrapper), wrapper)
+        return store
+
+    def testIndexes(self):
+        """
+        Test that the documents written by the SoledadStore can be found
+        through the indexes, in memory and in a SQLite file.
+        """
+        for path in (None, os.path.join(self.tempdir, "fake.db")):
+            soledad = self._soledad(path=path)
+            store = self._write_message(soledad)
+            fdoc = store.get_flags_doc("INBOX", 1)
+            self.assertEqual(fdoc.content["chash"], "chash1")
+            self.assertTrue(store._header_does_exist({"chash": "chash1"}))
+            self.assertEqual(soledad.get_count_from_index(
+                fields.TYPE_MBOX_IDX, "flags", "INBOX"), 1)
+            soledad.close()
+
+    def testLatency(self):
+        """
+        Test that the calls are counted, and take the configured latency.
+        """
+        soledad = self._soledad(latency=0.01, latencies={"sync": 0})
+        self.assertEqual(soledad.calls["create_index"],
+                         len(fields.INDEXES))
+        start = time.time()
+        self._write_message(soledad)
+        self.assertTrue(time.time() - start >= 0.01 * (
+            soledad.calls["create_doc"] + soledad.calls["get_from_index"]))
+        self.assertEqual(soledad.calls["create_doc"], 2)
+        soledad.sync()
+        self.assertEqual(soledad.calls["sync"], 1)
+
+
+class LeapMessageTestCase(unittest.TestCase):
+    """
+    Tests for the documents cached by a LeapMessage.
+    """
+
+    def setUp(self):
+        self.soledad = FakeSoledad()
+        for name, expression in fields.INDEXES.items():
+            self.soledad.create_index(name, *expression)
+        self.soledad.create_doc(
+            {"type": "flags", "mbox": "INBOX", "uid": 1, "chash": "chash1",
+             "flags": [], "seen": False, "deleted": False, "size": 42,
+             "multi": False})
+        self.soledad.create_doc(
+            {"type": "head", "chash": "chash1",
+             "headers": {"Subject": "hello"}, "body": "phash1"})
+        self.memstore = MemoryStore()
+        self.collection = Mock(memstore=self.memstore, recent_flags=set())
+
+    def testDocsLoadedOnce(self):
+        """
+        Test that the documents are queried only once per message, and that
+        the flags are loaded again when the message changes in the memory
+        store.
+        """
+        msg = LeapMessage(self.soledad, 1, "INBOX",
+                          collection=self.collection)
+        for i in range(3):
+            self.assertTrue(msg.does_exist())
+            self.assertEqual(msg.getFlags(), ())
+            self.assertEqual(msg.getSize(), 42)
+            self.assertFalse(msg.isMultipart())
+            self.assertEqual(msg["chash"], "chash1")
+            self.assertEqual(msg.getHeaders(False, "subject"),
+                             {"Subject": "hello"})
+        self.assertEqual(self.soledad.calls["get_from_index"], 2)
+
+        self.memstore.put_message(
+            "INBOX", 1, MessageWrapper(
+                fdoc={"type": "flags", "mbox": "INBOX", "uid": 1,
+                      "chash": "chash1", "flags": ["\\Seen"], "size": 42},
+                new=False, dirty=True),
+            notify_on_disk=False)
+        self.assertEqual(msg.getFlags(), ("\\Seen",))
+        self.assertEqual(msg.getSize(), 42)
+        self.assertEqual(self.soledad.calls["get_from_index"], 2)
+
+    def testCachedDocsOutliveChanges(self):
+        """
+        Test that the cached headers of a message held in the memory store
+        are still valid after the message changes there, or is evicted.
+        """
+        import gc
+        fdoc = {"type": "flags", "mbox": "INBOX", "uid": 2,
+                "chash": "chash2", "flags": [], "size": 42}
+        self.memstore.create_message(
+            "INBOX", 2, MessageWrapper(
+                fdoc=fdoc, hdoc={"type": "head", "chash": "chash2",
+                                 "headers": {"Subject": "hi"}}),
+            observer=defer.Deferred(), notify_on_disk=False)
+        msg = LeapMessage(
+            self.soledad, 2, "INBOX", collection=self.collection,
+            container=self.memstore.get_message("INBOX", 2))
+        self.assertEqual(msg.getHeaders(False, "subject"),
+                         {"Subject": "hi"})
+
+        self.memstore.put_message(
+            "INBOX", 2, MessageWrapper(
+                fdoc=dict(fdoc, flags=["\\Seen"]), new=False, dirty=True),
+            notify_on_disk=False)
+        self.assertEqual(msg.getFlags(), ("\\Seen",))
+        gc.collect()
+        self.assertEqual(msg.getHeaders(False, "subject"),
+                         {"Subject": "hi"})
+
+        self.memstore.remove_message("INBOX", 2)
+        gc.collect()
+        self.assertEqual(msg.getHeaders(False, "subject"),
+                         {"Subject": "hi"})
+
+
+class BulkAddTestCase(unittest.TestCase):
+    """
+    Tests for adding messages in bulk to a MessageCollection.
+    """
+
+    def setUp(self):
+        self.soledad = FakeSoledad()
+        self.memstore = MemoryStore()
+        self.messages = MessageCollection(
+            "INBOX", self.soledad, memstore=self.memstore)
+        # as SoledadMailbox does when it is created.
+        self.memstore.set_last_soledad_uid("INBOX", 0)
+
+    @deferred(timeout=5)
+    def testAddMsgs(self):
+        """
+        Test that the messages get consecutive UIDs in the given order, and
+        that the duplicates get the UID of the first copy.
+        """
+        raw = "From: me@example.com\nSubject: %s\n\nBody %s\n"
+        msgs = [raw % ("one", 1), (raw % ("two", 2), ("\\Seen",)),
+                raw % ("one", 1), raw % ("three", 3)]
+
+        def check(uids):
+            self.assertEqual(uids, [1, 2, 1, 3])
+            self.assertEqual(self.memstore.get_last_uid("INBOX"), 3)
+            self.assertEqual(self.memstore.count_new_mbox("INBOX"), 3)
+            self.assertEqual(self.messages.count(), 3)
+            msg = self.messages.get_msg_by_uid(2)
+            self.assertEqual(msg.getHeaders(False, "subject"),
+                             {"Subject": "two"})
+            self.assertTrue("\\Seen" in msg.getFlags())
+
+        d = self.messages.add_msgs(msgs)
+        d.addCallback(check)
+        return d
+
+    def testBuildMsgDocsInPool(self):
+        """
+        Test that the documents built in a worker process are the same as
+        the ones built in this one.
+        """
+        raw = ("From: me@example.com\nSubject: parts\n"
+               "Content-Type: multipart/mixed; boundary=XX\n\n"
+               "--XX\nContent-Type: text/plain\n\nBody\n"
+               "--XX\nContent-Type: text/html\n\n<p>Body</p>\n--XX--\n")
+        args = [("INBOX", raw, ("\\Seen",), None, None),
+                ("INBOX", "From: me@example.com\n\nPlain\n", (), "s", None)]
+        pool = new_parse_pool(1)
+        self.addCleanup(pool.terminate)
+
+        built = pool.map(build_msg_docs, args)
+        self.assertEqual(built, map(build_msg_docs, args))
+        chash, fd, hd, cdocs = built[0]
+        self.assertEqual(fd[fields.CONTENT_HASH_KEY], chash)
+        self.assertTrue(fd[fields.MULTIPART_KEY])
+        self.assertEqual(len(cdocs), 2)
+
+    @deferred(timeout=5)
+    def testAddMsg(self):
+        """
+        Test that add_msg fires with the UID of the new message.
+        """
+        d = self.messages.add_msg("From: me@example.com\n\nBody\n")
+        d.addCallback(self.assertEqual, 1)
+        return d
+
+
+class WalkTestCase(unittest.TestCase):
+    """
+    Tests for the utilities that walk along a message tree.
+    """
+
+    corpus = ('rfc822.message',
+              'rfc822.plain.message',
+              'rfc822.multi.message',
+              'rfc822.multi-minimal.message',
+              'rfc822.multi-signed.message')
+
+    def _parse(self, name):
+        return parser.Parser().parse(open(util.sibpath(__file__, name)))
+
+    def testAnalyzeMsg(self):
+        """
+        Test that analyze_msg gives the same hashes, sizes, parts and raw
+        docs as serializing and walking the message several times.
+        """
+        for name in self.corpus:
+            analysis = walk.analyze_msg(self._parse(name))
+
+            msg = self._parse(name)
+            raw = msg.as_string()
+            multi = msg.is_multipart()
+            body_phash_fun = [walk.get_body_phash_simple,
+                              walk.get_body_phash_multi][int(multi)]
+            parts = walk.get_parts(msg)
+
+            self.assertEqual(analysis.chash,
+                             hashlib.sha256(raw).hexdigest(), name)
+            self.assertEqual(analysis.size, len(raw), name)
+            self.assertEqual(analysis.multi, multi, name)
+            self.assertEqual(analysis.parts, parts, name)
+            self.assertEqual(analysis.body_phash,
+                             body_phash_fun(walk.get_payloads(msg)), name)
+            self.assertEqual(analysis.raw_docs,
+                             list(walk.get_raw_docs(msg, parts)), name)
+
+    def testWalkMsgTree(self):
+        """
+        Test that walk_msg_tree builds the same parts map as the quadratic
+        implementation it replaced.
+        """
+        digest = MIMEMultipart("digest")
+        for i in range(50):
+            alternative = MIMEMultipart("alternative")
+            alternative.attach(MIMEText("part %s" % (i,)))
+            alternative.attach(MIMEText("<p>part %s</p>" % (i,), "html"))
+            digest.attach(alternative)
+        digest.attach(MIMEText("the end"))
+
+        msgs = [self._parse(name) for name in self.corpus] + [digest]
+        for msg in msgs:
+            self.assertEqual(compare_walks(msg)[0], "equal")
+
+    def testWalkMsgTreeRepeatedParts(self):
+        """
+        Test that walk_msg_tree keeps a part that is repeated in a nested
+        multipart in its place.
+        """
+        inner = MIMEMultipart()
+        inner.attach(MIMEText("repeated"))
+        inner.attach(MIMEText("last"))
+        middle = MIMEMultipart()
+        middle.attach(MIMEText("repeated"))
+        middle.attach(inner)
+        msg = MIMEMultipart()
+        msg.attach(MIMEText("first"))
+        msg.attach(middle)
+
+        # the old implementation removed the first repeated part instead.
+        self.assertEqual(compare_walks(msg)[0], "removal")
+
+        analysis = walk.analyze_msg(msg)
+        pdoc = walk.walk_msg_tree(analysis.parts, analysis.body_phash)
+        pmap = pdoc["part_map"][2]["part_map"]
+        self.assertEqual(pmap[0]["phash"], walk.get_hash("repeated"))
+        self.assertEqual(
+            [pmap[1]["part_map"][i]["phash"] for i in (1, 2)],
+            [walk.get_hash("repeated"), walk.get_hash("last")])
+
+
 class LeapIMAP4ServerTestCase(IMAP4HelperMixin, unittest.TestCase):
 
     """
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# walkcompare.py
+# Copyright (C) 2014 LEAP
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compare walk.walk_msg_tree with the implementation it replaced.
+
+Pass it message files, mbox files or directories (Maildirs, or any tree of
+message files), and it checks that both build the same parts map for every
+message, and how long they take:
+
+    python walkcompare.py ~/Maildir some.mbox rfc822.multi.message
+
+It exits with status 1 if any message gives a different parts map, other
+than the ones where the old implementation removes the wrong subparts (see
+`walk_msg_tree_reference`), which are only reported.
+"""
+import copy
+import mailbox
+import os
+import sys
+import time
+
+from email import parser
+
+from leap.mail import walk as W
+
+
+def walk_msg_tree_reference(parts, body_phash=None, fix_removal=False):
+    """
+    The quadratic implementation of `walk.walk_msg_tree`, as it was before
+    being rewritten as a single pass, without its debug output.
+
+    It removes the collapsed subparts from the sequence by equality, so
+    when a subpart is equal to an earlier part (the same attachment twice,
+    for instance) it removes the wrong one. The single pass does not have
+    that problem.
+
+    See `walk.walk_msg_tree` for parameter info.
+
+    :param fix_removal: if True, remove the subparts by position instead.
+    :type fix_removal: bool
+    """
+    PART_MAP = "part_map"
+    MULTI = "multi"
+    HEADERS = "headers"
+    PHASH = "phash"
+    BODY = "body"
+
+    # parts vector
+    pv = list(W.get_parts_vector(parts))
+
+    inner_headers = parts[1].get(HEADERS, None) if (
+        len(parts) == 2) else None
+
+    # wrappers vector
+    def getwv(pv):
+        return [True if pv[i] != 1 and pv[i + 1] == 1 else False
+                for i in range(len(pv) - 1)]
+    wv = getwv(pv)
+
+    # do until no wrapper document is left
+    while any(wv):
+        wind = wv.index(True)  # wrapper index
+        nsub = pv[wind]  # number of subparts to pick
+        slic = parts[wind + 1:wind + 1 + nsub]  # slice with subparts
+
+        cwra = {
+            MULTI: True,
+            PART_MAP: dict((index + 1, part)  # content wrapper
+                           for index, part in enumerate(slic)),
+            HEADERS: dict(parts[wind][HEADERS])
+        }
+
+        # remove subparts and substitue wrapper
+        if fix_removal:
+            del parts[wind + 1:wind + 1 + nsub]
+        else:
+            map(lambda i: parts.remove(i), slic)
+        parts[wind] = cwra
+
+        # refresh vectors for this iteration
+        pv = list(W.get_parts_vector(parts))
+        wv = getwv(pv)
+
+    if all(x == 1 for x in pv):
+        # special case in the rightmost element
+        main_pmap = parts[0].get(PART_MAP, None)
+        if main_pmap is not None:
+            last_part = max(main_pmap.keys())
+            main_pmap[last_part][PART_MAP] = {}
+            for partind in range(len(pv) - 1):
+                main_pmap[last_part][PART_MAP][partind] = parts[partind + 1]
+
+    outer = parts[0]
+    outer.pop(HEADERS)
+    if PART_MAP not in outer:
+        # we have a multipart with 1 part only, so kind of fix it
+        # although it would be prettier if I take this special case at
+        # the beginning of the walk.
+        pdoc = {MULTI: True,
+                PART_MAP: {1: outer}}
+        pdoc[PART_MAP][1][MULTI] = False
+        if not pdoc[PART_MAP][1].get(PHASH, None):
+            pdoc[PART_MAP][1][PHASH] = body_phash
+        if inner_headers:
+            pdoc[PART_MAP][1][HEADERS] = inner_headers
+    else:
+        pdoc = outer
+    pdoc[BODY] = body_phash
+    return pdoc
+
+
+def iter_messages(path):
+    """
+    Iterate over the messages found in a path.
+
+    :param path: a message file, a mbox file, or a directory
+    :type path: str
+    :return: tuples with the name and the parsed message
+    :rtype: iterator
+    """
+    p = parser.Parser()
+    if os.path.isdir(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                name = os.path.join(dirpath, filename)
+                with open(name) as fd:
+                    yield name, p.parse(fd)
+        return
+
+    with open(path) as fd:
+        is_mbox = fd.read(5) == "From "
+    if not is_mbox:
+        with open(path) as fd:
+            yield path, p.parse(fd)
+        return
+    for key, msg in mailbox.mbox(path, factory=None).iteritems():
+        yield "%s:%s" % (path, key), msg
+
+
+def compare(msg):
+    """
+    Build the parts map of a message with both implementations.
+
+    :param msg: a parsed message
+    :type msg: Message
+    :return: a tuple with the result ("equal", "removal" if they are only
+             equal removing the subparts by position in the reference, or
+             "different"), and the time taken by the reference and the new
+             implementation.
+    :rtype: tuple
+    """
+    analysis = W.analyze_msg(msg)
+
+    def run(fun, **kwargs):
+        parts = copy.deepcopy(analysis.parts)
+        start = time.time()
+        pdoc = fun(parts, body_phash=analysis.body_phash, **kwargs)
+        return pdoc, time.time() - start
+
+    ref, ref_time = run(walk_msg_tree_reference)
+    new, new_time = run(W.walk_msg_tree)
+    if ref == new:
+        result = "equal"
+    elif run(walk_msg_tree_reference, fix_removal=True)[0] == new:
+        result = "removal"
+    else:
+        result = "different"
+    return result, ref_time, new_time
+
+
+def main(paths):
+    """
+    Compare both implementations on all the messages in some paths.
+
+    :param paths: paths to message files, mbox files or directories
+    :type paths: list
+    :return: the number of messages with different parts maps
+    :rtype: int
+    """
+    total = failed = removal = 0
+    ref_time = new_time = 0
+    for path in paths:
+        for name, msg in iter_messages(path):
+            total += 1
+            try:
+                result, ref, new = compare(msg)
+            except Exception as exc:
+                print "ERROR %s: %r" % (name, exc)
+                failed += 1
+                continue
+            ref_time += ref
+            new_time += new
+            if result == "different":
+                print "DIFFERENT %s" % (name,)
+                failed += 1
+            elif result == "removal":
+                print "REMOVAL %s" % (name,)
+                removal += 1
+            if ref > 0.1:
+                print "SLOW %s: %.3fs -> %.3fs" % (name, ref, new)
+
+    print "%s messages, %s different, %s with wrong removals" % (
+        total, failed, removal)
+    print "reference: %.3fs, walk_msg_tree: %.3fs" % (ref_time, new_time)
+    return failed
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(2)
+    sys.exit(1 if main(sys.argv[1:]) else 0)
@@ -21,6 +21,9 @@ from gc import collect
 from itertools import chain
 from sys import getsizeof
 
+# A rough estimate of the per-item overhead in containers.
+_ITEM_SIZE = getsizeof(0)
+
 
 def _get_size(item, seen):
     known_types = {dict: lambda d: chain.from_iterable(d.items())}
@@ -55,3 +58,28 @@ def get_size(item):
     del seen
     collect()
     return size
+
+
+def get_doc_size(doc):
+    """
+    Return an estimate of the size, in bytes, of a message-part document.
+
+    Unlike `get_size`, this does not keep track of the objects already seen
+    nor collects garbage, so it is cheap enough to be called every time a
+    document is added to a store. It only accounts for the length of the
+    strings and a fixed overhead per item in the containers, which is what
+    dominates the size of our documents. Any other object is measured with
+    `sys.getsizeof`.
+
+    :param doc: the document to estimate the size of
+    :type doc: dict
+    :rtype: int
+    """
+    if isinstance(doc, basestring):
+        return len(doc)
+    if isinstance(doc, dict):
+        return sum(_ITEM_SIZE + get_doc_size(key) + get_doc_size(value)
+                   for key, value in doc.iteritems())
+    if isinstance(doc, (list, tuple, set, frozenset)):
+        return sum(_ITEM_SIZE + get_doc_size(item) for item in doc)
+    return getsizeof(doc, _ITEM_SIZE)
@@ -20,6 +20,10 @@ Utilities for walking along a message tree.
 import hashlib
 import os
 
+from collections import namedtuple
+from cStringIO import StringIO
+from email.generator import Generator
+
 from leap.mail.utils import first
 
 DEBUG = os.environ.get("BITMASK_MAIL_DEBUG")
@@ -85,6 +89,98 @@ get_raw_docs = lambda msg, parts: (
     if not isinstance(payload, list))
 
 
+"""
+A MsgAnalysis keeps everything that we need from a parsed message to build
+its documents: the content hash and size of the whole message, whether it is
+multipart, the interesting parts (as in get_parts), the payload hash of the
+body and the raw docs (as in get_raw_docs).
+"""
+MsgAnalysis = namedtuple(
+    'MsgAnalysis',
+    ['chash', 'size', 'multi', 'parts', 'body_phash', 'raw_docs'])
+
+
+class _SizingGenerator(Generator):
+    """
+    A Generator that remembers the size of every part it flattens.
+
+    The subparts are flattened by clones of the generator, each into its own
+    buffer, and their text is exactly the one that part.as_string() would
+    return. So we get the sizes of all the parts serializing the message
+    only once.
+    """
+
+    def __init__(self, outfp, sizes, mangle_from_=True, maxheaderlen=78):
+        Generator.__init__(self, outfp, mangle_from_, maxheaderlen)
+        self._sizes = sizes
+
+    def clone(self, fp):
+        return self.__class__(
+            fp, self._sizes, self._mangle_from_, self._maxheaderlen)
+
+    def flatten(self, msg, unixfrom=False):
+        Generator.flatten(self, msg, unixfrom)
+        self._sizes[id(msg)] = len(self._fp.getvalue())
+
+
+def analyze_msg(msg):
+    """
+    Get all the information needed to store a parsed message, walking it
+    only once.
+
+    This is equivalent to hashing and measuring msg.as_string(), and calling
+    get_parts, get_body_phash_simple or get_body_phash_multi, and
+    get_raw_docs, but the message is serialized only once, instead of once
+    more for every subpart, and every payload is hashed only once.
+
+    :param msg: a parsed message
+    :type msg: Message
+    :rtype: MsgAnalysis
+    """
+    sizes = {}
+    fp = StringIO()
+    _SizingGenerator(fp, sizes).flatten(msg)
+    raw = fp.getvalue()
+    multi = msg.is_multipart()
+
+    parts = []
+    raw_docs = []
+    body_phash = None
+    for part in msg.walk():
+        payload = part.get_payload()
+        items = part.items()
+        is_multi = part.is_multipart()
+        phash = get_hash(payload) if not is_multi else None
+        parts.append(
+            {'multi': is_multi,
+             'ctype': part.get_content_type(),
+             'size': sizes[id(part)],
+             'parts': len(payload) if isinstance(payload, list) else 1,
+             'headers': items,
+             'phash': phash})
+        if isinstance(payload, list):
+            continue
+
+        headers = dict(((str.lower(k), v) for k, v in items))
+        if body_phash is None and (
+                not multi or
+                "text/plain" in headers.get('content-type', '')):
+            body_phash = phash
+        raw_docs.append(
+            {"type": "cnt",
+             "raw": payload if not DEBUG else payload[:100],
+             "phash": phash,
+             "content-disposition": first(headers.get(
+                 'content-disposition', '').split(';')),
+             "content-type": headers.get(
+                 'content-type', ''),
+             "content-transfer-encoding": headers.get(
+                 'content-transfer-type', '')})
+
+    return MsgAnalysis(hashlib.sha256(raw).hexdigest(), len(raw), multi,
+                       parts, body_phash, raw_docs)
+
+
 def walk_msg_tree(parts, body_phash=None):
     """
     Take a list of interesting items of a message subparts structure,
@@ -93,11 +189,16 @@ def walk_msg_tree(parts, body_phash=None):
 
     It walks down the subparts in the parsed message tree, and collapses
     the leaf docuents into a wrapper document until no multipart submessages
-    are left. To achieve this, it iteratively calculates a wrapper vector of
-    all documents in the sequence that have more than one part and have unitary
-    documents to their right. To collapse a multipart, take as many
-    unitary documents as parts the submessage contains, and replace the object
-    in the sequence with the new wrapper document.
+    are left. A wrapper is a document that has more than one part and a
+    unitary document to its right. To collapse it, take as many documents
+    as parts the submessage contains, and replace the wrapper in the
+    sequence with the new wrapper document, which is unitary.
+
+    The sequence is walked only once, from left to right, keeping the
+    already walked documents in a stack: collapsing a wrapper can only turn
+    the document before it into a new wrapper, and that one is on the top
+    of the stack. So the wrappers are collapsed in the same order as
+    looking always for the leftmost one, but in linear time.
 
     :param parts: A list of dicts containing the interesting properties for
                   the message structure. Normally this has been generated by
@@ -113,41 +214,41 @@ def walk_msg_tree(parts, body_phash=None):
     PHASH = "phash"
     BODY = "body"
 
-    # parts vector
-    pv = list(get_parts_vector(parts))
-
     inner_headers = parts[1].get(HEADERS, None) if (
         len(parts) == 2) else None
 
     if DEBUG:
-        print "parts vector: ", pv
+        print "parts vector: ", list(get_parts_vector(parts))
         print
 
-    # wrappers vector
-    getwv = lambda pv: [True if pv[i] != 1 and pv[i + 1] == 1 else False
-                        for i in range(len(pv) - 1)]
-    wv = getwv(pv)
-
-    # do until no wrapper document is left
-    while any(wv):
-        wind = wv.index(True)  # wrapper index
-        nsub = pv[wind]  # number of subparts to pick
-        slic = parts[wind + 1:wind + 1 + nsub]  # slice with subparts
-
+    nparts = lambda part: part.get('parts', 1)
+
+    # the walked documents, and the sequence that is still to be walked,
+    # from `index` on. A collapsed wrapper is put back in the sequence,
+    # in the place of its last subpart.
+    walked = []
+    parts = list(parts)
+    index = 0
+    while index < len(parts):
+        current = parts[index]
+        if not walked or nparts(walked[-1]) == 1 or nparts(current) != 1:
+            walked.append(current)
+            index += 1
+            continue
+
+        wrapper = walked.pop()
+        slic = parts[index:index + nparts(wrapper)]  # slice with subparts
         cwra = {
             MULTI: True,
-            PART_MAP: dict((index + 1, part)  # content wrapper
-                           for index, part in enumerate(slic)),
-            HEADERS: dict(parts[wind][HEADERS])
+            PART_MAP: dict((i + 1, subpart)  # content wrapper
+                           for i, subpart in enumerate(slic)),
+            HEADERS: dict(wrapper[HEADERS])
         }
+        index += len(slic) - 1
+        parts[index] = cwra
 
-        # remove subparts and substitue wrapper
-        map(lambda i: parts.remove(i), slic)
-        parts[wind] = cwra
-
-        # refresh vectors for this iteration
-        pv = list(get_parts_vector(parts))
-        wv = getwv(pv)
+    parts = walked
+    pv = [nparts(part) for part in parts]
 
     if all(x == 1 for x in pv):
         # special case in the rightmost element
@@ -156,7 +257,6 @@ def walk_msg_tree(parts, body_phash=None):
             last_part = max(main_pmap.keys())
             main_pmap[last_part][PART_MAP] = {}
             for partind in range(len(pv) - 1):
-                print partind+1, len(parts)
                 main_pmap[last_part][PART_MAP][partind] = parts[partind + 1]
 
     outer = parts[0]